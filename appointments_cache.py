@@ -0,0 +1,95 @@
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+
+class AppointmentsCache:
+    """
+    Bounded LRU cache of the rendered active appointments pages, keyed by the user ID.
+
+    Entries expire after 'ttl' seconds, which also covers appointments passing with time. Every flow that changes
+    the appointments of a user (booking, cancelling, rescheduling) must call invalidate() for that user.
+    """
+
+    def __init__(self, max_users: int = 10000, ttl: float = 5 * 60):
+        """
+        Args:
+            max_users (int, optional): How many users are kept before the least recently used ones are dropped. Default is 10000.
+            ttl (float, optional): How long a rendered page is reused, in seconds. Default is 5 minutes.
+        """
+        self.max_users = max_users
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+        # User ID -> page key -> (stored at, rendered page)
+        self._users: 'OrderedDict[int, Dict[Hashable, Tuple[float, Any]]]' = OrderedDict()
+
+    def get(self, user_id: int, key: Hashable) -> Optional[Any]:
+        """
+        Get a rendered page of the user.
+
+        Args:
+            user_id (int): The Telegram user ID.
+            key (Hashable): The page key, e.g. its cursors.
+
+        Returns:
+            Optional[Any]: The rendered page, or None if it is not cached or has expired.
+        """
+        pages = self._users.get(user_id)
+        entry = pages.get(key) if pages is not None else None
+
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            self.misses += 1
+            return None
+
+        self._users.move_to_end(user_id)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, user_id: int, key: Hashable, page: Any):
+        """
+        Store a rendered page of the user.
+
+        Args:
+            user_id (int): The Telegram user ID.
+            key (Hashable): The page key, e.g. its cursors.
+            page (Any): The rendered page.
+        """
+        pages = self._users.get(user_id)
+        if pages is None:
+            pages = self._users[user_id] = dict()
+            if len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+        else:
+            self._users.move_to_end(user_id)
+
+        pages[key] = (time.monotonic(), page)
+
+    def invalidate(self, user_id: int):
+        """
+        Drop all pages of the user, e.g. after an appointment was booked or cancelled.
+
+        Args:
+            user_id (int): The Telegram user ID.
+        """
+        if self._users.pop(user_id, None) is not None:
+            self.invalidations += 1
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Get the cache statistics.
+
+        Returns:
+            Dict[str, float]: The 'hits', 'misses', 'hit_rate', 'invalidations' and the number of cached 'users'.
+        """
+        requests = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests if requests else 0.0,
+            'invalidations': self.invalidations,
+            'users': len(self._users),
+        }
@@ -0,0 +1,160 @@
+"""
+Throughput and latency benchmark of the bot handlers.
+
+Feeds synthetic /start, 'menu', 'info', 'active' and successful payment updates through the dispatcher of bot.py,
+with the Telegram Bot API and the webapp replaced by local fakes (see benchmarks.fakes), and reports
+updates per second and p50/p99 latency for every handler. Nothing is sent to Telegram.
+
+The outbound rate limits of the bot are lifted (unless --rate-limits is given), since they would dominate the results.
+
+Usage (from the repository root):
+    python -m benchmarks.bot_handlers [--updates 2000] [--users 200] [--concurrency 50] [--api-latency-ms 0]
+"""
+import argparse
+import asyncio
+import datetime
+import itertools
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+from benchmarks.fakes import FakeTelegramServer, StubWebapp
+
+BOT_ID = 42
+
+
+def make_user(user_id: int) -> Dict[str, Any]:
+    return {'id': user_id, 'is_bot': False, 'first_name': 'User'}
+
+
+def make_message(update_id: int, user_id: int, **fields) -> Dict[str, Any]:
+    return {'update_id': update_id, 'message': dict({
+        'message_id': update_id, 'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'}, 'from': make_user(user_id),
+    }, **fields)}
+
+
+def make_callback_query(update_id: int, user_id: int, data: str) -> Dict[str, Any]:
+    # The callback query of a button under a message of the bot
+    message = {
+        'message_id': update_id, 'date': int(time.time()), 'text': 'Menu',
+        'chat': {'id': user_id, 'type': 'private'}, 'from': dict(make_user(BOT_ID), is_bot=True),
+    }
+    return {'update_id': update_id, 'callback_query': {
+        'id': str(update_id), 'from': make_user(user_id), 'chat_instance': str(user_id), 'data': data, 'message': message,
+    }}
+
+
+def make_successful_payment(update_id: int, user_id: int) -> Dict[str, Any]:
+    date_iso = (datetime.date.today() + datetime.timedelta(days=1)).isoformat()
+    return make_message(update_id, user_id, successful_payment={
+        'currency': 'USD',
+        'total_amount': 2000,
+        'invoice_payload': f'{user_id} {update_id} [1] {date_iso} 12:00:00',
+        'telegram_payment_charge_id': f'telegram-{update_id}',
+        'provider_payment_charge_id': f'provider-{update_id}',
+    })
+
+
+# Synthetic updates of every benchmarked handler
+SCENARIOS: Dict[str, Callable[[int, int], Dict[str, Any]]] = {
+    'start': lambda update_id, user_id: make_message(update_id, user_id, text='/start'),
+    'menu': lambda update_id, user_id: make_callback_query(update_id, user_id, 'menu'),
+    'info': lambda update_id, user_id: make_callback_query(update_id, user_id, 'info'),
+    'active': lambda update_id, user_id: make_callback_query(update_id, user_id, 'active'),
+    'successful_payment': make_successful_payment,
+}
+
+
+def percentile(latencies: List[float], q: float) -> float:
+    return latencies[min(int(len(latencies) * q), len(latencies) - 1)]
+
+
+def import_bot(telegram_url: str, webapp_url: str, rate_limits: bool):
+    # bot.py is configured from the environment when it is imported
+    os.environ.setdefault('BOT_TOKEN', f'{BOT_ID}:BENCHMARK')
+    os.environ.setdefault('PROVIDER_TOKEN', 'benchmark')
+    os.environ.setdefault('DJANGO_SECRET_KEY', 'benchmark')
+    os.environ.setdefault('DATABASE_URL', 'postgres://localhost/benchmark')
+    os.environ['WEBAPP_URL'] = f'{webapp_url}/bot'
+    os.environ['WEBAPP_MODE'] = 'http'
+    if not rate_limits:
+        os.environ['SEND_GLOBAL_RATE'] = os.environ['SEND_CHAT_RATE'] = '1000000'
+
+    import bot
+    from aiogram.client.telegram import TelegramAPIServer
+
+    bot.bot.session.api = TelegramAPIServer.from_base(telegram_url)
+    # The dispatcher logs every handled update
+    logging.getLogger().setLevel(logging.WARNING)
+    return bot
+
+
+async def run_scenario(bot_module, name: str, updates: int, users: int, concurrency: int) -> Tuple[float, List[float]]:
+    from aiogram import types
+
+    update_ids = itertools.count(1)
+    make_update = SCENARIOS[name]
+    queue = [
+        types.Update.model_validate(make_update(next(update_ids), 1000 + i % users), context={'bot': bot_module.bot})
+        for i in range(updates)
+    ]
+
+    latencies = []
+
+    async def worker(index: int):
+        for update in queue[index::concurrency]:
+            start = time.perf_counter()
+            await bot_module.dp.feed_update(bot_module.bot, update)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(index) for index in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return elapsed, latencies
+
+
+async def run(args: argparse.Namespace):
+    telegram = FakeTelegramServer(latency=args.api_latency_ms / 1000)
+    webapp = StubWebapp(latency=args.webapp_latency_ms / 1000)
+    bot_module = import_bot(await telegram.start(), await webapp.start(), args.rate_limits)
+
+    print(f"{args.updates} updates per handler, {args.users} users, concurrency {args.concurrency}, "
+          f"API latency {args.api_latency_ms} ms, webapp latency {args.webapp_latency_ms} ms")
+    print(f"{'handler':<20} {'updates/s':>10} {'p50 ms':>8} {'p99 ms':>8}")
+    try:
+        for name in args.handlers:
+            elapsed, latencies = await run_scenario(bot_module, name, args.updates, args.users, args.concurrency)
+            print(f"{name:<20} {len(latencies) / elapsed:>10.0f} "
+                  f"{percentile(latencies, 0.5) * 1000:>8.2f} {percentile(latencies, 0.99) * 1000:>8.2f}")
+
+        print(f"\nBot API calls: {dict(telegram.calls)}")
+        print(f"Webapp calls: {dict(webapp.calls)}")
+        print(f"Active appointments cache: {bot_module.active_appointments_cache.stats()}")
+    finally:
+        await bot_module.webapp_client.close()
+        await bot_module.bot.session.close()
+        await telegram.stop()
+        await webapp.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--updates', type=int, default=2000, help="Number of updates per handler")
+    parser.add_argument('--users', type=int, default=200, help="Number of distinct users")
+    parser.add_argument('--concurrency', type=int, default=50, help="Updates handled at once")
+    parser.add_argument('--api-latency-ms', type=float, default=0.0, help="Latency of the fake Bot API")
+    parser.add_argument('--webapp-latency-ms', type=float, default=0.0, help="Latency of the stub webapp")
+    parser.add_argument('--handlers', nargs='+', default=list(SCENARIOS), choices=list(SCENARIOS),
+                        help="Handlers to benchmark")
+    parser.add_argument('--rate-limits', action='store_true', help="Keep the outbound rate limits of the bot")
+    args = parser.parse_args()
+
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
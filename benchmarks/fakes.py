@@ -0,0 +1,159 @@
+"""
+Local stand-ins for the Telegram Bot API and the webapp, so that the bot can be exercised offline.
+"""
+import abc
+import asyncio
+import collections
+import datetime
+import itertools
+import socket
+import time
+from typing import Any, Dict, Optional
+
+from aiohttp import web
+
+# Methods answered with a sent (or edited) message, the other methods are answered with True
+MESSAGE_METHODS = {'sendmessage', 'editmessagetext', 'sendsticker', 'sendcontact', 'sendlocation'}
+
+
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class _LocalServer(abc.ABC):
+
+    def __init__(self, latency: float = 0.0):
+        """
+        Args:
+            latency (float, optional): Delay added to every response, in seconds. Default is 0.
+        """
+        self.latency = latency
+        self.calls = collections.Counter()
+
+        self._runner: Optional[web.AppRunner] = None
+        self.url: Optional[str] = None
+
+    @abc.abstractmethod
+    def make_app(self) -> web.Application:
+        pass
+
+    async def start(self) -> str:
+        """
+        Start the server on a free local port.
+
+        Returns:
+            str: The base URL of the server.
+        """
+        self._runner = web.AppRunner(self.make_app(), access_log=None)
+        await self._runner.setup()
+        port = get_free_port()
+        await web.TCPSite(self._runner, '127.0.0.1', port).start()
+        self.url = f'http://127.0.0.1:{port}'
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _delay(self):
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+
+
+class FakeTelegramServer(_LocalServer):
+    """
+    Fake Bot API server. Every method succeeds: sending and editing methods return a message in the requested chat,
+    the others return True. The number of calls of every method is counted in 'calls'.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__(latency)
+        self._message_ids = itertools.count(1)
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route('*', '/bot{token}/{method}', self.handle)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        self.calls[method] += 1
+        params = await request.post()
+        await self._delay()
+
+        if method.lower() == 'getme':
+            result: Any = {'id': 42, 'is_bot': True, 'first_name': 'Benchmark', 'username': 'benchmark_bot'}
+        elif method.lower() in MESSAGE_METHODS:
+            chat_id = int(params.get('chat_id', 0))
+            result = {
+                'message_id': int(params.get('message_id', 0)) or next(self._message_ids),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': params.get('text', ''),
+            }
+        else:
+            result = True
+
+        return web.json_response({'ok': True, 'result': result})
+
+
+class StubWebapp(_LocalServer):
+    """
+    Stub of the webapp endpoints called by the bot. Every user has 'appointments' active appointments,
+    served in pages like the real webapp does; bookings and slot hold checks always succeed.
+    """
+
+    def __init__(self, latency: float = 0.0, appointments: int = 12):
+        """
+        Args:
+            latency (float, optional): Delay added to every response, in seconds. Default is 0.
+            appointments (int, optional): Number of active appointments of every user. Default is 12.
+        """
+        super().__init__(latency)
+        date = datetime.date.today() + datetime.timedelta(days=1)
+        self.appointments = [
+            {
+                'services_titles': ['Haircut', 'Manicure'],
+                'date': (date + datetime.timedelta(days=i // 10)).isoformat(),
+                'time': datetime.time(11 + i % 10).isoformat(),
+            }
+            for i in range(appointments)
+        ]
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/bot/get_active_appointments', self.get_active_appointments)
+        app.router.add_get('/bot/make_appointment', self.make_appointment)
+        app.router.add_get('/bot/check_slot_hold', self.check_slot_hold)
+        return app
+
+    async def get_active_appointments(self, request: web.Request) -> web.Response:
+        self.calls['get_active_appointments'] += 1
+        await self._delay()
+
+        # Cursors are plain offsets here
+        limit = int(request.query.get('limit', 5))
+        start = int(request.query.get('after', -1)) + 1
+        if 'before' in request.query:
+            start = max(int(request.query['before']) - limit, 0)
+        end = min(start + limit, len(self.appointments))
+
+        page: Dict[str, Any] = {
+            'active_appointments': self.appointments[start:end],
+            'prev': str(start) if start > 0 else None,
+            'next': str(end - 1) if end < len(self.appointments) else None,
+        }
+        return web.json_response(page)
+
+    async def make_appointment(self, request: web.Request) -> web.Response:
+        self.calls['make_appointment'] += 1
+        await self._delay()
+        return web.Response(text="OK")
+
+    async def check_slot_hold(self, request: web.Request) -> web.Response:
+        self.calls['check_slot_hold'] += 1
+        await self._delay()
+        return web.json_response({'held': True})
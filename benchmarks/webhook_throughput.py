@@ -0,0 +1,138 @@
+"""
+Throughput benchmark of the sharded webhook.
+
+Replays updates (recorded as JSON lines, or synthetic /start messages and 'menu' callback queries)
+against the webhook with 1, 2 and 4 worker processes, and reports the number of updates handled per second.
+Handlers only burn CPU for --work-ms, no requests to Telegram are made. Recorded messages and callback queries
+other than /start and 'menu' are handled the same way, and the other updates are only counted.
+
+Usage (from the repository root):
+    python -m benchmarks.webhook_throughput [--updates updates.jsonl] [--workers 1 2 4]
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import time
+from typing import Any, Dict, List
+
+import aiohttp
+from aiogram import Bot, Dispatcher, F, types
+from aiogram.filters import Command
+from aiohttp import web
+
+from benchmarks.fakes import get_free_port
+from webhook_sharding import ShardedWebhook
+
+WEBHOOK_PATH = '/webhook'
+
+
+def make_synthetic_updates(count: int, chats: int) -> List[Dict[str, Any]]:
+    updates = list()
+    for update_id in range(count):
+        chat_id = 1000 + update_id % chats
+        user = {'id': chat_id, 'is_bot': False, 'first_name': 'User'}
+        message = {'message_id': update_id, 'date': 0, 'chat': {'id': chat_id, 'type': 'private'}, 'from': user}
+        if update_id % 2 == 0:
+            updates.append({'update_id': update_id, 'message': dict(message, text='/start')})
+        else:
+            updates.append({'update_id': update_id, 'callback_query': {
+                'id': str(update_id), 'from': user, 'chat_instance': '1', 'data': 'menu', 'message': message,
+            }})
+    return updates
+
+
+def make_dispatcher(work: float, handled: multiprocessing.Value) -> Dispatcher:
+    dp = Dispatcher()
+
+    def handle():
+        end = time.perf_counter() + work
+        while time.perf_counter() < end:
+            pass
+
+    # Every update is counted once the dispatcher is done with it, whether a handler matched it or not
+    @dp.update.outer_middleware()
+    async def count_handled(handler, update: types.Update, data: Dict[str, Any]):
+        try:
+            return await handler(update, data)
+        finally:
+            with handled.get_lock():
+                handled.value += 1
+
+    @dp.message(Command('start'))
+    async def start(message: types.Message):
+        handle()
+
+    @dp.callback_query(F.data == 'menu')
+    async def menu(callback_query: types.CallbackQuery):
+        handle()
+
+    @dp.message()
+    async def other_message(message: types.Message):
+        handle()
+
+    @dp.callback_query()
+    async def other_callback_query(callback_query: types.CallbackQuery):
+        handle()
+
+    return dp
+
+
+async def replay(sharded_webhook: ShardedWebhook, updates: List[Dict[str, Any]],
+                 handled: multiprocessing.Value, concurrency: int) -> float:
+    app = web.Application()
+    sharded_webhook.register(app, path=WEBHOOK_PATH)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    port = get_free_port()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+
+    semaphore = asyncio.Semaphore(concurrency)
+    async with aiohttp.ClientSession() as session:
+        async def post(update):
+            async with semaphore:
+                async with session.post(f'http://127.0.0.1:{port}{WEBHOOK_PATH}', json=update) as response:
+                    response.raise_for_status()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(post(update) for update in updates))
+        while handled.value < len(updates):
+            await asyncio.sleep(0.005)
+        elapsed = time.perf_counter() - start
+
+    await runner.cleanup()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--updates', help="JSON lines file with recorded updates (synthetic updates by default)")
+    parser.add_argument('--count', type=int, default=5000, help="Number of synthetic updates")
+    parser.add_argument('--chats', type=int, default=500, help="Number of chats of the synthetic updates")
+    parser.add_argument('--work-ms', type=float, default=1.0, help="CPU time spent by a handler per update")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help="Worker counts to compare")
+    parser.add_argument('--concurrency', type=int, default=100, help="Concurrent webhook requests")
+    args = parser.parse_args()
+
+    if args.updates:
+        with open(args.updates) as f:
+            updates = [json.loads(line) for line in f if line.strip()]
+    else:
+        updates = make_synthetic_updates(args.count, args.chats)
+
+    print(f"{len(updates)} updates, {args.work_ms} ms of work per update")
+    for workers in args.workers:
+        handled = multiprocessing.get_context('fork').Value('i', 0)
+        sharded_webhook = ShardedWebhook(make_dispatcher(args.work_ms / 1000, handled), Bot('42:BENCHMARK'), workers)
+
+        sharded_webhook.start_workers()
+        try:
+            elapsed = asyncio.run(replay(sharded_webhook, updates, handled, args.concurrency))
+        finally:
+            sharded_webhook.stop_workers()
+
+        print(f"{workers} worker(s): {len(updates) / elapsed:.0f} updates/s ({elapsed:.2f} s)")
+
+
+if __name__ == '__main__':
+    main()
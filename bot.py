@@ -4,18 +4,26 @@ import logging
 import os
 import ssl
 from urllib.parse import quote
-from typing import Union, Tuple
+from typing import Any, Dict, Optional, Union, Tuple
 
-import requests
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.filters import Command
 
 from webapp.mysecrets import BOT_TOKEN, WEBAPP_URL, WEBHOOK_SECRET, BASE_WEBHOOK_URL  # Importing mysecrets (BOT_TOKEN and WEBAPP_URL)
 
 from aiohttp import web
+from prometheus_client import start_http_server
 
 from aiogram import Router
-from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiogram.webhook.aiohttp_server import setup_application
+
+from appointments_cache import AppointmentsCache
+from bot_metrics import HandlerMetricsMiddleware, make_metrics_handler, register_stats
+from reminders import ReminderScheduler
+from send_scheduler import SendScheduler
+from update_queue import QueuedWebhook, UpdateQueue
+from webapp_client import DirectWebappClient, WebappClient
+from webhook_sharding import ShardedWebhook
 
 # Webserver settings
 WEB_SERVER_HOST = "0.0.0.0"
@@ -24,6 +32,54 @@ WEB_SERVER_PORT = int(os.getenv('PORT', 8443))
 # Path to webhook route, on which Telegram will send requests
 WEBHOOK_PATH = "/webhook"
 
+# Path to the depth and lag of the update queue (in JSON), for monitoring
+WEBHOOK_STATS_PATH = "/webhook/stats"
+
+# Path to the metrics in the Prometheus format, served next to the webhook with the bot token. When polling,
+# the metrics are served on METRICS_PORT of METRICS_ADDR (only locally by default) if it is set
+METRICS_PATH = "/metrics"
+METRICS_PORT = os.getenv('METRICS_PORT')
+METRICS_ADDR = os.getenv('METRICS_ADDR', '127.0.0.1')
+
+# The update queue database and the number of updates handled at once
+UPDATE_QUEUE_PATH = os.getenv('UPDATE_QUEUE_PATH', 'updates.sqlite3')
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', 20))
+
+# Number of worker processes handling the webhook updates (see run_on_server_webhooks_sharded)
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 2))
+
+# Webapp client settings
+# 'http' to call the webapp over HTTP, 'direct' to call its data functions through the Django ORM
+WEBAPP_MODE = os.getenv('WEBAPP_MODE', 'http')
+WEBAPP_TIMEOUT = float(os.getenv('WEBAPP_TIMEOUT', 10))
+WEBAPP_MAX_CONNECTIONS = int(os.getenv('WEBAPP_MAX_CONNECTIONS', 20))
+WEBAPP_MAX_CONCURRENCY = int(os.getenv('WEBAPP_MAX_CONCURRENCY', 10))
+WEBAPP_RETRIES = int(os.getenv('WEBAPP_RETRIES', 2))
+
+# Number of active appointments shown on a page
+ACTIVE_PAGE_SIZE = 5
+
+# How long the rendered active appointments pages are reused, in seconds, and for how many users
+ACTIVE_CACHE_TTL = float(os.getenv('ACTIVE_CACHE_TTL', 5 * 60))
+ACTIVE_CACHE_MAX_USERS = int(os.getenv('ACTIVE_CACHE_MAX_USERS', 10000))
+
+# How many hours before the appointments the reminders are sent (comma-separated, empty to disable the reminders),
+# how often the upcoming appointments are loaded, in seconds, and how many reminders are sent at once
+REMINDER_OFFSETS = [float(hours) for hours in os.getenv('REMINDER_OFFSETS', '24,2').split(',') if hours.strip()]
+REMINDER_REFRESH_INTERVAL = float(os.getenv('REMINDER_REFRESH_INTERVAL', 5 * 60))
+REMINDER_BATCH_SIZE = int(os.getenv('REMINDER_BATCH_SIZE', 30))
+
+# Chat notified when a paid appointment cannot be booked (optional)
+STAFF_CHAT_ID = os.getenv('STAFF_CHAT_ID')
+
+# Telegram expects the answer to a pre-checkout query within 10 seconds
+PRE_CHECKOUT_TIMEOUT = 5
+
+# Outbound message limits (see https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this).
+# The global rate leaves 10 of the 30 messages per second of the token to the broadcasts of the webapp
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', 20))
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', 1))
+
 
 # Configure logging for the application
 logging.basicConfig(level=logging.INFO)
@@ -32,6 +88,26 @@ logging.basicConfig(level=logging.INFO)
 bot = Bot(token=BOT_TOKEN)  # Create a bot instance using the provided BOT_TOKEN
 dp = Dispatcher()
 
+# Record the latency and the errors of every handler
+HandlerMetricsMiddleware().setup(dp)
+
+# Schedule all outbound messages within the Telegram flood limits
+send_scheduler = SendScheduler(global_rate=SEND_GLOBAL_RATE, chat_rate=SEND_CHAT_RATE)
+bot.session.middleware(send_scheduler)
+
+# Shared client for all requests to the webapp
+if WEBAPP_MODE == 'direct':
+    # The bot runs next to the webapp and calls its data functions directly
+    webapp_client = DirectWebappClient()
+else:
+    webapp_client = WebappClient(
+        WEBAPP_URL, BOT_TOKEN,
+        timeout=WEBAPP_TIMEOUT,
+        max_connections=WEBAPP_MAX_CONNECTIONS,
+        max_concurrency=WEBAPP_MAX_CONCURRENCY,
+        retries=WEBAPP_RETRIES,
+    )
+
 router = Router()
 
 
@@ -47,6 +123,65 @@ async def on_startup(bot: Bot) -> None:
     )
 
 
+# Rendered active appointments pages of the users
+active_appointments_cache = AppointmentsCache(max_users=ACTIVE_CACHE_MAX_USERS, ttl=ACTIVE_CACHE_TTL)
+
+
+# Define an asynchronous function to send the reminder of an appointment
+async def send_reminder(appointment: Dict[str, Any], offset: datetime.timedelta):
+    """
+    Send the reminder of an appointment to the user.
+
+    Args:
+        appointment (Dict[str, Any]): The appointment, as returned by the webapp.
+        offset (datetime.timedelta): How long before the appointment the reminder is sent.
+    """
+    date_formatted = datetime.date.fromisoformat(appointment["date"]).strftime("%B, %d")
+    time_formatted = datetime.time.fromisoformat(appointment["time"]).strftime("%H:%M")
+    text = f"Reminder of your appointment\n\nDate: *{date_formatted}*\nTime: *{time_formatted}*"
+    if appointment.get('services_titles'):
+        # The services are unknown for the appointments merged in right after the payment
+        text += "\nServices:\n" + "".join(f"\n— *{service_title}*" for service_title in appointment['services_titles'])
+
+    await bot.send_message(chat_id=appointment['user_id'], text=text, parse_mode='Markdown')
+
+
+# Reminders of the upcoming appointments
+reminder_scheduler = ReminderScheduler(
+    fetch=webapp_client.get_upcoming_appointments,
+    send=send_reminder,
+    offsets=[datetime.timedelta(hours=hours) for hours in REMINDER_OFFSETS],
+    refresh_interval=REMINDER_REFRESH_INTERVAL,
+    batch_size=REMINDER_BATCH_SIZE,
+)
+
+
+# Expose the stats of the caches and queues of the bot in the metrics
+register_stats('bot_active_appointments_cache', "Active appointments cache stats", active_appointments_cache.stats)
+register_stats('bot_reminders', "Reminder stats", reminder_scheduler.stats)
+register_stats('bot_send_scheduler', "Outbound messages waiting for the flood limits",
+               lambda: {'queue_size': send_scheduler.queue_size})
+
+
+async def start_reminders() -> None:
+    if REMINDER_OFFSETS:
+        reminder_scheduler.start()
+
+
+dp.startup.register(start_reminders)
+
+
+async def on_shutdown() -> None:
+    logging.info("Active appointments cache: %s", active_appointments_cache.stats())
+    logging.info("Reminders: %s", reminder_scheduler.stats())
+    await reminder_scheduler.stop()
+    # Close the connection pool to the webapp
+    await webapp_client.close()
+
+
+dp.shutdown.register(on_shutdown)
+
+
 # Define an asynchronous function to process incoming events
 async def process_event(event: Union[types.Message, types.CallbackQuery], with_user_id: bool = False) -> Union[
     types.Message, Tuple[types.Message, int]]:
@@ -142,11 +277,36 @@ async def pre_checkout(pre_checkout_query: types.PreCheckoutQuery):
     Args:
         pre_checkout_query (types.PreCheckoutQuery): The pre-checkout query to be handled.
     """
-    # Answer the pre-checkout query with 'ok'
-    await bot.answer_pre_checkout_query(
-        pre_checkout_query_id=pre_checkout_query.id,
-        ok=True
-    )
+    user_id, _, _, date_iso, time_iso = pre_checkout_query.invoice_payload.split()
+
+    # Check that the slot is still held for the user, well within the Telegram deadline for the answer
+    try:
+        held = await asyncio.wait_for(
+            webapp_client.check_slot_hold(int(user_id), date_iso, time_iso),
+            timeout=PRE_CHECKOUT_TIMEOUT
+        )
+    except Exception:
+        logging.exception("Failed to check the slot hold")
+        held = None
+
+    if held:
+        # Answer the pre-checkout query with 'ok'
+        await bot.answer_pre_checkout_query(
+            pre_checkout_query_id=pre_checkout_query.id,
+            ok=True
+        )
+    elif held is None:
+        await bot.answer_pre_checkout_query(
+            pre_checkout_query_id=pre_checkout_query.id,
+            ok=False,
+            error_message="Sorry, we could not confirm your appointment time. Please try again in a minute."
+        )
+    else:
+        await bot.answer_pre_checkout_query(
+            pre_checkout_query_id=pre_checkout_query.id,
+            ok=False,
+            error_message="Sorry, this time has just been booked. Please select another time for your appointment."
+        )
 
 
 # Define a handler for successful payment confirmation and create an appointment
@@ -162,15 +322,31 @@ async def successful_payment(message: types.Message):
     invoice_payload = message.successful_payment.invoice_payload
     user_id, init_message_id, services_ids, date_iso, time_iso = invoice_payload.split()
     user_id, init_message_id = int(user_id), int(init_message_id)
-
-    # Make a request to create an appointment using the provided data
-    requests.get(f'{WEBAPP_URL}/make_appointment', {
-        'bot_token': BOT_TOKEN,
-        'user_id': user_id,
-        'services_ids': services_ids,
-        'date_iso': date_iso,
-        'time_iso': time_iso,
-    }, verify=False)
+    charge_id = message.successful_payment.telegram_payment_charge_id
+
+    # Make a request to create an appointment using the provided data, once per payment
+    try:
+        await webapp_client.make_appointment(user_id, services_ids, date_iso, time_iso, charge_id)
+    except Exception:
+        # The user has already paid, so the booking must be refunded or moved to another time
+        logging.exception("Failed to book the paid appointment %s (charge %s)", invoice_payload, charge_id)
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text="Sorry, we could not book your appointment, the time may have just been taken. "
+                 "Your payment has been received: we will contact you to book another time or refund it.\n\n"
+                 f"Payment ID: {charge_id}"
+        )
+        if STAFF_CHAT_ID:
+            await bot.send_message(
+                chat_id=STAFF_CHAT_ID,
+                text=f"A paid appointment could not be booked and needs a refund or rebooking.\n\n"
+                     f"User ID: {user_id}\nDate: {date_iso}\nTime: {time_iso}\nServices: {services_ids}\n"
+                     f"Payment ID: {charge_id}"
+            )
+        return
+
+    active_appointments_cache.invalidate(user_id)
+    reminder_scheduler.add({'user_id': user_id, 'date': date_iso, 'time': time_iso})
 
     # Delete the initial message related to the payment
     await bot.delete_message(
@@ -275,60 +451,86 @@ async def contacts(event: Union[types.Message, types.CallbackQuery]):
     await info(message, init_message_editable=False)
 
 
-# Define a handler for the '/active' command or 'active' callback query to display active appointments for the user
-@dp.message(Command('active'))
-@dp.callback_query(lambda callback_query: callback_query.data == 'active')
-async def active(event: Union[types.Message, types.CallbackQuery]):
+# Define an asynchronous function to render a page of active appointments for the user
+async def render_active_page(user_id: int, after: Optional[str] = None, before: Optional[str] = None) -> Tuple[
+    str, types.InlineKeyboardMarkup, Optional[str]]:
     """
-    Handle the '/active' command or 'active' callback query to display active appointments for the user.
+    Render a page of active appointments for the user.
 
     Args:
-        event (Union[types.Message, types.CallbackQuery]): The incoming event that triggered the display of active appointments.
-    """
-    # Process the incoming event to get the message and user ID
-    message, user_id = await process_event(event, with_user_id=True)
+        user_id (int): The user ID.
+        after (str, optional): Cursor of the appointment the page starts after. Default is None (the first page).
+        before (str, optional): Cursor of the appointment the page ends before. Default is None.
 
-    # Make a request to get the user's active appointments
-    response = requests.get(f'{WEBAPP_URL}/get_active_appointments', {
-        'bot_token': BOT_TOKEN,
-        'user_id': user_id
-    }, verify=False)
+    Returns:
+        Tuple[str, types.InlineKeyboardMarkup, Optional[str]]: The text, the inline keyboard and the parse mode of the page.
+    """
+    # Make a request to get a page of the user's active appointments
+    page = await webapp_client.get_active_appointments(user_id, after=after, before=before, limit=ACTIVE_PAGE_SIZE)
 
-    active_appointments = response.json()['active_appointments']
+    if len(page['active_appointments']) == 0 and (after is not None or before is not None):
+        # The appointments around the cursor have passed or were cancelled, start from the first page
+        page = await webapp_client.get_active_appointments(user_id, limit=ACTIVE_PAGE_SIZE)
 
-    if len(active_appointments) == 0:
+    if len(page['active_appointments']) == 0:
         # If there are no active appointments, display a message with a back to menu button
         inline_keyboard_markup = types.InlineKeyboardMarkup(
             inline_keyboard=[[types.InlineKeyboardButton(text="< Menu", callback_data='menu')]])
-        await bot.edit_message_text(
-            chat_id=message.chat.id,
-            message_id=message.message_id,
-            text="You don't have any active appointments yet",
-            reply_markup=inline_keyboard_markup
-        )
-        return None
+        return "You don't have any active appointments yet", inline_keyboard_markup, None
+
+    # Add the pagination buttons, the cursors are passed in the callback data
+    nav_buttons = []
+    if page['prev'] is not None:
+        nav_buttons.append(types.InlineKeyboardButton(text="< Prev", callback_data=f"active_nav prev {page['prev']}"))
+    if page['next'] is not None:
+        nav_buttons.append(types.InlineKeyboardButton(text="Next >", callback_data=f"active_nav next {page['next']}"))
 
     inline_keyboard_markup = types.InlineKeyboardMarkup(
-        inline_keyboard=[[types.InlineKeyboardButton(text="< Menu", callback_data="menu")]]
+        inline_keyboard=[nav_buttons, [types.InlineKeyboardButton(text="< Menu", callback_data="menu")]]
+        if nav_buttons else [[types.InlineKeyboardButton(text="< Menu", callback_data="menu")]]
     )
 
-    text = ""
-    # Add text about all active appointments
-    for i in range(len(active_appointments)):
-        date_formatted = datetime.date.fromisoformat(active_appointments[i]["date"]).strftime("%B, %d")
-        time_formatted = datetime.time.fromisoformat(active_appointments[i]["time"]).strftime("%H:%M")
-        text += f"Date: *{date_formatted}*\nTime: *{time_formatted}*\nServices:\n"
-        for service_title in active_appointments[i]['services_titles']:
-            text += f"\n— *{service_title}*"
+    # Add text about the active appointments of the page
+    appointments_texts = []
+    for active_appointment in page['active_appointments']:
+        date_formatted = datetime.date.fromisoformat(active_appointment["date"]).strftime("%B, %d")
+        time_formatted = datetime.time.fromisoformat(active_appointment["time"]).strftime("%H:%M")
+        services_text = "".join(f"\n— *{service_title}*" for service_title in active_appointment['services_titles'])
+        appointments_texts.append(f"Date: *{date_formatted}*\nTime: *{time_formatted}*\nServices:\n{services_text}")
+
+    return "\n\n".join(appointments_texts), inline_keyboard_markup, 'Markdown'
 
-        text += "\n\n"
 
-    # Edit the message to display the active appointments with Markdown parsing
+# Define a handler for the '/active' command or 'active' callback query to display active appointments for the user
+@dp.message(Command('active'))
+@dp.callback_query(lambda callback_query: callback_query.data == 'active')
+async def active(event: Union[types.Message, types.CallbackQuery], after: Optional[str] = None, before: Optional[str] = None):
+    """
+    Handle the '/active' command or 'active' callback query to display a page of active appointments for the user.
+
+    Rendered pages are cached per user until they expire or the user books an appointment.
+
+    Args:
+        event (Union[types.Message, types.CallbackQuery]): The incoming event that triggered the display of active appointments.
+        after (str, optional): Cursor of the appointment the page starts after. Default is None (the first page).
+        before (str, optional): Cursor of the appointment the page ends before. Default is None.
+    """
+    # Process the incoming event to get the message and user ID
+    message, user_id = await process_event(event, with_user_id=True)
+
+    rendered_page = active_appointments_cache.get(user_id, (after, before))
+    if rendered_page is None:
+        rendered_page = await render_active_page(user_id, after=after, before=before)
+        active_appointments_cache.set(user_id, (after, before), rendered_page)
+
+    text, inline_keyboard_markup, parse_mode = rendered_page
+
+    # Edit the message to display the active appointments
     await bot.edit_message_text(
         chat_id=message.chat.id,
         message_id=message.message_id,
         text=text,
-        parse_mode='Markdown',
+        parse_mode=parse_mode,
         reply_markup=inline_keyboard_markup
     )
 
@@ -340,15 +542,14 @@ async def active_nav(callback_query: types.CallbackQuery):
     Handle pagination for active appointments.
 
     Args:
-        callback_query (types.CallbackQuery): The callback query containing pagination information.
+        callback_query (types.CallbackQuery): The callback query containing the direction and the cursor of the page.
     """
-    callback_query_data_split = callback_query.data.split()
-    active_appointment_idx = int(callback_query_data_split[-1])
+    _, direction, cursor = callback_query.data.split()
 
-    if callback_query_data_split[1] == 'prev':
-        await active(callback_query, active_appointment_idx - 1)
+    if direction == 'prev':
+        await active(callback_query, before=cursor)
     else:
-        await active(callback_query, active_appointment_idx + 1)
+        await active(callback_query, after=cursor)
 
 
 # Define the main asynchronous function to start polling the bot for incoming events
@@ -356,6 +557,8 @@ async def main():
     """
     Main function to start polling the bot for incoming events.
     """
+    if METRICS_PORT:
+        start_http_server(int(METRICS_PORT), addr=METRICS_ADDR)
     await dp.start_polling(bot)
 
 
@@ -368,16 +571,22 @@ def run_on_server_webhooks():
     # Create aiohttp.web.Application instance
     app = web.Application()
 
-    # Create an instance of request handler,
-    # aiogram has few implementations for different cases of usage
-    # In this example we use SimpleRequestHandler which is designed to handle simple cases
-    webhook_requests_handler = SimpleRequestHandler(
+    # Create an instance of request handler, which stores the updates in a durable queue
+    # and answers Telegram right away; the queue is drained by a pool of workers
+    update_queue = UpdateQueue(UPDATE_QUEUE_PATH)
+    register_stats('bot_update_queue', "Update queue stats", update_queue.stats)
+
+    webhook_requests_handler = QueuedWebhook(
         dispatcher=dp,
         bot=bot,
+        queue=update_queue,
         secret_token=WEBHOOK_SECRET,
+        bot_token=BOT_TOKEN,
+        workers=UPDATE_WORKERS,
     )
     # Register webhook handler on application
-    webhook_requests_handler.register(app, path=WEBHOOK_PATH)
+    webhook_requests_handler.register(app, path=WEBHOOK_PATH, stats_path=WEBHOOK_STATS_PATH)
+    app.router.add_get(METRICS_PATH, make_metrics_handler(BOT_TOKEN))
 
     # Mount dispatcher startup and shutdown hooks to aiohttp application
     setup_application(app, dp, bot=bot)
@@ -386,6 +595,53 @@ def run_on_server_webhooks():
     web.run_app(app, host=WEB_SERVER_HOST, port=WEB_SERVER_PORT)
 
 
+def sharded_send_rate() -> float:
+    # The workers and the main process (which sends the reminders) send with the same bot,
+    # so they share the global send rate
+    return SEND_GLOBAL_RATE / (WEBHOOK_WORKERS + 1)
+
+
+def init_webhook_worker(index: int):
+    send_scheduler.set_global_rate(sharded_send_rate())
+
+
+def run_on_server_webhooks_sharded():
+    """
+    Run the webhook server with the update handling spread over WEBHOOK_WORKERS processes.
+
+    Updates are routed to the workers by a hash of the chat ID, so the updates of a chat
+    are still handled in order, by the same process.
+    """
+    dp.include_router(router)
+
+    # Register startup hook to initialize webhook
+    dp.startup.register(on_startup)
+
+    app = web.Application()
+
+    sharded_webhook = ShardedWebhook(
+        dispatcher=dp,
+        bot=bot,
+        workers=WEBHOOK_WORKERS,
+        secret_token=WEBHOOK_SECRET,
+        worker_init=init_webhook_worker,
+    )
+    sharded_webhook.register(app, path=WEBHOOK_PATH)
+    app.router.add_get(METRICS_PATH, make_metrics_handler(BOT_TOKEN))
+
+    # Mount dispatcher startup and shutdown hooks to aiohttp application
+    setup_application(app, dp, bot=bot)
+
+    send_scheduler.set_global_rate(sharded_send_rate())
+
+    # Workers are forked before the event loop of the webserver is started
+    sharded_webhook.start_workers()
+    try:
+        web.run_app(app, host=WEB_SERVER_HOST, port=WEB_SERVER_PORT)
+    finally:
+        sharded_webhook.stop_workers()
+
+
 # Check if the script is being run directly
 if __name__ == '__main__':
     # Local run and develop
@@ -393,3 +649,5 @@ if __name__ == '__main__':
 
     # # Server setup
     # run_on_server_webhooks()
+    # # Or, to handle updates in several processes:
+    # run_on_server_webhooks_sharded()
@@ -0,0 +1,131 @@
+import hmac
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List
+
+from aiogram import BaseMiddleware, Dispatcher
+from aiogram.types import TelegramObject
+from aiohttp import web
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.multiprocess import MultiProcessCollector
+
+# Header with the bot token, like for the metrics of the webapp
+BOT_TOKEN_HEADER = 'X-Bot-Token'
+
+# Latency buckets of the handlers, in seconds
+HANDLER_DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+handler_duration = Histogram(
+    'bot_handler_duration_seconds', "Time spent in the bot handlers", ['handler'], buckets=HANDLER_DURATION_BUCKETS
+)
+handler_errors = Counter('bot_handler_errors', "Updates whose handler has raised an exception", ['handler'])
+
+# Collectors of the in-process stats, registered with register_stats()
+_stats_collectors: List['StatsCollector'] = list()
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """
+    Inner middleware of the dispatcher that records the latency and the errors of every handler,
+    labelled with the name of the handler function (e.g. 'menu', 'active' or 'successful_payment').
+    """
+
+    async def __call__(self,
+                       handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+                       event: TelegramObject,
+                       data: Dict[str, Any]) -> Any:
+        # Inner middlewares are called once the handler has been chosen by its filters
+        handler_object = data.get('handler')
+        name = handler_object.callback.__name__ if handler_object is not None else 'unknown'
+
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            handler_errors.labels(name).inc()
+            raise
+        finally:
+            handler_duration.labels(name).observe(time.perf_counter() - start)
+
+    def setup(self, dispatcher: Dispatcher):
+        """
+        Register the middleware for all the update types handled by the bot.
+
+        Args:
+            dispatcher (Dispatcher): The dispatcher.
+        """
+        for observer in (dispatcher.message, dispatcher.callback_query, dispatcher.pre_checkout_query):
+            observer.middleware(self)
+
+
+class StatsCollector:
+    """
+    Exposes a stats dictionary (e.g. AppointmentsCache.stats()) as a gauge with a 'stat' label, read on every scrape.
+    """
+
+    def __init__(self, name: str, documentation: str, get_stats: Callable[[], Dict[str, float]]):
+        self.name = name
+        self.documentation = documentation
+        self.get_stats = get_stats
+
+    def collect(self):
+        gauge = GaugeMetricFamily(self.name, self.documentation, labels=['stat'])
+        for stat, value in self.get_stats().items():
+            if value is not None:
+                gauge.add_metric([stat], value)
+        yield gauge
+
+
+def register_stats(name: str, documentation: str, get_stats: Callable[[], Dict[str, float]]):
+    """
+    Expose the stats of a component of the bot in the metrics.
+
+    Args:
+        name (str): The metric name, e.g. 'bot_active_appointments_cache'.
+        documentation (str): The metric description.
+        get_stats (Callable[[], Dict[str, float]]): Function returning the current stats.
+    """
+    collector = StatsCollector(name, documentation, get_stats)
+    REGISTRY.register(collector)
+    _stats_collectors.append(collector)
+
+
+def render_metrics() -> bytes:
+    """
+    Render the metrics in the Prometheus text format.
+
+    If PROMETHEUS_MULTIPROC_DIR is set (in all processes, before they start), the handler metrics
+    of all processes are aggregated, e.g. of the workers of run_on_server_webhooks_sharded().
+
+    Returns:
+        bytes: The metrics.
+    """
+    if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        return generate_latest(REGISTRY)
+
+    registry = CollectorRegistry()
+    MultiProcessCollector(registry)
+    for collector in _stats_collectors:
+        registry.register(collector)
+    return generate_latest(registry)
+
+
+def make_metrics_handler(bot_token: str) -> Callable[[web.Request], Awaitable[web.Response]]:
+    """
+    Get the handler serving the metrics to the requests with the bot token in the X-Bot-Token header
+    (or the 'bot_token' parameter), like the metrics of the webapp.
+
+    Args:
+        bot_token (str): The bot token.
+
+    Returns:
+        Callable[[web.Request], Awaitable[web.Response]]: The aiohttp handler.
+    """
+    async def handle_metrics(request: web.Request) -> web.Response:
+        token = request.headers.get(BOT_TOKEN_HEADER) or request.query.get('bot_token') or ''
+        if not hmac.compare_digest(token.encode(), bot_token.encode()):
+            return web.Response(status=403, text="Forbidden")
+        return web.Response(body=render_metrics(), headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+    return handle_metrics
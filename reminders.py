@@ -0,0 +1,234 @@
+import asyncio
+import datetime
+import heapq
+import itertools
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+from send_scheduler import BULK, send_priority
+
+logger = logging.getLogger(__name__)
+
+# (user_id, date_iso, time_iso, offset) of a reminder
+ReminderKey = Tuple[int, str, str, datetime.timedelta]
+
+# Longest window of the upcoming appointments loaded at once (MAX_UPCOMING_APPOINTMENTS_WINDOW of the webapp)
+MAX_FETCH_WINDOW = datetime.timedelta(days=7)
+
+
+def appointment_start(appointment: Dict[str, Any]) -> datetime.datetime:
+    return datetime.datetime.combine(datetime.date.fromisoformat(appointment['date']),
+                                     datetime.time.fromisoformat(appointment['time']))
+
+
+class ReminderScheduler:
+    """
+    Sends reminders some time before the appointments (e.g. 24 and 2 hours before).
+
+    Every 'refresh_interval' the appointments whose reminders are due between the previous refresh and the next
+    one are loaded with a windowed query (one per group of offsets within MAX_FETCH_WINDOW) and merged into
+    a min-heap of reminders ordered by due time; the scheduler sleeps until the earliest reminder (or the next
+    refresh) and sends the due reminders in batches, in the BULK lane of the send scheduler.
+
+    Since every refresh loads the reminders due since the previous one again, reminders are not lost when
+    the scheduler wakes up late or a load fails, and the appointments booked elsewhere (e.g. in the worker
+    processes of the sharded webhook, or in the admin) are picked up late by at most 'refresh_interval'.
+    Appointments booked in this process can be merged in right away with add(). Sent reminders are remembered,
+    so that they are not sent again.
+
+    All times are local and naive, like the dates and times of the appointments. Reminders that became due
+    while the bot was not running, or more than 'max_lateness' ago, are not sent.
+    """
+
+    def __init__(self,
+                 fetch: Callable[[datetime.datetime, datetime.datetime], Awaitable[List[Dict[str, Any]]]],
+                 send: Callable[[Dict[str, Any], datetime.timedelta], Awaitable[Any]],
+                 offsets: Sequence[datetime.timedelta],
+                 refresh_interval: float = 5 * 60,
+                 batch_size: int = 30,
+                 max_lateness: float = 60 * 60):
+        """
+        Args:
+            fetch (Callable): Coroutine function returning the appointments starting in [start, end),
+                e.g. webapp_client.get_upcoming_appointments.
+            send (Callable): Coroutine function sending the reminder of an appointment, called with the appointment
+                and the offset of the reminder.
+            offsets (Sequence[datetime.timedelta]): How long before the appointments the reminders are sent.
+            refresh_interval (float, optional): Time between the loads of the upcoming appointments, in seconds. Default is 5 minutes.
+            batch_size (int, optional): Maximum number of reminders sent at once. Default is 30.
+            max_lateness (float, optional): How late a reminder can still be sent, in seconds. Default is 1 hour.
+        """
+        self.fetch = fetch
+        self.send = send
+        self.offsets = sorted(offsets)
+        self.refresh_interval = datetime.timedelta(seconds=refresh_interval)
+        self.batch_size = batch_size
+        self.max_lateness = datetime.timedelta(seconds=max_lateness)
+
+        self.sent = 0
+        self.failed = 0
+
+        self._heap: List[Tuple[datetime.datetime, int, ReminderKey]] = list()
+        # Appointments of the reminders in the heap, so that an appointment loaded again is not reminded twice
+        self._scheduled: Dict[ReminderKey, Dict[str, Any]] = dict()
+        # Due times of the sent reminders that the next refresh loads again
+        self._sent: Dict[ReminderKey, datetime.datetime] = dict()
+        self._counter = itertools.count()
+        # Time of the last successful refresh, and until when the reminders have been loaded
+        self._refreshed_at: Optional[datetime.datetime] = None
+        self._loaded_until: Optional[datetime.datetime] = None
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def pending(self) -> int:
+        return len(self._heap)
+
+    def _push(self,
+              appointment: Dict[str, Any],
+              start: datetime.datetime,
+              until: datetime.datetime,
+              now: datetime.datetime) -> bool:
+        # Schedule the reminders of the appointment that are due in [start, until) and have not been sent,
+        # unless the appointment has already started
+        appointment_at = appointment_start(appointment)
+        if appointment_at <= now:
+            return False
+
+        pushed = False
+        for offset in self.offsets:
+            due_at = appointment_at - offset
+            key = (appointment['user_id'], appointment['date'], appointment['time'], offset)
+            if not start <= due_at < until or key in self._sent:
+                continue
+            if key not in self._scheduled:
+                heapq.heappush(self._heap, (due_at, next(self._counter), key))
+                pushed = True
+            # The loaded appointment replaces the one merged in with add()
+            self._scheduled[key] = appointment
+        return pushed
+
+    def add(self, appointment: Dict[str, Any]):
+        """
+        Merge a newly booked appointment in, so that its reminders due before the next refresh are sent on time.
+        Does nothing if the scheduler is not running in this process, the appointment is then picked up
+        by the next refresh of the process running it.
+
+        Args:
+            appointment (Dict[str, Any]): The 'user_id', 'date' and 'time' of the appointment. The other fields
+                (e.g. 'services_titles') are filled in if the appointment is loaded again before its reminder is due.
+        """
+        if self._task is None or self._loaded_until is None:
+            return
+
+        now = datetime.datetime.now()
+        if self._push(appointment, now, self._loaded_until, now):
+            # The new reminder may be due before the one the scheduler is sleeping for
+            self._wakeup.set()
+
+    def _fetch_windows(self,
+                       start: datetime.datetime,
+                       until: datetime.datetime) -> List[Tuple[datetime.datetime, datetime.datetime]]:
+        # Windows of the appointment start times of the reminders due in [start, until). The windows of the offsets
+        # are merged while they span at most MAX_FETCH_WINDOW, e.g. into a single window for 24 and 2 hours
+        windows: List[Tuple[datetime.datetime, datetime.datetime]] = list()
+        for offset in self.offsets:
+            window_start, window_end = start + offset, until + offset
+            if windows and window_end - windows[-1][0] <= MAX_FETCH_WINDOW:
+                window_start = windows.pop()[0]
+            while window_end - window_start > MAX_FETCH_WINDOW:
+                windows.append((window_start, window_start + MAX_FETCH_WINDOW))
+                window_start += MAX_FETCH_WINDOW
+            windows.append((window_start, window_end))
+        return windows
+
+    async def _refresh(self, now: datetime.datetime):
+        # Load again the reminders due since the previous refresh, which may have been booked in other processes
+        # or missed while this one was late
+        start = now if self._refreshed_at is None else max(self._refreshed_at, now - self.max_lateness)
+        until = now + self.refresh_interval
+
+        appointments = list()
+        for window_start, window_end in self._fetch_windows(start, until):
+            appointments.extend(await self.fetch(window_start, window_end))
+        for appointment in appointments:
+            self._push(appointment, start, until, now)
+
+        self._refreshed_at = now
+        self._loaded_until = until
+        # The sent reminders due before this refresh are not loaded again
+        self._sent = {key: due_at for key, due_at in self._sent.items() if due_at >= now}
+
+    async def _send_one(self, key: ReminderKey, appointment: Dict[str, Any]):
+        try:
+            await self.send(appointment, key[3])
+            self.sent += 1
+        except Exception:
+            self.failed += 1
+            logger.exception("Failed to send the reminder of the appointment %s", key)
+
+    async def _send_due(self, now: datetime.datetime):
+        while self._heap and self._heap[0][0] <= now:
+            batch = []
+            while self._heap and self._heap[0][0] <= now and len(batch) < self.batch_size:
+                due_at, _, key = heapq.heappop(self._heap)
+                batch.append((key, self._scheduled.pop(key)))
+                self._sent[key] = due_at
+
+            # Reminders must not delay the replies to the users
+            with send_priority(BULK):
+                await asyncio.gather(*(self._send_one(key, appointment) for key, appointment in batch))
+
+    async def _run(self):
+        next_refresh = datetime.datetime.now()
+        while True:
+            now = datetime.datetime.now()
+            if now >= next_refresh:
+                try:
+                    await self._refresh(now)
+                except Exception:
+                    logger.exception("Failed to load the upcoming appointments")
+                next_refresh = now + self.refresh_interval
+
+            await self._send_due(datetime.datetime.now())
+
+            # Sleep until the earliest reminder or the next refresh, unless a new reminder is added
+            deadline = min(self._heap[0][0], next_refresh) if self._heap else next_refresh
+            self._wakeup.clear()
+            timeout = (deadline - datetime.datetime.now()).total_seconds()
+            if timeout > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+    def start(self):
+        """
+        Start sending the reminders in a background task of the running event loop.
+        """
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        Stop the background task. Pending reminders are dropped, they are loaded again on the next start.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        self._heap.clear()
+        self._scheduled.clear()
+        self._sent.clear()
+        self._refreshed_at = None
+        self._loaded_until = None
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the number of pending, sent and failed reminders.
+        """
+        return {'pending': self.pending, 'sent': self.sent, 'failed': self.failed}
@@ -0,0 +1,200 @@
+import asyncio
+import contextlib
+import contextvars
+import heapq
+import itertools
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import (
+    EditMessageText, Response, SendContact, SendLocation, SendMessage, SendSticker, TelegramMethod,
+)
+from aiogram.methods.base import TelegramType
+
+logger = logging.getLogger(__name__)
+
+# Priority lanes: interactive replies are sent before bulk sends (broadcasts, reminders)
+INTERACTIVE = 0
+BULK = 1
+
+# Methods that deliver messages to chats and are subject to the Telegram flood limits
+RATE_LIMITED_METHODS = (SendMessage, EditMessageText, SendSticker, SendLocation, SendContact)
+
+_send_priority: contextvars.ContextVar[int] = contextvars.ContextVar('send_priority', default=INTERACTIVE)
+
+
+@contextlib.contextmanager
+def send_priority(priority: int):
+    """
+    Send the messages of the enclosed block (in the current task) with the given priority.
+
+    Args:
+        priority (int): INTERACTIVE or BULK.
+    """
+    token = _send_priority.set(priority)
+    try:
+        yield
+    finally:
+        _send_priority.reset(token)
+
+
+class TokenBucket:
+    """
+    Token bucket that allows 'rate' operations per second with bursts of up to 'capacity' operations.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def delay(self) -> float:
+        """
+        Get the time until a token is available, in seconds.
+        """
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+    async def acquire(self):
+        """
+        Wait for a token and take it.
+        """
+        while (delay := self.delay()) > 0:
+            await asyncio.sleep(delay)
+        self.take()
+
+
+class SendScheduler(BaseRequestMiddleware):
+    """
+    Request middleware of the bot session that schedules outbound messages within the Telegram flood limits.
+
+    Every message-delivering request waits for a token of its chat and then for a token of the global bucket,
+    which are granted by priority lanes. When Telegram still answers with 'retry_after', all sends are paused
+    for that time and the request is repeated. Other requests (answering queries, deleting messages, etc.)
+    are not delayed.
+    """
+
+    def __init__(self,
+                 global_rate: float = 30,
+                 chat_rate: float = 1,
+                 chat_burst: float = 3,
+                 max_retries: int = 3,
+                 max_chat_buckets: int = 10000):
+        """
+        Args:
+            global_rate (float, optional): Messages per second for all chats together. Default is 30.
+            chat_rate (float, optional): Messages per second for a single chat. Default is 1.
+            chat_burst (float, optional): Burst of messages allowed for a single chat. Default is 3.
+            max_retries (int, optional): How many times a request is repeated after 'retry_after'. Default is 3.
+            max_chat_buckets (int, optional): How many per-chat buckets are kept before idle ones are dropped. Default is 10000.
+        """
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_chat_buckets = max_chat_buckets
+
+        self._chat_buckets: Dict[int, TokenBucket] = dict()
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = list()
+        self._counter = itertools.count()
+        self._grant_task: Optional[asyncio.Task] = None
+        self._paused_until = 0.0
+
+    def _get_chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= self.max_chat_buckets:
+                # Drop the buckets of the chats that have been idle long enough to refill them
+                self._chat_buckets = {
+                    chat_id: bucket for chat_id, bucket in self._chat_buckets.items() if not bucket.is_full()
+                }
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def _grant(self):
+        # Grant global tokens to the waiters in the order of their priority
+        while self._waiters:
+            delay = max(self.global_bucket.delay(), self._paused_until - time.monotonic())
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            _, _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                self.global_bucket.take()
+                waiter.set_result(None)
+
+    async def acquire(self, chat_id: int, priority: int = INTERACTIVE):
+        """
+        Wait until a message can be sent to the chat.
+
+        Args:
+            chat_id (int): The chat ID.
+            priority (int, optional): INTERACTIVE or BULK. Default is INTERACTIVE.
+        """
+        await self._get_chat_bucket(chat_id).acquire()
+
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), waiter))
+        if self._grant_task is None or self._grant_task.done():
+            self._grant_task = asyncio.create_task(self._grant())
+
+        await waiter
+
+    def set_global_rate(self, rate: float):
+        """
+        Change the global rate, e.g. to split it between several processes sending with the same bot.
+
+        Args:
+            rate (float): Messages per second for all chats together.
+        """
+        self.global_bucket = TokenBucket(rate, rate)
+
+    def pause(self, seconds: float):
+        """
+        Pause all sends, e.g. after Telegram has answered with 'retry_after'.
+
+        Args:
+            seconds (float): The duration of the pause.
+        """
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    @property
+    def queue_size(self) -> int:
+        return len(self._waiters)
+
+    async def __call__(self,
+                       make_request: NextRequestMiddlewareType[TelegramType],
+                       bot: Bot,
+                       method: TelegramMethod[TelegramType]) -> Response[TelegramType]:
+        chat_id = getattr(method, 'chat_id', None)
+        if not isinstance(method, RATE_LIMITED_METHODS) or chat_id is None:
+            return await make_request(bot, method)
+
+        priority = _send_priority.get()
+        for attempt in range(self.max_retries + 1):
+            await self.acquire(chat_id, priority)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                logger.warning("Flood limit exceeded, pausing sends for %s seconds", e.retry_after)
+                self.pause(e.retry_after)
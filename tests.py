@@ -0,0 +1,461 @@
+import asyncio
+import datetime
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import send_scheduler
+from appointments_cache import AppointmentsCache
+from reminders import ReminderScheduler
+from send_scheduler import BULK, INTERACTIVE, SendScheduler, TokenBucket
+from update_queue import QueuedWebhook, UpdateQueue
+from webhook_sharding import ChatOrderedProcessor, get_shard, get_update_chat_id
+
+
+def make_update(update_id: int, chat_id: int) -> dict:
+    user = {'id': chat_id, 'is_bot': False, 'first_name': 'User'}
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': 0, 'chat': {'id': chat_id, 'type': 'private'}, 'from': user, 'text': 'Hi',
+    }}
+
+
+class TokenBucketTests(unittest.IsolatedAsyncioTestCase):
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(rate=10, capacity=3)
+
+        for _ in range(3):
+            self.assertEqual(bucket.delay(), 0)
+            bucket.take()
+        self.assertAlmostEqual(bucket.delay(), 0.1, delta=0.01)
+
+    async def test_acquire_waits_for_tokens(self):
+        bucket = TokenBucket(rate=50, capacity=1)
+
+        start = time.monotonic()
+        for _ in range(6):
+            await bucket.acquire()
+
+        # The first token is in the bucket, the other five come at 50 per second
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+
+class SendSchedulerTests(unittest.IsolatedAsyncioTestCase):
+
+    async def test_global_rate(self):
+        scheduler = SendScheduler(global_rate=50, chat_rate=100, chat_burst=100)
+
+        start = time.monotonic()
+        await asyncio.gather(*(scheduler.acquire(chat_id) for chat_id in range(60)))
+
+        # 50 messages are sent in a burst, the other 10 at 50 per second
+        self.assertGreaterEqual(time.monotonic() - start, 0.18)
+
+    async def test_chat_rate(self):
+        scheduler = SendScheduler(global_rate=1000, chat_rate=20, chat_burst=1)
+
+        start = time.monotonic()
+        for _ in range(3):
+            await scheduler.acquire(1)
+        await scheduler.acquire(2)
+
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+    async def test_interactive_messages_go_first(self):
+        scheduler = SendScheduler(global_rate=20, chat_rate=100, chat_burst=100)
+        # Empty the global bucket, so that the sends below wait in the priority lanes
+        scheduler.global_bucket.tokens = 0
+        sent = []
+
+        async def send(chat_id, priority):
+            await scheduler.acquire(chat_id, priority)
+            sent.append(chat_id)
+
+        await asyncio.gather(*(send(chat_id, BULK) for chat_id in range(3)),
+                             *(send(chat_id, INTERACTIVE) for chat_id in range(100, 103)))
+
+        self.assertEqual(sent, [100, 101, 102, 0, 1, 2])
+
+    async def test_retry_after_pauses_all_sends(self):
+        scheduler = SendScheduler(global_rate=1000, chat_rate=100, chat_burst=100)
+        method = SendMessage(chat_id=1, text="Hello")
+        requests = []
+
+        async def make_request(bot, method):
+            requests.append(time.monotonic())
+            if len(requests) == 1:
+                raise TelegramRetryAfter(method=method, message="Flood control exceeded", retry_after=1)
+            return 'sent'
+
+        self.assertEqual(await scheduler(make_request, None, method), 'sent')
+        self.assertGreaterEqual(requests[1] - requests[0], 0.95)
+
+        # Telegram answers with 'retry_after' for every chat, so the other chats wait as well
+        scheduler.pause(0.1)
+        start = time.monotonic()
+        await scheduler.acquire(2)
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+    async def test_retry_after_is_raised_after_max_retries(self):
+        scheduler = SendScheduler(max_retries=0)
+        method = SendMessage(chat_id=1, text="Hello")
+
+        async def make_request(bot, method):
+            raise TelegramRetryAfter(method=method, message="Flood control exceeded", retry_after=1)
+
+        with self.assertRaises(TelegramRetryAfter):
+            await scheduler(make_request, None, method)
+
+    async def test_bulk_priority_of_the_context(self):
+        scheduler = SendScheduler()
+        priorities = []
+
+        async def acquire(chat_id, priority=INTERACTIVE):
+            priorities.append(priority)
+
+        async def make_request(bot, method):
+            return 'sent'
+
+        scheduler.acquire = acquire
+        with send_scheduler.send_priority(BULK):
+            await scheduler(make_request, None, SendMessage(chat_id=1, text="Reminder"))
+        await scheduler(make_request, None, SendMessage(chat_id=1, text="Reply"))
+
+        self.assertEqual(priorities, [BULK, INTERACTIVE])
+
+
+class ChatOrderedProcessorTests(unittest.IsolatedAsyncioTestCase):
+
+    async def test_updates_of_a_chat_are_processed_in_order(self):
+        processed = []
+
+        async def process(update):
+            # The later updates of a chat finish faster, they would overtake the earlier ones if run concurrently
+            await asyncio.sleep(0.01 * (10 - update['update_id'] // 2))
+            processed.append(update['update_id'])
+
+        processor = ChatOrderedProcessor(process)
+        for update_id in range(10):
+            await processor.submit(make_update(update_id, chat_id=update_id % 2))
+        await processor.join()
+
+        self.assertEqual([update_id for update_id in processed if update_id % 2 == 0], [0, 2, 4, 6, 8])
+        self.assertEqual([update_id for update_id in processed if update_id % 2 == 1], [1, 3, 5, 7, 9])
+
+    async def test_chats_are_processed_concurrently(self):
+        running = 0
+        max_running = 0
+
+        async def process(update):
+            nonlocal running, max_running
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        processor = ChatOrderedProcessor(process, max_concurrent_updates=3)
+        for update_id in range(10):
+            await processor.submit(make_update(update_id, chat_id=update_id))
+        await processor.join()
+
+        self.assertEqual(max_running, 3)
+
+    async def test_failed_update_does_not_block_the_chat(self):
+        processed = []
+
+        async def process(update):
+            if update['update_id'] == 0:
+                raise ValueError("Handler failed")
+            processed.append(update['update_id'])
+
+        processor = ChatOrderedProcessor(process)
+        with self.assertLogs('webhook_sharding', 'ERROR'):
+            await processor.submit(make_update(0, chat_id=1))
+            await processor.submit(make_update(1, chat_id=1))
+            await processor.join()
+
+        self.assertEqual(processed, [1])
+
+
+class ShardingTests(unittest.TestCase):
+
+    def test_update_chat_id(self):
+        user = {'id': 7, 'is_bot': False, 'first_name': 'User'}
+
+        self.assertEqual(get_update_chat_id(make_update(1, chat_id=5)), 5)
+        self.assertEqual(get_update_chat_id({'update_id': 1, 'callback_query': {
+            'id': '1', 'from': user, 'chat_instance': '1', 'data': 'menu', 'message': make_update(0, 5)['message'],
+        }}), 5)
+        self.assertEqual(get_update_chat_id({'update_id': 1, 'pre_checkout_query': {'id': '1', 'from': user}}), 7)
+        self.assertIsNone(get_update_chat_id({'update_id': 1}))
+
+    def test_shard_is_stable(self):
+        self.assertEqual(get_shard(None, 4), 0)
+        self.assertEqual({get_shard(5, 4) for _ in range(3)}, {get_shard(5, 4)})
+        self.assertEqual({get_shard(chat_id, 4) for chat_id in range(100)}, {0, 1, 2, 3})
+
+
+
+class FakeDispatcher:
+    # Records the updates fed by the webhook, the handlers take 'delay' seconds
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.updates = []
+
+    async def feed_raw_update(self, bot, update):
+        await asyncio.sleep(self.delay)
+        self.updates.append(update['update_id'])
+
+
+class UpdateQueueTests(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'updates.sqlite3')
+
+    async def start_webhook(self, dispatcher: FakeDispatcher, on_shutdown=None) -> TestClient:
+        app = web.Application()
+        QueuedWebhook(dispatcher, None, UpdateQueue(self.path), bot_token='42:TOKEN').register(
+            app, '/webhook', stats_path='/webhook/stats'
+        )
+        # The shutdown hook of the dispatcher is registered after the webhook, like with setup_application()
+        if on_shutdown is not None:
+            app.on_shutdown.append(on_shutdown)
+        client = TestClient(TestServer(app))
+        await client.start_server()
+        return client
+
+    async def wait_for(self, condition):
+        for _ in range(200):
+            if condition():
+                return
+            await asyncio.sleep(0.01)
+        self.fail("Timed out")
+
+    def test_updates_are_deduplicated(self):
+        queue = UpdateQueue(self.path)
+        self.addCleanup(queue.close)
+
+        self.assertTrue(queue.put(2, '{"update_id": 2}'))
+        self.assertTrue(queue.put(1, '{"update_id": 1}'))
+        self.assertFalse(queue.put(2, '{"update_id": 2}'))
+        self.assertEqual(queue.get_pending(10), [(1, '{"update_id": 1}'), (2, '{"update_id": 2}')])
+
+        # An update delivered again after it has been processed is still a duplicate
+        queue.mark_processed(1)
+        self.assertFalse(queue.put(1, '{"update_id": 1}'))
+        self.assertEqual(queue.get_pending(10), [(2, '{"update_id": 2}')])
+        self.assertEqual(queue.stats()['depth'], 1)
+
+    def test_processed_updates_are_purged(self):
+        queue = UpdateQueue(self.path, retention=0)
+        self.addCleanup(queue.close)
+        queue.put(1, '{"update_id": 1}')
+        queue.put(2, '{"update_id": 2}')
+        queue.mark_processed(1)
+
+        self.assertEqual(queue.purge(), 1)
+        self.assertTrue(queue.put(1, '{"update_id": 1}'))
+
+    async def test_pending_updates_are_processed_after_a_restart(self):
+        # Updates stored by a process that stopped before processing them
+        queue = UpdateQueue(self.path)
+        for update_id in range(3):
+            queue.put(update_id, json.dumps(make_update(update_id, chat_id=1)))
+        queue.mark_processed(0)
+        queue.close()
+
+        dispatcher = FakeDispatcher()
+        client = await self.start_webhook(dispatcher)
+        await self.wait_for(lambda: len(dispatcher.updates) == 2)
+        await client.close()
+
+        self.assertEqual(dispatcher.updates, [1, 2])
+        queue = UpdateQueue(self.path)
+        self.addCleanup(queue.close)
+        self.assertEqual(queue.get_pending(10), [])
+
+    async def test_webhook_answers_before_processing(self):
+        dispatcher = FakeDispatcher(delay=0.05)
+        client = await self.start_webhook(dispatcher)
+
+        for update_id in (1, 2, 1):
+            response = await client.post('/webhook', data=json.dumps(make_update(update_id, chat_id=1)))
+            self.assertEqual(response.status, 200)
+        self.assertEqual(dispatcher.updates, [])
+
+        await self.wait_for(lambda: len(dispatcher.updates) == 2)
+        await client.close()
+        self.assertEqual(dispatcher.updates, [1, 2])
+
+    async def test_updates_are_finished_before_the_dispatcher_shuts_down(self):
+        dispatcher = FakeDispatcher(delay=0.1)
+        updates_at_shutdown = []
+
+        async def on_shutdown(app):
+            updates_at_shutdown.extend(dispatcher.updates)
+
+        client = await self.start_webhook(dispatcher, on_shutdown)
+        await client.post('/webhook', data=json.dumps(make_update(1, chat_id=1)))
+        # Stop while the update is being processed
+        await asyncio.sleep(0.02)
+        await client.close()
+
+        self.assertEqual(updates_at_shutdown, [1])
+
+    async def test_stats_require_the_bot_token(self):
+        client = await self.start_webhook(FakeDispatcher())
+
+        self.assertEqual((await client.get('/webhook/stats')).status, 403)
+        response = await client.get('/webhook/stats', headers={'X-Bot-Token': '42:TOKEN'})
+        self.assertEqual((await response.json())['depth'], 0)
+        await client.close()
+
+
+
+class AppointmentsCacheTests(unittest.TestCase):
+
+    def test_pages_are_cached_per_user(self):
+        cache = AppointmentsCache()
+        cache.set(1, (None, None), 'first page')
+        cache.set(1, ('cursor', None), 'second page')
+
+        self.assertEqual(cache.get(1, (None, None)), 'first page')
+        self.assertEqual(cache.get(1, ('cursor', None)), 'second page')
+        self.assertIsNone(cache.get(2, (None, None)))
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 1, 'hit_rate': 2 / 3, 'invalidations': 0, 'users': 1})
+
+    def test_least_recently_used_user_is_dropped(self):
+        cache = AppointmentsCache(max_users=2)
+        cache.set(1, None, 'page of 1')
+        cache.set(2, None, 'page of 2')
+        cache.get(1, None)
+        cache.set(3, None, 'page of 3')
+
+        self.assertEqual(cache.get(1, None), 'page of 1')
+        self.assertIsNone(cache.get(2, None))
+        self.assertEqual(cache.get(3, None), 'page of 3')
+
+    def test_pages_expire(self):
+        cache = AppointmentsCache(ttl=60)
+
+        with mock.patch('appointments_cache.time.monotonic', return_value=1000):
+            cache.set(1, None, 'page')
+        with mock.patch('appointments_cache.time.monotonic', return_value=1060):
+            self.assertEqual(cache.get(1, None), 'page')
+        with mock.patch('appointments_cache.time.monotonic', return_value=1061):
+            self.assertIsNone(cache.get(1, None))
+
+    def test_invalidate_drops_all_pages_of_the_user(self):
+        cache = AppointmentsCache()
+        cache.set(1, (None, None), 'first page')
+        cache.set(1, ('cursor', None), 'second page')
+        cache.set(2, (None, None), 'page of 2')
+
+        cache.invalidate(1)
+        cache.invalidate(3)
+
+        self.assertIsNone(cache.get(1, (None, None)))
+        self.assertIsNone(cache.get(1, ('cursor', None)))
+        self.assertEqual(cache.get(2, (None, None)), 'page of 2')
+        self.assertEqual(cache.stats()['invalidations'], 1)
+
+
+
+class ReminderSchedulerTests(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.now = datetime.datetime(2023, 10, 10, 10)
+        # Appointments in the database of the webapp
+        self.appointments = []
+        self.fetches = []
+        self.sent = []
+
+        async def fetch(start, end):
+            self.fetches.append((start, end))
+            return [appointment for appointment in self.appointments if start <= appointment_at(appointment) < end]
+
+        async def send(appointment, offset):
+            self.sent.append((appointment['user_id'], offset))
+
+        def appointment_at(appointment):
+            return datetime.datetime.fromisoformat(f"{appointment['date']}T{appointment['time']}")
+
+        self.scheduler = ReminderScheduler(fetch, send, [datetime.timedelta(hours=24), datetime.timedelta(hours=2)],
+                                           refresh_interval=300)
+
+    def book(self, user_id: int, start: datetime.datetime):
+        self.appointments.append({'user_id': user_id, 'services_titles': ['Haircut'],
+                                  'date': start.date().isoformat(), 'time': start.time().isoformat()})
+
+    def at(self, seconds: float) -> datetime.datetime:
+        return self.now + datetime.timedelta(seconds=seconds)
+
+    async def test_offsets_are_loaded_with_one_query(self):
+        await self.scheduler._refresh(self.now)
+
+        self.assertEqual(self.fetches, [(self.at(2 * 3600), self.at(24 * 3600 + 300))])
+
+    async def test_reminders_are_not_sent_twice_across_refreshes(self):
+        self.book(1, self.at(2 * 3600 + 100))
+
+        await self.scheduler._refresh(self.now)
+        await self.scheduler._send_due(self.at(100))
+        # The next refresh loads the reminders due since the previous one again
+        await self.scheduler._refresh(self.at(300))
+        await self.scheduler._send_due(self.at(300))
+
+        self.assertEqual(self.sent, [(1, datetime.timedelta(hours=2))])
+        self.assertEqual(self.scheduler.pending, 0)
+
+    async def test_reminders_booked_after_a_refresh_are_sent_late(self):
+        await self.scheduler._refresh(self.now)
+        # Booked in another process after the refresh, due before the next one
+        self.book(2, self.at(2 * 3600 + 200))
+        await self.scheduler._send_due(self.at(250))
+        self.assertEqual(self.sent, [])
+
+        await self.scheduler._refresh(self.at(300))
+        await self.scheduler._send_due(self.at(300))
+
+        self.assertEqual(self.sent, [(2, datetime.timedelta(hours=2))])
+
+    async def test_added_appointment_is_merged(self):
+        self.scheduler._loaded_until = self.at(300)
+        self.scheduler._refreshed_at = self.now
+        self.scheduler._task = mock.Mock()
+
+        with mock.patch('reminders.datetime.datetime', wraps=datetime.datetime) as mocked_datetime:
+            mocked_datetime.now.return_value = self.at(0)
+            self.scheduler.add({'user_id': 3, 'date': self.at(2 * 3600 + 60).date().isoformat(),
+                                'time': self.at(2 * 3600 + 60).time().isoformat()})
+        self.assertEqual(self.scheduler.pending, 1)
+
+        # The appointment is loaded again by the refresh, with its services, and reminded once
+        self.book(3, self.at(2 * 3600 + 60))
+        await self.scheduler._refresh(self.at(30))
+        self.assertEqual(self.scheduler.pending, 1)
+        self.assertEqual([appointment.get('services_titles') for appointment in self.scheduler._scheduled.values()],
+                         [['Haircut']])
+        await self.scheduler._send_due(self.at(60))
+
+        self.assertEqual(self.sent, [(3, datetime.timedelta(hours=2))])
+
+    async def test_add_does_nothing_when_not_running(self):
+        self.scheduler.add({'user_id': 3, 'date': self.at(2 * 3600).date().isoformat(),
+                            'time': self.at(2 * 3600).time().isoformat()})
+
+        self.assertEqual(self.scheduler.pending, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
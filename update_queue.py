@@ -0,0 +1,252 @@
+import asyncio
+import hmac
+import json
+import logging
+import sqlite3
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from aiogram import Bot, Dispatcher
+from aiohttp import web
+
+from bot_metrics import BOT_TOKEN_HEADER
+from webhook_sharding import SECRET_TOKEN_HEADER, ChatOrderedProcessor
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateQueue:
+    """
+    Durable queue of updates stored in a local SQLite database.
+
+    Updates are deduplicated by update_id: an update that Telegram delivers again (e.g. after a timeout)
+    is ignored, as long as the processed one is still retained.
+    """
+
+    def __init__(self, path: str, retention: float = 24 * 60 * 60):
+        """
+        Args:
+            path (str): The path to the SQLite database file.
+            retention (float, optional): How long processed updates are kept for deduplication, in seconds. Default is 24 hours.
+        """
+        self.retention = retention
+
+        self._connection = sqlite3.connect(path, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS updates (
+                update_id INTEGER PRIMARY KEY,
+                payload TEXT NOT NULL,
+                received_at REAL NOT NULL,
+                processed_at REAL
+            )
+        """)
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS updates_pending ON updates (update_id) WHERE processed_at IS NULL"
+        )
+
+    def put(self, update_id: int, payload: str) -> bool:
+        """
+        Store an update.
+
+        Args:
+            update_id (int): The update ID.
+            payload (str): The update as received.
+
+        Returns:
+            bool: Whether the update was stored, False if it is a duplicate.
+        """
+        cursor = self._connection.execute(
+            "INSERT OR IGNORE INTO updates (update_id, payload, received_at) VALUES (?, ?, ?)",
+            (update_id, payload, time.time())
+        )
+        return cursor.rowcount == 1
+
+    def get_pending(self, limit: int) -> List[Tuple[int, str]]:
+        """
+        Get pending updates in the order of their IDs.
+
+        Args:
+            limit (int): Maximum number of updates.
+
+        Returns:
+            List[Tuple[int, str]]: (update_id, payload) pairs.
+        """
+        return self._connection.execute(
+            "SELECT update_id, payload FROM updates WHERE processed_at IS NULL ORDER BY update_id LIMIT ?",
+            (limit,)
+        ).fetchall()
+
+    def mark_processed(self, update_id: int):
+        self._connection.execute("UPDATE updates SET processed_at = ? WHERE update_id = ?", (time.time(), update_id))
+
+    def purge(self) -> int:
+        """
+        Delete processed updates older than the retention period.
+
+        Returns:
+            int: The number of deleted updates.
+        """
+        cursor = self._connection.execute(
+            "DELETE FROM updates WHERE processed_at < ?", (time.time() - self.retention,)
+        )
+        return cursor.rowcount
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Get the queue depth (the number of pending updates) and lag (the age of the oldest pending update, in seconds).
+
+        Returns:
+            Dict[str, float]: The 'depth' and 'lag'.
+        """
+        depth, oldest_received_at = self._connection.execute(
+            "SELECT COUNT(*), MIN(received_at) FROM updates WHERE processed_at IS NULL"
+        ).fetchone()
+        return {
+            'depth': depth,
+            'lag': time.time() - oldest_received_at if oldest_received_at is not None else 0.0,
+        }
+
+    def close(self):
+        self._connection.close()
+
+
+class QueuedWebhook:
+    """
+    Webhook that stores every update in a durable queue and answers Telegram right away,
+    so slow handlers neither keep the webhook request open nor cause Telegram to deliver the update again.
+
+    The queue is drained by a pool of concurrent workers that keeps the order of the updates of each chat.
+    Updates that were pending when the process stopped are processed after the restart. An update is marked
+    processed once its handler has finished, so after a crash it may be handled again: handlers must be
+    idempotent (payments book their appointment once per charge ID).
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, queue: UpdateQueue,
+                 secret_token: Optional[str] = None,
+                 bot_token: Optional[str] = None,
+                 workers: int = 20,
+                 batch_size: int = 100,
+                 purge_interval: float = 10 * 60,
+                 shutdown_timeout: float = 30):
+        """
+        Args:
+            dispatcher (Dispatcher): The dispatcher to feed the updates to.
+            bot (Bot): The bot instance.
+            queue (UpdateQueue): The update queue.
+            secret_token (str, optional): The secret token of the webhook. Default is None (not checked).
+            bot_token (str, optional): The bot token required to read the queue stats, in the X-Bot-Token header
+                or the 'bot_token' parameter. Default is None (the stats are not served).
+            workers (int, optional): Maximum number of updates processed at once. Default is 20.
+            batch_size (int, optional): How many pending updates are read from the queue at once. Default is 100.
+            purge_interval (float, optional): How often processed updates are purged, in seconds. Default is 10 minutes.
+            shutdown_timeout (float, optional): How long the updates being processed are waited for on shutdown,
+                in seconds. Default is 30.
+        """
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.queue = queue
+        self.secret_token = secret_token
+        self.bot_token = bot_token
+        self.workers = workers
+        self.batch_size = batch_size
+        self.purge_interval = purge_interval
+        self.shutdown_timeout = shutdown_timeout
+
+        self._new_updates = asyncio.Event()
+        self._processor: Optional[ChatOrderedProcessor] = None
+        # IDs of the updates passed to the processor and not processed yet
+        self._claimed: Set[int] = set()
+        self._drain_task: Optional[asyncio.Task] = None
+        self._closed = False
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret_token is not None and \
+                not hmac.compare_digest(request.headers.get(SECRET_TOKEN_HEADER, '').encode(), self.secret_token.encode()):
+            return web.Response(status=401, text="Unauthorized")
+
+        payload = await request.text()
+        try:
+            update_id = int(json.loads(payload)['update_id'])
+        except (ValueError, KeyError, TypeError):
+            return web.Response(status=400, text="Bad Request")
+
+        # Telegram delivers the update again after the restart
+        if self._closed:
+            return web.Response(status=503, text="Service Unavailable")
+
+        if self.queue.put(update_id, payload):
+            self._new_updates.set()
+        return web.Response()
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        token = request.headers.get(BOT_TOKEN_HEADER) or request.query.get('bot_token') or ''
+        if self.bot_token is None or not hmac.compare_digest(token.encode(), self.bot_token.encode()):
+            return web.Response(status=403, text="Forbidden")
+        return web.json_response(self.queue.stats())
+
+    async def _process(self, update: Dict[str, Any]):
+        try:
+            await self.dispatcher.feed_raw_update(self.bot, update)
+        finally:
+            self._claimed.discard(update['update_id'])
+            # An update still running when the queue is closed on shutdown is processed again after the restart
+            if not self._closed:
+                self.queue.mark_processed(update['update_id'])
+
+    async def _drain(self):
+        purged_at = 0.0
+
+        while True:
+            self._new_updates.clear()
+            for update_id, payload in self.queue.get_pending(self.batch_size + len(self._claimed)):
+                if update_id not in self._claimed:
+                    self._claimed.add(update_id)
+                    await self._processor.submit(json.loads(payload))
+
+            if time.monotonic() - purged_at > self.purge_interval:
+                self.queue.purge()
+                purged_at = time.monotonic()
+
+            if not self._new_updates.is_set():
+                try:
+                    await asyncio.wait_for(self._new_updates.wait(), timeout=1)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _on_startup(self, app: web.Application):
+        self._processor = ChatOrderedProcessor(self._process, max_concurrent_updates=self.workers)
+        self._drain_task = asyncio.create_task(self._drain())
+
+    async def _on_shutdown(self, app: web.Application):
+        # Finish the updates being processed before the shutdown hooks of the dispatcher close the resources
+        # of the handlers, the pending ones are processed after the restart
+        try:
+            if self._drain_task is not None:
+                self._drain_task.cancel()
+                await asyncio.wait_for(self._processor.join(), timeout=self.shutdown_timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Updates still processed after %s seconds, they are processed again after the restart",
+                           self.shutdown_timeout)
+        finally:
+            self._closed = True
+            self.queue.close()
+
+    def register(self, app: web.Application, path: str, stats_path: Optional[str] = None):
+        """
+        Register the webhook handler and the queue draining on the application.
+
+        Args:
+            app (web.Application): The aiohttp application.
+            path (str): The webhook path.
+            stats_path (str, optional): The path of the queue stats (depth and lag) in JSON, served with the bot token.
+                Default is None (not served).
+        """
+        app.router.add_post(path, self.handle)
+        if stats_path is not None:
+            app.router.add_get(stats_path, self.handle_stats)
+        app.on_startup.append(self._on_startup)
+        # The queue is drained before the shutdown hooks of the dispatcher (see setup_application()),
+        # whether they are registered before or after
+        app.on_shutdown.insert(0, self._on_shutdown)
@@ -1,5 +1,7 @@
 from django.contrib import admin
-from .models import Service, Appointment
+from .models import Service, Staff, Appointment, Broadcast
 
 admin.site.register(Service)
-admin.site.register(Appointment)
\ No newline at end of file
+admin.site.register(Staff)
+admin.site.register(Appointment)
+admin.site.register(Broadcast)
@@ -0,0 +1,134 @@
+from django.http import HttpResponse
+from mysecrets import BOT_TOKEN
+
+import asyncio
+import functools
+import hmac
+import json
+import threading
+import time
+from collections import OrderedDict
+from hashlib import sha256
+from urllib.parse import parse_qsl
+
+from typing import Any, Dict, NamedTuple, Optional
+
+# Create a secret key using HMAC for verifying the Mini App init data
+secret_key = hmac.new(b'WebAppData', bytes(BOT_TOKEN, encoding='utf-8'), sha256).digest()
+
+# How long the Mini App init data is accepted after it was issued by Telegram, in seconds
+INIT_DATA_MAX_AGE = 24 * 60 * 60
+
+# How many verified init data strings are remembered
+VERIFIED_INIT_DATA_CACHE_SIZE = 4096
+
+INIT_DATA_HEADER = 'X-Telegram-Init-Data'
+BOT_TOKEN_HEADER = 'X-Bot-Token'
+
+
+class InitData(NamedTuple):
+    auth_date: int
+    user: Dict[str, Any]
+    fields: Dict[str, str]
+
+
+_verified_init_data: 'OrderedDict[str, InitData]' = OrderedDict()
+_verified_init_data_lock = threading.Lock()
+
+
+def _verify_init_data(init_data: str) -> Optional[InitData]:
+    fields = dict(parse_qsl(init_data, keep_blank_values=True))
+    received_hash = fields.pop('hash', '')
+
+    data_check_string = '\n'.join(f'{key}={value}' for key, value in sorted(fields.items()))
+    hash = hmac.new(secret_key, bytes(data_check_string, encoding='utf-8'), sha256).hexdigest()
+
+    if not hmac.compare_digest(hash.encode(), received_hash.encode()):
+        return None
+
+    try:
+        return InitData(auth_date=int(fields['auth_date']), user=json.loads(fields['user']), fields=fields)
+    except (KeyError, ValueError):
+        return None
+
+
+def verify_init_data(init_data: str) -> Optional[InitData]:
+    """
+    Verify the Mini App init data (window.Telegram.WebApp.initData) and check that it has not expired.
+
+    Verified init data is kept in a bounded LRU cache, so that the HMAC is computed once per Mini App session.
+
+    Args:
+        init_data (str): The raw init data query string.
+
+    Returns:
+        Optional[InitData]: The parsed init data, or None if it is not valid or has expired.
+    """
+    with _verified_init_data_lock:
+        verified = _verified_init_data.get(init_data)
+        if verified is not None:
+            _verified_init_data.move_to_end(init_data)
+
+    if verified is None:
+        verified = _verify_init_data(init_data)
+        if verified is None:
+            return None
+
+        with _verified_init_data_lock:
+            _verified_init_data[init_data] = verified
+            if len(_verified_init_data) > VERIFIED_INIT_DATA_CACHE_SIZE:
+                _verified_init_data.popitem(last=False)
+
+    if time.time() - verified.auth_date > INIT_DATA_MAX_AGE:
+        return None
+
+    return verified
+
+
+def _check_init_data(request) -> bool:
+    init_data = request.headers.get(INIT_DATA_HEADER) or request.GET.get('initData')
+    if not init_data:
+        return False
+
+    verified = verify_init_data(init_data)
+    if verified is None:
+        return False
+
+    request.init_data = verified
+    request.telegram_user = verified.user
+    return True
+
+
+def _check_bot_token(request) -> bool:
+    bot_token = request.headers.get(BOT_TOKEN_HEADER) or request.GET.get('bot_token') or ''
+    return hmac.compare_digest(bot_token.encode(), BOT_TOKEN.encode())
+
+
+def _require(check, response_text: str, status: int):
+    def decorator(view):
+        if asyncio.iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def wrapper(request, *args, **kwargs):
+                if not check(request):
+                    return HttpResponse(response_text, status=status)
+                return await view(request, *args, **kwargs)
+        else:
+            @functools.wraps(view)
+            def wrapper(request, *args, **kwargs):
+                if not check(request):
+                    return HttpResponse(response_text, status=status)
+                return view(request, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# Decorator for the views called by the Mini App. The raw init data is expected in the X-Telegram-Init-Data header
+# (or the 'initData' GET parameter); the verified init data and user are attached to the request
+# as request.init_data and request.telegram_user.
+init_data_required = _require(_check_init_data, "Unauthorized", 401)
+
+# Decorator for the views called by the bot. The bot token is expected in the X-Bot-Token header
+# (or the 'bot_token' GET parameter).
+bot_token_required = _require(_check_bot_token, "Forbidden", 403)
@@ -0,0 +1,236 @@
+from app import roster, scheduling
+from app.models import Appointment, SlotHold
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.db import connection, models
+from django.db.models.query import QuerySet
+from django.utils import timezone
+
+import datetime
+import hashlib
+import json
+
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+
+# Working hours of a salon without staff: the first appointment hour and the closing hour
+OPENING_HOUR = 11
+CLOSING_HOUR = 21
+
+# How many days ahead (including today) appointments can be booked
+BOOKING_DAYS = 60
+
+# How long a free slots map is reused at most, in seconds
+AVAILABILITY_TIMEOUT = 60
+
+# Postgres sequence holding the availability version (see migrations/0008_availability_version.py), shared by all
+# the processes, so that a booking made in one of them is seen by the others on their next request
+VERSION_SEQUENCE = 'app_availability_version'
+
+# Namespace of the advisory locks of the dates
+LOCK_NAMESPACE = 1
+
+# The only chair of a salon without staff
+DEFAULT_CHAIR = scheduling.Chair(None, scheduling.working_mask(datetime.time(OPENING_HOUR), datetime.time(CLOSING_HOUR)))
+
+
+class FreeSlotsMap(NamedTuple):
+    etag: str
+    # JSON response body with the free slots
+    content: bytes
+
+
+def _bookings_query(date_from: datetime.date, date_to: datetime.date) -> QuerySet:
+    # (staff_id, date, time, duration, expires_at) of the appointments and unexpired holds,
+    # expires_at is None for the appointments
+    appointments = Appointment.objects.filter(date__range=(date_from, date_to)).annotate(
+        expires_at=models.Value(None, output_field=models.DateTimeField())
+    ).values_list('staff_id', 'date', 'time', 'duration', 'expires_at')
+    holds = SlotHold.objects.filter(
+        date__range=(date_from, date_to), expires_at__gt=timezone.now()
+    ).values_list('staff_id', 'date', 'time', 'duration', 'expires_at')
+
+    return appointments.union(holds)
+
+
+def _build_schedule(chairs: List[scheduling.Chair],
+                    bookings_rows: Iterable[Tuple],
+                    date_from: datetime.date,
+                    days: int) -> Tuple[scheduling.Schedule, Optional[datetime.datetime]]:
+    schedule = scheduling.Schedule(chairs or [DEFAULT_CHAIR], date_from, days)
+
+    earliest_expiry = None
+    for *booking, expires_at in bookings_rows:
+        schedule.add(scheduling.Booking(*booking))
+        if expires_at is not None and (earliest_expiry is None or expires_at < earliest_expiry):
+            earliest_expiry = expires_at
+
+    return schedule, earliest_expiry
+
+
+def lock_date(date: datetime.date):
+    """
+    Serialize the bookings and holds of the date until the end of the current transaction,
+    so that the free chair found in the schedule cannot be taken by a concurrent booking.
+
+    Args:
+        date (datetime.date): The date.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_advisory_xact_lock(%s, %s)", [LOCK_NAMESPACE, date.toordinal()])
+
+
+def get_schedule(date_from: datetime.date, days: int) -> scheduling.Schedule:
+    """
+    Get the occupancy of all chairs over a range of days, with a single query for the appointments and holds.
+
+    Args:
+        date_from (datetime.date): The first date of the range.
+        days (int): The number of days in the range.
+
+    Returns:
+        scheduling.Schedule: The schedule.
+    """
+    bookings_rows = _bookings_query(date_from, date_from + datetime.timedelta(days=days - 1))
+    schedule, _ = _build_schedule(roster.get_chairs(), bookings_rows, date_from, days)
+
+    return schedule
+
+
+def get_free_slots(days: int = BOOKING_DAYS,
+                   now: Optional[datetime.datetime] = None,
+                   duration: int = scheduling.DEFAULT_DURATION) -> Dict[datetime.date.isoformat, List[datetime.time.isoformat]]:
+    """
+    Get the map of free start times for an appointment of the given duration over the booking horizon.
+
+    Args:
+        days (int, optional): The number of days in the horizon, starting from today. Default is BOOKING_DAYS.
+        now (datetime.datetime, optional): The current date and time. Default is datetime.datetime.now().
+        duration (int, optional): The duration of the appointment in minutes. Default is scheduling.DEFAULT_DURATION.
+
+    Returns:
+        Dict[str, List[str]]: Free start times (in ISO format) by date (in ISO format).
+    """
+    if now is None:
+        now = datetime.datetime.now()
+
+    schedule = get_schedule(now.date(), days)
+
+    return schedule.free_slots(scheduling.duration_slots(duration), now)
+
+
+async def aget_free_slots(days: int = BOOKING_DAYS,
+                          now: Optional[datetime.datetime] = None,
+                          duration: int = scheduling.DEFAULT_DURATION) -> Dict[datetime.date.isoformat, List[datetime.time.isoformat]]:
+    """
+    Asynchronous version of get_free_slots().
+
+    Args:
+        days (int, optional): The number of days in the horizon, starting from today. Default is BOOKING_DAYS.
+        now (datetime.datetime, optional): The current date and time. Default is datetime.datetime.now().
+        duration (int, optional): The duration of the appointment in minutes. Default is scheduling.DEFAULT_DURATION.
+
+    Returns:
+        Dict[str, List[str]]: Free start times (in ISO format) by date (in ISO format).
+    """
+    if now is None:
+        now = datetime.datetime.now()
+
+    today = now.date()
+    bookings_rows = [row async for row in _bookings_query(today, today + datetime.timedelta(days=days - 1))]
+    schedule, _ = _build_schedule(await roster.aget_chairs(), bookings_rows, today, days)
+
+    return schedule.free_slots(scheduling.duration_slots(duration), now)
+
+
+def get_version() -> int:
+    """
+    Get the availability version, which is incremented whenever slots are booked, held or freed.
+
+    Returns:
+        int: The availability version.
+    """
+    with connection.cursor() as cursor:
+        # The last value of a sequence is read without a lock and is the same in every session
+        cursor.execute(f"SELECT last_value FROM {VERSION_SEQUENCE}")
+        return cursor.fetchone()[0]
+
+
+def bump_version():
+    """
+    Increment the availability version, so that the cached free slots maps are rebuilt in all the processes.
+    It is meant to be called once the transaction that books, holds or frees slots is committed.
+    """
+    with connection.cursor() as cursor:
+        # nextval() is atomic and never blocks nor is rolled back
+        cursor.execute(f"SELECT nextval('{VERSION_SEQUENCE}')")
+
+
+def _build_free_slots_map(chairs: List[scheduling.Chair],
+                          bookings_rows: Iterable[Tuple],
+                          slots: int,
+                          now: datetime.datetime) -> Tuple[FreeSlotsMap, float]:
+    schedule, earliest_expiry = _build_schedule(chairs, bookings_rows, now.date(), BOOKING_DAYS)
+
+    content = json.dumps({'free_dates': schedule.free_slots(slots, now)}).encode('utf-8')
+
+    # The map changes when the hour rolls over or the earliest hold expires
+    next_hour = now.replace(minute=0, second=0, microsecond=0) + datetime.timedelta(hours=1)
+    timeout = min(AVAILABILITY_TIMEOUT, (next_hour - now).total_seconds())
+    if earliest_expiry is not None:
+        timeout = min(timeout, (earliest_expiry - timezone.now()).total_seconds())
+
+    return FreeSlotsMap(etag=hashlib.sha256(content).hexdigest()[:32], content=content), timeout
+
+
+def get_free_slots_map(duration: int = scheduling.DEFAULT_DURATION) -> FreeSlotsMap:
+    """
+    Get the free start times for an appointment of the given duration as a JSON response body together with its ETag.
+
+    The map is cached per availability version and appointment length until the hour rolls over
+    or the earliest hold expires, so while nothing is booked it is served with a single query (the version).
+
+    Args:
+        duration (int, optional): The duration of the appointment in minutes. Default is scheduling.DEFAULT_DURATION.
+
+    Returns:
+        FreeSlotsMap: The free slots map.
+    """
+    slots = scheduling.duration_slots(duration)
+    key = f'availability:free_slots:{get_version()}:{slots}'
+
+    free_slots_map = cache.get(key)
+    if free_slots_map is None:
+        now = datetime.datetime.now()
+        bookings_rows = _bookings_query(now.date(), now.date() + datetime.timedelta(days=BOOKING_DAYS - 1))
+        free_slots_map, timeout = _build_free_slots_map(roster.get_chairs(), bookings_rows, slots, now)
+        cache.set(key, free_slots_map, timeout)
+
+    return free_slots_map
+
+
+async def aget_free_slots_map(duration: int = scheduling.DEFAULT_DURATION) -> FreeSlotsMap:
+    """
+    Asynchronous version of get_free_slots_map().
+
+    Args:
+        duration (int, optional): The duration of the appointment in minutes. Default is scheduling.DEFAULT_DURATION.
+
+    Returns:
+        FreeSlotsMap: The free slots map.
+    """
+    version = await sync_to_async(get_version)()
+
+    slots = scheduling.duration_slots(duration)
+    key = f'availability:free_slots:{version}:{slots}'
+
+    free_slots_map = await cache.aget(key)
+    if free_slots_map is None:
+        now = datetime.datetime.now()
+        bookings_rows = [
+            row async for row in _bookings_query(now.date(), now.date() + datetime.timedelta(days=BOOKING_DAYS - 1))
+        ]
+        free_slots_map, timeout = _build_free_slots_map(await roster.aget_chairs(), bookings_rows, slots, now)
+        await cache.aset(key, free_slots_map, timeout)
+
+    return free_slots_map
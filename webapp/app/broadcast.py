@@ -0,0 +1,188 @@
+from app import telegram
+from app.models import Appointment, Broadcast
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from django.utils import timezone
+
+import collections
+import logging
+import threading
+import time
+
+from typing import Callable, Deque, Dict, Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Number of user IDs fetched from the server-side cursor at once
+BROADCAST_CHUNK_SIZE = 1000
+
+# Messages sent at once, and per second. The bot sends its replies with the same token and its own
+# SEND_GLOBAL_RATE budget (20 by default), so the two rates add up and their sum must stay within
+# the Telegram limit of 30 messages per second
+BROADCAST_CONCURRENCY = 8
+BROADCAST_RATE = 10
+
+# How often the progress is saved and reported, in seconds
+CHECKPOINT_INTERVAL = 1.0
+
+# How many times a message is sent again after Telegram has answered with 'retry_after' or a server error
+MAX_RETRIES = 3
+
+SENT = 'sent'
+FAILED = 'failed'
+
+
+class RateLimiter:
+    """
+    Spaces the sends of all threads evenly at 'rate' messages per second.
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self._next_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            send_at = max(self._next_at, now)
+            self._next_at = send_at + self.interval
+        time.sleep(send_at - now)
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self._next_at = max(self._next_at, time.monotonic() + seconds)
+
+
+def send(limiter: RateLimiter, user_id: int, text: str) -> str:
+    """
+    Send the message to the user within the rate limit, retrying after flood limits and server errors.
+
+    Args:
+        limiter (RateLimiter): The rate limiter shared by the threads of the broadcast.
+        user_id (int): The user ID.
+        text (str): The message text.
+
+    Returns:
+        str: SENT, or FAILED if the user has blocked the bot, does not exist or the retries are exhausted.
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        limiter.wait()
+        try:
+            response = telegram.send_message(user_id, text)
+        except OSError as e:
+            logger.warning("Broadcast to %s failed: %r", user_id, e)
+            continue
+
+        if response.get('ok'):
+            return SENT
+
+        retry_after = response.get('parameters', {}).get('retry_after')
+        if retry_after is not None:
+            # All threads wait, the flood limit is shared
+            limiter.pause(retry_after)
+        elif response.get('error_code', 500) < 500:
+            # The user has blocked the bot or the chat does not exist, sending again would not help
+            return FAILED
+
+    return FAILED
+
+
+def iter_user_ids(after: Optional[int] = None) -> Iterator[int]:
+    """
+    Stream the distinct IDs of the users who have booked an appointment, in ascending order,
+    through a server-side cursor.
+
+    Args:
+        after (int, optional): Start after this user ID. Default is None (from the first user).
+
+    Returns:
+        Iterator[int]: The user IDs.
+    """
+    appointments = Appointment.objects.all()
+    if after is not None:
+        appointments = appointments.filter(user_id__gt=after)
+
+    # Served by the (user_id, date, time) index
+    return appointments.order_by('user_id').values_list('user_id', flat=True).distinct().iterator(
+        chunk_size=BROADCAST_CHUNK_SIZE
+    )
+
+
+def _save(broadcast: Broadcast):
+    Broadcast.objects.filter(pk=broadcast.pk).update(
+        last_user_id=broadcast.last_user_id, sent=broadcast.sent, failed=broadcast.failed,
+        finished_at=broadcast.finished_at,
+    )
+
+
+def run_broadcast(broadcast: Broadcast,
+                  concurrency: int = BROADCAST_CONCURRENCY,
+                  rate: float = BROADCAST_RATE,
+                  progress: Optional[Callable[[Broadcast, float], None]] = None) -> Broadcast:
+    """
+    Send the broadcast to every user after its checkpoint.
+
+    Messages are sent by 'concurrency' threads, and the checkpoint ('last_user_id') is the highest user ID
+    up to which all messages have been handled, saved every CHECKPOINT_INTERVAL. After a crash, the broadcast
+    is resumed after the checkpoint, so at most the messages in flight at the time of the crash are sent twice.
+
+    Args:
+        broadcast (Broadcast): The broadcast, new or interrupted.
+        concurrency (int, optional): Number of messages sent at once. Default is BROADCAST_CONCURRENCY.
+        rate (float, optional): Messages per second. Default is BROADCAST_RATE.
+        progress (Callable[[Broadcast, float], None], optional): Called with the broadcast and the current
+            throughput (messages per second) on every checkpoint. Default is None.
+
+    Returns:
+        Broadcast: The finished broadcast.
+    """
+    limiter = RateLimiter(rate)
+    # Messages in flight, in the order of the user IDs
+    in_flight: Deque[Tuple[int, Future]] = collections.deque()
+    initial_sent, initial_failed = broadcast.sent, broadcast.failed
+    counts: Dict[str, int] = {SENT: 0, FAILED: 0}
+    started_at = checkpoint_at = time.monotonic()
+
+    def advance() -> Optional[BaseException]:
+        # Move the checkpoint over the handled messages, up to the first message that has crashed
+        while in_flight and in_flight[0][1].done():
+            user_id, future = in_flight[0]
+            if future.exception() is not None:
+                return future.exception()
+            in_flight.popleft()
+            counts[future.result()] += 1
+            broadcast.last_user_id = user_id
+        return None
+
+    def checkpoint(force: bool = False):
+        nonlocal checkpoint_at
+
+        error = advance()
+        now = time.monotonic()
+        if force or error is not None or now - checkpoint_at >= CHECKPOINT_INTERVAL:
+            broadcast.sent, broadcast.failed = initial_sent + counts[SENT], initial_failed + counts[FAILED]
+            _save(broadcast)
+            checkpoint_at = now
+            if progress is not None:
+                progress(broadcast, (counts[SENT] + counts[FAILED]) / max(now - started_at, 1e-9))
+        if error is not None:
+            raise error
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='broadcast') as executor:
+        try:
+            for user_id in iter_user_ids(broadcast.last_user_id):
+                running = [future for _, future in in_flight if not future.done()]
+                if len(running) >= concurrency:
+                    wait(running, return_when=FIRST_COMPLETED)
+                    checkpoint()
+                in_flight.append((user_id, executor.submit(send, limiter, user_id, broadcast.text)))
+
+            wait([future for _, future in in_flight])
+            checkpoint()
+            broadcast.finished_at = timezone.now()
+        finally:
+            # Save the progress of the messages in flight, even if the broadcast has crashed
+            wait([future for _, future in in_flight])
+            checkpoint(force=True)
+
+    return broadcast
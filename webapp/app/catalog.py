@@ -0,0 +1,209 @@
+from app.models import Service
+from app.scheduling import DEFAULT_DURATION
+from asgiref.sync import sync_to_async
+from django.core import serializers
+
+import threading
+import time
+
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
+
+# How long a loaded catalog is trusted, in seconds. Signals invalidate the catalog only in the process
+# where the service was changed, so other worker processes pick the change up after this timeout.
+CATALOG_TIMEOUT = 60
+
+# Services missing from the catalog (e.g. deleted services of old appointments, or IDs sent by clients)
+# reload it only if it was loaded longer than this ago, in seconds
+UNKNOWN_SERVICES_RELOAD_INTERVAL = 5
+
+
+class CatalogEntry(NamedTuple):
+    title: str
+    price: int
+
+
+class ServiceCatalog(NamedTuple):
+    # Incremented on every load of the catalog that finds the services changed
+    version: int
+    services: List[Service]
+    services_json: str
+    entries: Dict[int, CatalogEntry]
+    # Durations of the services in minutes
+    durations: Dict[int, int]
+    loaded_at: float
+
+
+_catalog: Optional[ServiceCatalog] = None
+_version = 0
+_lock = threading.Lock()
+
+
+def _load(previous: Optional[ServiceCatalog]) -> ServiceCatalog:
+    global _version
+
+    services = list(Service.objects.order_by('pk'))
+    services_json = serializers.serialize('json', services)
+
+    # Keep the version of an unchanged catalog, so that the pages rendered from it are not rendered again
+    if previous is not None and previous.services_json == services_json:
+        return previous._replace(loaded_at=time.monotonic())
+
+    _version += 1
+
+    return ServiceCatalog(
+        version=_version,
+        services=services,
+        services_json=services_json,
+        entries={service.pk: CatalogEntry(service.title, service.price) for service in services},
+        durations={service.pk: service.duration for service in services},
+        loaded_at=time.monotonic(),
+    )
+
+
+def _is_fresh(catalog: Optional[ServiceCatalog]) -> bool:
+    return catalog is not None and time.monotonic() - catalog.loaded_at <= CATALOG_TIMEOUT
+
+
+def _is_complete(catalog: ServiceCatalog, services_ids: List[int]) -> bool:
+    # Whether the catalog can be used for the services without reloading it: they are all known,
+    # or the catalog has just been loaded and the unknown services do not exist
+    return (all(service_id in catalog.entries for service_id in services_ids)
+            or time.monotonic() - catalog.loaded_at < UNKNOWN_SERVICES_RELOAD_INTERVAL)
+
+
+def _get_catalog_for(services_ids: List[int]) -> ServiceCatalog:
+    # Get the catalog, reloading it if some of the services are unknown (they may have been added by another process)
+    global _catalog
+
+    catalog = get_catalog()
+    if not _is_complete(catalog, services_ids):
+        with _lock:
+            if _catalog is catalog:
+                _catalog = _load(catalog)
+            catalog = _catalog
+
+    return catalog
+
+
+def get_catalog() -> ServiceCatalog:
+    """
+    Get the service catalog, loading it with a single query if it is not cached yet.
+
+    Returns:
+        ServiceCatalog: The cached service catalog.
+    """
+    global _catalog
+
+    catalog = _catalog
+    if not _is_fresh(catalog):
+        with _lock:
+            catalog = _catalog = _load(_catalog)
+
+    return catalog
+
+
+async def aget_catalog() -> ServiceCatalog:
+    """
+    Asynchronous version of get_catalog(). The database is accessed only if the cached catalog is missing or stale.
+
+    Returns:
+        ServiceCatalog: The cached service catalog.
+    """
+    catalog = _catalog
+    if _is_fresh(catalog):
+        return catalog
+
+    return await sync_to_async(get_catalog)()
+
+
+def invalidate():
+    """
+    Mark the cached catalog as stale, so that it is reloaded on the next access
+    (with a new version if the services have changed).
+    """
+    global _catalog
+
+    with _lock:
+        if _catalog is not None:
+            _catalog = _catalog._replace(loaded_at=float('-inf'))
+
+
+def get_entries(services_ids: Iterable[int]) -> List[CatalogEntry]:
+    """
+    Get catalog entries of the services, in the given order.
+
+    The catalog is reloaded if some of the services are unknown, since they may have been added
+    by another process, at most once per UNKNOWN_SERVICES_RELOAD_INTERVAL. Services that do not exist
+    anymore are skipped.
+
+    Args:
+        services_ids (Iterable[int]): IDs of the services.
+
+    Returns:
+        List[CatalogEntry]: The catalog entries.
+    """
+    services_ids = list(services_ids)
+    entries = _get_catalog_for(services_ids).entries
+
+    return [entries[service_id] for service_id in services_ids if service_id in entries]
+
+
+async def aget_entries(services_ids: Iterable[int]) -> List[CatalogEntry]:
+    """
+    Asynchronous version of get_entries(). The database is accessed only if the cached catalog
+    is missing, stale or has to be reloaded for unknown services.
+
+    Args:
+        services_ids (Iterable[int]): IDs of the services.
+
+    Returns:
+        List[CatalogEntry]: The catalog entries.
+    """
+    services_ids = list(services_ids)
+
+    catalog = _catalog
+    if _is_fresh(catalog) and _is_complete(catalog, services_ids):
+        return [catalog.entries[service_id] for service_id in services_ids if service_id in catalog.entries]
+
+    return await sync_to_async(get_entries)(services_ids)
+
+
+def _total_duration(durations: Dict[int, int], services_ids: List[int]) -> int:
+    known_durations = [durations[service_id] for service_id in services_ids if service_id in durations]
+    return sum(known_durations) if known_durations else DEFAULT_DURATION
+
+
+def get_duration(services_ids: Iterable[int]) -> int:
+    """
+    Get the total duration of the services, reloading the catalog if some of them are unknown
+    (at most once per UNKNOWN_SERVICES_RELOAD_INTERVAL).
+
+    Args:
+        services_ids (Iterable[int]): IDs of the services.
+
+    Returns:
+        int: The duration in minutes, DEFAULT_DURATION if none of the services is known.
+    """
+    services_ids = list(services_ids)
+
+    return _total_duration(_get_catalog_for(services_ids).durations, services_ids)
+
+
+async def aget_duration(services_ids: Iterable[int]) -> int:
+    """
+    Asynchronous version of get_duration().
+
+    Args:
+        services_ids (Iterable[int]): IDs of the services.
+
+    Returns:
+        int: The duration in minutes, DEFAULT_DURATION if none of the services is known.
+    """
+    services_ids = list(services_ids)
+
+    catalog = _catalog
+    if _is_fresh(catalog) and _is_complete(catalog, services_ids):
+        return _total_duration(catalog.durations, services_ids)
+
+    return await sync_to_async(get_duration)(services_ids)
@@ -1,77 +1,258 @@
-from app.models import Service, Appointment
-from django.core import serializers
+from app import availability, catalog, holds, reporting, scheduling
+from app.models import Service, Appointment, SlotHold
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError, transaction
+from django.db.models import Q
 
 import datetime
 
-from django.db.models.query import QuerySet
-from typing import Tuple, List, Dict
+from typing import Tuple, List, Dict, Optional
 
+# Number of active appointments on a page, and the largest page that can be requested
+ACTIVE_APPOINTMENTS_PAGE_SIZE = 5
+MAX_ACTIVE_APPOINTMENTS_PAGE_SIZE = 50
 
-def get_services_with_json() -> Tuple[QuerySet, str]:
+# The longest window of upcoming appointments that can be requested at once
+MAX_UPCOMING_APPOINTMENTS_WINDOW = datetime.timedelta(days=7)
 
-    services = Service.objects.all()
-    services_json = serializers.serialize('json', services)
 
-    return services, services_json
+def get_services_with_json() -> Tuple[List[Service], str]:
+
+    service_catalog = catalog.get_catalog()
+
+    return service_catalog.services, service_catalog.services_json
     
 
-def get_free_appointment_dates() -> Dict[datetime.date.isoformat, List[datetime.time.isoformat]]:
+async def aget_services_with_json() -> Tuple[List[Service], str]:
+
+    service_catalog = await catalog.aget_catalog()
+
+    return service_catalog.services, service_catalog.services_json
+
 
-    free_dates = dict()
+def get_free_appointment_dates(services_ids: Optional[List[int]] = None) -> Dict[datetime.date.isoformat, List[datetime.time.isoformat]]:
 
-    today = datetime.date.today()
-    for i in range(7):
-        date_iso = (today + datetime.timedelta(days=i)).isoformat()
-        free_times = get_free_times(date_iso)
-        if len(free_times) != 0:
-            free_dates[date_iso] = free_times
+    duration = catalog.get_duration(services_ids) if services_ids else scheduling.DEFAULT_DURATION
 
-    return free_dates
+    return availability.get_free_slots(duration=duration)
 
 
-def get_free_times(date_iso: datetime.date.isoformat) -> List[datetime.time.isoformat]:
+async def aget_free_appointment_dates(services_ids: Optional[List[int]] = None) -> Dict[datetime.date.isoformat, List[datetime.time.isoformat]]:
 
-    free_times = list()
+    duration = await catalog.aget_duration(services_ids) if services_ids else scheduling.DEFAULT_DURATION
 
-    hour_start = 11
-    hour_end = 21
-    if date_iso == datetime.date.today().isoformat():
-        hour_now = datetime.datetime.now().hour
-        if hour_start <= hour_now < hour_end - 1:
-            hour_start = hour_now + 1
-        elif hour_now > hour_end:
-            hour_start = hour_end
+    return await availability.aget_free_slots(duration=duration)
 
-    for h in range(hour_start, hour_end):
-        time_iso = datetime.time(h).isoformat()
-        if not Appointment.objects.filter(date=date_iso, time=time_iso).exists():
-            free_times.append(time_iso)
 
-    return free_times
+def get_free_times(date_iso: datetime.date.isoformat, services_ids: Optional[List[int]] = None) -> List[datetime.time.isoformat]:
+
+    date = datetime.date.fromisoformat(date_iso)
+    duration = catalog.get_duration(services_ids) if services_ids else scheduling.DEFAULT_DURATION
+
+    free_dates = availability.get_schedule(date, 1).free_slots(scheduling.duration_slots(duration), datetime.datetime.now())
+
+    return free_dates.get(date_iso, [])
 
 
 def make_appointment(user_id: int,
     services_ids: List[int],
     date_iso: datetime.date.isoformat,
-    time_iso: datetime.time.isoformat):
+    time_iso: datetime.time.isoformat,
+    charge_id: Optional[str] = None):
+
+    date = datetime.date.fromisoformat(date_iso)
+    time = datetime.time.fromisoformat(time_iso)
+    duration = catalog.get_duration(services_ids)
+
+    with transaction.atomic():
+        availability.lock_date(date)
+
+        # A payment books one appointment, a repeated call (a retry, or the update handled again) succeeds
+        # without booking another one. The date lock serializes the calls of the same payment.
+        if charge_id is not None and Appointment.objects.filter(payment_charge_id=charge_id).exists():
+            return
+
+        # The appointment is booked for the staff member of the user's hold if they are still free
+        hold = SlotHold.objects.filter(user_id=user_id, date=date, time=time).first()
+        holds.release_slot(user_id, date_iso, time_iso)
+
+        chair = availability.get_schedule(date, 1).find_chair(
+            date, scheduling.slot_index(time), scheduling.duration_slots(duration),
+            preferred_staff_id=hold.staff_id if hold is not None else None
+        )
+        if chair is None:
+            raise IntegrityError("No staff member is free for the appointment")
+
+        # The availability version is bumped by the post_save signal of the appointment
+        Appointment.objects.create(user_id=user_id, services_ids=services_ids, date=date, time=time,
+                                   staff_id=chair.staff_id, duration=duration, payment_charge_id=charge_id)
+        reporting.record_appointment(date, services_ids)
+
+
+def format_cursor(appointment: Appointment) -> str:
+
+    return f'{appointment.date.isoformat()},{appointment.time.isoformat()},{appointment.pk}'
+
 
-    appointment = Appointment.objects.create(user_id=user_id, services_ids=services_ids, date=date_iso, time=time_iso)
-    appointment.save()
+def parse_cursor(cursor: str) -> Tuple[datetime.date, datetime.time, int]:
+
+    # Raises ValueError if the cursor is malformed
+    date_iso, time_iso, pk = cursor.split(',')
+
+    return datetime.date.fromisoformat(date_iso), datetime.time.fromisoformat(time_iso), int(pk)
+
+
+def _active_appointments_query(user_id: int, after: Optional[str] = None, before: Optional[str] = None):
+
+    active_appointments = Appointment.objects.filter(user_id=user_id, date__gte=datetime.date.today().isoformat())
+
+    # Keyset pagination on (date, time, id), served by the (user_id, date, time) index
+    if after is not None:
+        date, time, pk = parse_cursor(after)
+        return active_appointments.filter(
+            Q(date__gt=date) | Q(date=date, time__gt=time) | Q(date=date, time=time, pk__gt=pk)
+        ).order_by('date', 'time', 'pk')
+
+    if before is not None:
+        date, time, pk = parse_cursor(before)
+        return active_appointments.filter(
+            Q(date__lt=date) | Q(date=date, time__lt=time) | Q(date=date, time=time, pk__lt=pk)
+        ).order_by('-date', '-time', '-pk')
+
+    return active_appointments.order_by('date', 'time', 'pk')
+
+
+def _active_appointment_dict(active_appointment: Appointment, entries: List[catalog.CatalogEntry]) -> Dict:
+
+    return {
+        'services_titles': [entry.title for entry in entries],
+        'date': active_appointment.date,
+        'time': active_appointment.time
+    }
+
+
+def _active_appointments_page(active_appointments: List[Appointment],
+    limit: int,
+    after: Optional[str],
+    before: Optional[str]) -> Tuple[List[Appointment], Optional[str], Optional[str]]:
+
+    # One extra row is fetched to know whether there is a further page
+    has_more = len(active_appointments) > limit
+    active_appointments = active_appointments[:limit]
+
+    if before is not None:
+        active_appointments.reverse()
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = after is not None, has_more
+
+    if len(active_appointments) == 0:
+        return active_appointments, None, None
+
+    return (
+        active_appointments,
+        format_cursor(active_appointments[0]) if has_prev else None,
+        format_cursor(active_appointments[-1]) if has_next else None
+    )
 
 
 def get_active_appointments(user_id: int):
 
-    active_appointments = Appointment.objects.filter(user_id=user_id, date__gte=datetime.date.today().isoformat()).order_by('date', 'time')
+    active_appointments = _active_appointments_query(user_id)
     active_appointments = [
-        {
-            'services_titles': [
-                Service.objects.get(pk=service_id).title
-                for service_id in active_appointment.services_ids
-            ],
-            'date': active_appointment.date,
-            'time': active_appointment.time
-        }
+        _active_appointment_dict(active_appointment, catalog.get_entries(active_appointment.services_ids))
         for active_appointment in active_appointments
     ]
 
     return active_appointments
+
+
+def get_active_appointments_page(user_id: int,
+    after: Optional[str] = None,
+    before: Optional[str] = None,
+    limit: int = ACTIVE_APPOINTMENTS_PAGE_SIZE) -> Dict:
+
+    active_appointments = list(_active_appointments_query(user_id, after, before)[:limit + 1])
+    active_appointments, prev_cursor, next_cursor = _active_appointments_page(active_appointments, limit, after, before)
+
+    return {
+        'active_appointments': [
+            _active_appointment_dict(active_appointment, catalog.get_entries(active_appointment.services_ids))
+            for active_appointment in active_appointments
+        ],
+        'prev': prev_cursor,
+        'next': next_cursor
+    }
+
+
+def _upcoming_appointments_query(start: datetime.datetime, end: datetime.datetime):
+
+    # Appointments starting in [start, end), served by the (date, time) index
+    return Appointment.objects.filter(
+        Q(date__gt=start.date()) | Q(date=start.date(), time__gte=start.time()),
+        Q(date__lt=end.date()) | Q(date=end.date(), time__lt=end.time()),
+        date__range=(start.date(), end.date()),
+    ).order_by('date', 'time', 'pk')
+
+
+def _upcoming_appointment_dict(appointment: Appointment, entries: List[catalog.CatalogEntry]) -> Dict:
+
+    return dict(_active_appointment_dict(appointment, entries), id=appointment.pk, user_id=appointment.user_id)
+
+
+def get_upcoming_appointments(start: datetime.datetime, end: datetime.datetime) -> List[Dict]:
+
+    return [
+        _upcoming_appointment_dict(appointment, catalog.get_entries(appointment.services_ids))
+        for appointment in _upcoming_appointments_query(start, end)
+    ]
+
+
+async def amake_appointment(user_id: int,
+    services_ids: List[int],
+    date_iso: datetime.date.isoformat,
+    time_iso: datetime.time.isoformat,
+    charge_id: Optional[str] = None):
+
+    # Transactions are not supported in the async context yet
+    await sync_to_async(make_appointment)(user_id, services_ids, date_iso, time_iso, charge_id)
+
+
+async def aget_active_appointments(user_id: int):
+
+    active_appointments = _active_appointments_query(user_id)
+    active_appointments = [
+        _active_appointment_dict(active_appointment, await catalog.aget_entries(active_appointment.services_ids))
+        async for active_appointment in active_appointments
+    ]
+
+    return active_appointments
+
+
+async def aget_active_appointments_page(user_id: int,
+    after: Optional[str] = None,
+    before: Optional[str] = None,
+    limit: int = ACTIVE_APPOINTMENTS_PAGE_SIZE) -> Dict:
+
+    active_appointments = [
+        active_appointment
+        async for active_appointment in _active_appointments_query(user_id, after, before)[:limit + 1]
+    ]
+    active_appointments, prev_cursor, next_cursor = _active_appointments_page(active_appointments, limit, after, before)
+
+    return {
+        'active_appointments': [
+            _active_appointment_dict(active_appointment, await catalog.aget_entries(active_appointment.services_ids))
+            for active_appointment in active_appointments
+        ],
+        'prev': prev_cursor,
+        'next': next_cursor
+    }
+
+
+async def aget_upcoming_appointments(start: datetime.datetime, end: datetime.datetime) -> List[Dict]:
+
+    return [
+        _upcoming_appointment_dict(appointment, await catalog.aget_entries(appointment.services_ids))
+        async for appointment in _upcoming_appointments_query(start, end)
+    ]
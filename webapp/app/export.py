@@ -0,0 +1,94 @@
+from app import catalog
+from app.models import Appointment
+
+import csv
+import datetime
+import io
+import itertools
+import json
+
+from typing import Callable, Iterable, Iterator, Optional, Tuple
+
+
+FORMATS = ('csv', 'jsonl')
+
+# Number of rows fetched from the server-side cursor at once, and written as one chunk of the export
+EXPORT_CHUNK_SIZE = 2000
+
+COLUMNS = ('id', 'user_id', 'date', 'time', 'duration', 'staff_id', 'services_ids', 'services_titles')
+
+
+def _appointments_rows(date_from: Optional[datetime.date], date_to: Optional[datetime.date]) -> Iterator[Tuple]:
+    appointments = Appointment.objects.all()
+    if date_from is not None:
+        appointments = appointments.filter(date__gte=date_from)
+    if date_to is not None:
+        appointments = appointments.filter(date__lte=date_to)
+
+    # iterator() reads the rows through a server-side cursor, EXPORT_CHUNK_SIZE rows at a time
+    return appointments.order_by('date', 'time', 'pk').values_list(
+        'pk', 'user_id', 'date', 'time', 'duration', 'staff_id', 'services_ids'
+    ).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+
+def _csv_chunks(rows: Iterable[Tuple], titles: Callable[[list], list]) -> Iterator[str]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    writer.writerow(COLUMNS)
+    while True:
+        chunk = list(itertools.islice(rows, EXPORT_CHUNK_SIZE))
+        for pk, user_id, date, time, duration, staff_id, services_ids in chunk:
+            writer.writerow((pk, user_id, date.isoformat(), time.isoformat(), duration, staff_id,
+                             ';'.join(map(str, services_ids)), ';'.join(titles(services_ids))))
+
+        yield buffer.getvalue()
+        if len(chunk) < EXPORT_CHUNK_SIZE:
+            return
+
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def _jsonl_chunks(rows: Iterable[Tuple], titles: Callable[[list], list]) -> Iterator[str]:
+    while True:
+        chunk = list(itertools.islice(rows, EXPORT_CHUNK_SIZE))
+        if not chunk:
+            return
+
+        yield ''.join(
+            json.dumps(dict(zip(COLUMNS, (pk, user_id, date.isoformat(), time.isoformat(), duration, staff_id,
+                                          services_ids, titles(services_ids))))) + '\n'
+            for pk, user_id, date, time, duration, staff_id, services_ids in chunk
+        )
+
+
+def export_appointments(export_format: str,
+                        date_from: Optional[datetime.date] = None,
+                        date_to: Optional[datetime.date] = None) -> Iterator[str]:
+    """
+    Export the appointments ordered by date and time, with the titles of their services, chunk by chunk.
+    At most EXPORT_CHUNK_SIZE appointments are held in memory, whatever the number of exported appointments.
+
+    Args:
+        export_format (str): 'csv' or 'jsonl'.
+        date_from (datetime.date, optional): The first exported day. Default is no lower bound.
+        date_to (datetime.date, optional): The last exported day. Default is no upper bound.
+
+    Returns:
+        Iterator[str]: Chunks of the export.
+    """
+    if export_format not in FORMATS:
+        raise ValueError(f"Unknown export format: {export_format}")
+
+    # Titles of the services that do not exist anymore are left empty
+    entries = catalog.get_catalog().entries
+
+    def titles(services_ids: list) -> list:
+        return [entries[service_id].title if service_id in entries else '' for service_id in services_ids]
+
+    rows = _appointments_rows(date_from, date_to)
+    chunks = _csv_chunks if export_format == 'csv' else _jsonl_chunks
+
+    return chunks(rows, titles)
+
@@ -0,0 +1,143 @@
+from app import availability, scheduling
+from app.models import SlotHold
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.db.models import Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+import datetime
+
+
+# How long a slot is held for the user after the invoice link is created
+HOLD_TTL = datetime.timedelta(minutes=15)
+
+# How long a slot is held once the payment has been started (after the pre-checkout check)
+PAYMENT_TTL = datetime.timedelta(minutes=5)
+
+
+def release_expired_holds() -> int:
+    """
+    Release all expired holds with a single bulk delete.
+
+    Returns:
+        int: The number of released holds.
+    """
+    deleted, _ = SlotHold.objects.filter(expires_at__lte=timezone.now()).delete()
+    return deleted
+
+
+def hold_slot(user_id: int,
+              date_iso: datetime.date.isoformat,
+              time_iso: datetime.time.isoformat,
+              duration: int = scheduling.DEFAULT_DURATION) -> bool:
+    """
+    Hold the slot for the user for HOLD_TTL, on the first staff member who is free for the whole duration.
+
+    The other holds of the user are released, so that a user holds at most one slot at a time and cannot
+    block the schedule by creating invoice links over and over.
+
+    Args:
+        user_id (int): The Telegram user ID.
+        date_iso (str): The date of the slot in ISO format.
+        time_iso (str): The time of the slot in ISO format.
+        duration (int, optional): The duration of the appointment in minutes. Default is scheduling.DEFAULT_DURATION.
+
+    Returns:
+        bool: Whether the slot is held for the user, False if no staff member is free.
+    """
+    release_expired_holds()
+
+    date = datetime.date.fromisoformat(date_iso)
+    time = datetime.time.fromisoformat(time_iso)
+
+    with transaction.atomic():
+        availability.lock_date(date)
+        SlotHold.objects.filter(user_id=user_id).delete()
+
+        chair = availability.get_schedule(date, 1).find_chair(
+            date, scheduling.slot_index(time), scheduling.duration_slots(duration)
+        )
+        if chair is None:
+            return False
+
+        SlotHold.objects.create(user_id=user_id, date=date, time=time, staff_id=chair.staff_id, duration=duration,
+                                expires_at=timezone.now() + HOLD_TTL)
+        # The slot is no longer free
+        transaction.on_commit(availability.bump_version)
+
+    return True
+
+
+async def ahold_slot(user_id: int,
+                     date_iso: datetime.date.isoformat,
+                     time_iso: datetime.time.isoformat,
+                     duration: int = scheduling.DEFAULT_DURATION) -> bool:
+    """
+    Asynchronous version of hold_slot().
+
+    Args:
+        user_id (int): The Telegram user ID.
+        date_iso (str): The date of the slot in ISO format.
+        time_iso (str): The time of the slot in ISO format.
+        duration (int, optional): The duration of the appointment in minutes. Default is scheduling.DEFAULT_DURATION.
+
+    Returns:
+        bool: Whether the slot is held for the user, False if no staff member is free.
+    """
+    # Transactions are not supported in the async context yet
+    return await sync_to_async(hold_slot)(user_id, date_iso, time_iso, duration)
+
+
+def check_slot_hold(user_id: int, date_iso: datetime.date.isoformat, time_iso: datetime.time.isoformat) -> bool:
+    """
+    Check that the user holds the slot, and extend the hold for PAYMENT_TTL so that it outlives the payment.
+
+    It is a single update. The user holds the slot on at most one staff member (hold_slot() replaces
+    the previous hold of the user), while the holds are unique per (staff, date, time), and per (date, time)
+    for a salon without staff.
+
+    Args:
+        user_id (int): The Telegram user ID.
+        date_iso (str): The date of the slot in ISO format.
+        time_iso (str): The time of the slot in ISO format.
+
+    Returns:
+        bool: Whether the user holds the slot.
+    """
+    now = timezone.now()
+
+    return SlotHold.objects.filter(
+        user_id=user_id, date=date_iso, time=time_iso, expires_at__gt=now
+    ).update(expires_at=Greatest('expires_at', Value(now + PAYMENT_TTL))) == 1
+
+
+async def acheck_slot_hold(user_id: int, date_iso: datetime.date.isoformat, time_iso: datetime.time.isoformat) -> bool:
+    """
+    Asynchronous version of check_slot_hold().
+
+    Args:
+        user_id (int): The Telegram user ID.
+        date_iso (str): The date of the slot in ISO format.
+        time_iso (str): The time of the slot in ISO format.
+
+    Returns:
+        bool: Whether the user holds the slot.
+    """
+    now = timezone.now()
+
+    return await SlotHold.objects.filter(
+        user_id=user_id, date=date_iso, time=time_iso, expires_at__gt=now
+    ).aupdate(expires_at=Greatest('expires_at', Value(now + PAYMENT_TTL))) == 1
+
+
+def release_slot(user_id: int, date_iso: datetime.date.isoformat, time_iso: datetime.time.isoformat):
+    """
+    Release the hold of the slot by the user (e.g. once it is booked).
+
+    Args:
+        user_id (int): The Telegram user ID.
+        date_iso (str): The date of the slot in ISO format.
+        time_iso (str): The time of the slot in ISO format.
+    """
+    SlotHold.objects.filter(user_id=user_id, date=date_iso, time=time_iso).delete()
@@ -0,0 +1,101 @@
+import datetime
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from app import availability
+from app.models import Appointment
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed appointments and compare query plans and latency of the appointment lookups "
+        "without and with the Appointment indexes. Everything is rolled back at the end."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1_000_000, help="Number of appointments to seed.")
+        parser.add_argument('--users', type=int, default=50_000, help="Number of distinct users.")
+        parser.add_argument('--repeat', type=int, default=200, help="Number of timed runs of every query.")
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options['rows'], options['users'], options['repeat'])
+                raise Rollback()
+        except Rollback:
+            self.stdout.write("Rolled back the seeded appointments")
+
+    def run(self, rows: int, users: int, repeat: int):
+        # Seed the slots before any real appointment: one per minute, starting from 2000-01-01
+        first_date = datetime.date(2000, 1, 1)
+        last_date = first_date + datetime.timedelta(days=(rows - 1) // 1440)
+
+        with connection.schema_editor() as schema_editor:
+            for index in Appointment._meta.indexes:
+                schema_editor.remove_index(Appointment, index)
+            for constraint in Appointment._meta.constraints:
+                schema_editor.remove_constraint(Appointment, constraint)
+
+        self.stdout.write(f"Seeding {rows} appointments...")
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {Appointment._meta.db_table} (user_id, services_ids, date, time, duration)
+                SELECT (random() * %s)::int, ARRAY[1, 2], %s::date + i / 1440, make_time(i %% 1440 / 60, i %% 60, 0), 60
+                FROM generate_series(0, %s - 1) AS i
+                """,
+                [users, first_date, rows]
+            )
+            cursor.execute(f"ANALYZE {Appointment._meta.db_table}")
+
+        self.benchmark("Without indexes", first_date, last_date, users, repeat)
+
+        self.stdout.write("Creating indexes...")
+        with connection.schema_editor() as schema_editor:
+            for index in Appointment._meta.indexes:
+                schema_editor.add_index(Appointment, index)
+            for constraint in Appointment._meta.constraints:
+                schema_editor.add_constraint(Appointment, constraint)
+        with connection.cursor() as cursor:
+            cursor.execute(f"ANALYZE {Appointment._meta.db_table}")
+
+        self.benchmark("With indexes", first_date, last_date, users, repeat)
+
+    def benchmark(self, title: str, first_date: datetime.date, last_date: datetime.date, users: int, repeat: int):
+        days = (last_date - first_date).days
+
+        def free_slots_query():
+            # The lookup of availability.get_free_slots()
+            date_from = first_date + datetime.timedelta(days=random.randint(0, days))
+            date_to = date_from + datetime.timedelta(days=availability.BOOKING_DAYS - 1)
+            return Appointment.objects.filter(date__range=(date_from, date_to)).values_list('date', 'time')
+
+        def active_appointments_query():
+            # The lookup of data.get_active_appointments()
+            return Appointment.objects.filter(
+                user_id=random.randint(0, users), date__gte=last_date - datetime.timedelta(days=7)
+            ).order_by('date', 'time')
+
+        self.stdout.write(self.style.MIGRATE_HEADING(title))
+        for name, query in (('free slots', free_slots_query), ('active appointments', active_appointments_query)):
+            self.stdout.write(f"\n{name}:\n{query().explain(analyze=True)}")
+
+            latencies = []
+            for _ in range(repeat):
+                queryset = query()
+                start = time.perf_counter()
+                list(queryset)
+                latencies.append(time.perf_counter() - start)
+
+            latencies.sort()
+            self.stdout.write(
+                f"{name}: p50 {latencies[len(latencies) // 2] * 1000:.2f} ms, "
+                f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.2f} ms ({repeat} runs)\n"
+            )
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from app import broadcast
+from app.models import Broadcast
+
+
+class Command(BaseCommand):
+    help = (
+        "Send a message to every user who has booked an appointment. The progress is saved under the name "
+        "of the broadcast: run the command again with the same name to resume an interrupted broadcast."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', help="Name of the broadcast.")
+        parser.add_argument('--text', help="Message text, required for a new broadcast.")
+        parser.add_argument('--concurrency', type=int, default=broadcast.BROADCAST_CONCURRENCY,
+                            help="Number of messages sent at once.")
+        parser.add_argument('--rate', type=float, default=broadcast.BROADCAST_RATE, help="Messages per second, on top of the SEND_GLOBAL_RATE of the bot.")
+
+    def handle(self, *args, **options):
+        existing = Broadcast.objects.filter(name=options['name']).first()
+
+        if existing is None:
+            if not options['text']:
+                raise CommandError("--text is required for a new broadcast")
+            existing = Broadcast.objects.create(name=options['name'], text=options['text'])
+        elif options['text'] and options['text'] != existing.text:
+            raise CommandError(f"Broadcast '{existing.name}' was started with another text")
+        elif existing.finished_at is not None:
+            self.stdout.write(f"Broadcast '{existing.name}' has already finished: "
+                              f"{existing.sent} sent, {existing.failed} failed")
+            return
+        elif existing.last_user_id is not None:
+            self.stdout.write(f"Resuming broadcast '{existing.name}' after user {existing.last_user_id}")
+
+        def progress(state: Broadcast, throughput: float):
+            self.stdout.write(f"{state.sent} sent, {state.failed} failed, {throughput:.1f} messages/s, "
+                              f"last user {state.last_user_id}")
+
+        finished = broadcast.run_broadcast(existing, options['concurrency'], options['rate'], progress)
+        self.stdout.write(self.style.SUCCESS(
+            f"Broadcast '{finished.name}' finished: {finished.sent} sent, {finished.failed} failed"
+        ))
@@ -0,0 +1,27 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+
+from app import export
+
+
+class Command(BaseCommand):
+    help = "Export the appointments with the titles of their services as CSV or JSONL, in constant memory."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=export.FORMATS, default='csv', help="Export format.")
+        parser.add_argument('--date-from', type=datetime.date.fromisoformat, help="The first exported day.")
+        parser.add_argument('--date-to', type=datetime.date.fromisoformat, help="The last exported day.")
+        parser.add_argument('--output', help="Output file. Default is the standard output.")
+
+    def handle(self, *args, **options):
+        chunks = export.export_appointments(options['format'], options['date_from'], options['date_to'])
+
+        if options['output'] is None:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
+            return
+
+        with open(options['output'], 'w', newline='', encoding='utf-8') as output:
+            for chunk in chunks:
+                output.write(chunk)
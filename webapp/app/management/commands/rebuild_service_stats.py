@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from app import reporting
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the daily bookings and revenue of the services from the appointments, "
+        "e.g. after appointments were changed in the admin."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--service', type=int, action='append', dest='services_ids',
+                            help="Rebuild only the statistics of this service (can be repeated).")
+
+    def handle(self, *args, **options):
+        rows = reporting.rebuild(options['services_ids'])
+        self.stdout.write(f"Rebuilt {rows} daily rows")
@@ -0,0 +1,96 @@
+from app import queries, telegram
+from django.utils.decorators import sync_and_async_middleware
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily
+from prometheus_client.multiprocess import MultiProcessCollector
+
+import asyncio
+import os
+import time
+
+# Latency buckets of the views, in seconds, and buckets of the number of database queries of a request
+VIEW_DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+VIEW_QUERIES_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+view_duration = Histogram(
+    'webapp_view_duration_seconds', "Time spent in the views", ['view'], buckets=VIEW_DURATION_BUCKETS
+)
+view_queries = Histogram(
+    'webapp_view_db_queries', "Database queries made by a request", ['view'], buckets=VIEW_QUERIES_BUCKETS
+)
+view_responses = Counter('webapp_view_responses', "Responses of the views", ['view', 'status'])
+
+
+class InvoiceLinkCollector:
+    # Hits and misses of the invoice link cache (see telegram.create_invoice_link)
+
+    def collect(self):
+        lookups = CounterMetricFamily('webapp_invoice_link_cache_lookups', "Invoice link cache lookups",
+                                      labels=['result'])
+        lookups.add_metric(['hit'], telegram.invoice_link_stats['hits'])
+        lookups.add_metric(['miss'], telegram.invoice_link_stats['misses'])
+        yield lookups
+
+
+invoice_link_collector = InvoiceLinkCollector()
+REGISTRY.register(invoice_link_collector)
+
+
+def render_metrics() -> bytes:
+    """
+    Render the metrics in the Prometheus text format.
+
+    If PROMETHEUS_MULTIPROC_DIR is set (before the workers start), the view metrics of all the worker
+    processes are aggregated; the invoice link cache stats are those of the process serving the metrics.
+
+    Returns:
+        bytes: The metrics.
+    """
+    if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        return generate_latest(REGISTRY)
+
+    registry = CollectorRegistry()
+    MultiProcessCollector(registry)
+    registry.register(invoice_link_collector)
+    return generate_latest(registry)
+
+
+def _observe(request, status: int, query_log: queries.QueryLog, started_at: float):
+    # Views are labelled with their URL names, unmatched URLs (404) share a single label
+    resolver_match = getattr(request, 'resolver_match', None)
+    view = (resolver_match.url_name or resolver_match.view_name) if resolver_match is not None else 'unmatched'
+
+    view_duration.labels(view).observe(time.perf_counter() - started_at)
+    view_queries.labels(view).observe(query_log.count)
+    view_responses.labels(view, f'{status // 100}xx').inc()
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    """
+    Record the latency, the number of database queries and the response status of every view.
+    """
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            started_at = time.perf_counter()
+            status = 500
+            with queries.capture() as query_log:
+                try:
+                    response = await get_response(request)
+                    status = response.status_code
+                    return response
+                finally:
+                    _observe(request, status, query_log, started_at)
+    else:
+        def middleware(request):
+            started_at = time.perf_counter()
+            status = 500
+            with queries.capture() as query_log:
+                try:
+                    response = get_response(request)
+                    status = response.status_code
+                    return response
+                finally:
+                    _observe(request, status, query_log, started_at)
+
+    return middleware
@@ -0,0 +1,47 @@
+# Generated by Django 4.1.12 on 2026-10-18 06:45
+
+from django.db import migrations, models
+
+
+def check_double_bookings(apps, schema_editor):
+    # The unique constraint cannot be added while a slot is booked twice. These appointments have been paid,
+    # so they are reported to be resolved by hand (moved or refunded, then deleted) instead of being deleted here
+    Appointment = apps.get_model('app', 'Appointment')
+
+    double_booked_slots = Appointment.objects.values('date', 'time').annotate(
+        count=models.Count('id')
+    ).filter(count__gt=1).order_by('date', 'time')
+
+    if double_booked_slots:
+        lines = [
+            f"{slot['date']} {slot['time']}: " + ", ".join(
+                f"appointment {pk} (user {user_id})"
+                for pk, user_id in Appointment.objects.filter(
+                    date=slot['date'], time=slot['time']
+                ).order_by('pk').values_list('pk', 'user_id')
+            )
+            for slot in double_booked_slots
+        ]
+        raise RuntimeError(
+            "These slots are booked more than once, keep one appointment per slot and run the migration again:\n"
+            + "\n".join(lines)
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(check_double_bookings, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['user_id', 'date', 'time'], name='appointment_user_date_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='appointment',
+            constraint=models.UniqueConstraint(fields=('date', 'time'), name='appointment_unique_slot'),
+        ),
+    ]
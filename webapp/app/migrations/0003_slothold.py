@@ -0,0 +1,31 @@
+# Generated by Django 4.1.12 on 2026-10-18 06:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0002_appointment_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SlotHold',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.IntegerField()),
+                ('date', models.DateField()),
+                ('time', models.TimeField()),
+                ('expires_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='slothold',
+            index=models.Index(fields=['expires_at'], name='slothold_expires_at_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='slothold',
+            constraint=models.UniqueConstraint(fields=('date', 'time'), name='slothold_unique_slot'),
+        ),
+    ]
@@ -0,0 +1,78 @@
+# Generated by Django 4.1.12 on 2026-10-18 07:02
+
+import datetime
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0003_slothold'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Staff',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.TextField()),
+                ('opening_time', models.TimeField(default=datetime.time(11, 0))),
+                ('closing_time', models.TimeField(default=datetime.time(21, 0))),
+                ('is_active', models.BooleanField(default=True)),
+            ],
+        ),
+        migrations.RemoveConstraint(
+            model_name='appointment',
+            name='appointment_unique_slot',
+        ),
+        migrations.RemoveConstraint(
+            model_name='slothold',
+            name='slothold_unique_slot',
+        ),
+        migrations.AddField(
+            model_name='appointment',
+            name='duration',
+            field=models.PositiveIntegerField(default=60),
+        ),
+        migrations.AddField(
+            model_name='service',
+            name='duration',
+            field=models.PositiveIntegerField(default=60),
+        ),
+        migrations.AddField(
+            model_name='slothold',
+            name='duration',
+            field=models.PositiveIntegerField(default=60),
+        ),
+        migrations.AddField(
+            model_name='appointment',
+            name='staff',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='app.staff'),
+        ),
+        migrations.AddField(
+            model_name='slothold',
+            name='staff',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='app.staff'),
+        ),
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['date', 'time'], name='appointment_date_time_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='appointment',
+            constraint=models.UniqueConstraint(fields=('staff', 'date', 'time'), name='appointment_unique_staff_slot'),
+        ),
+        migrations.AddConstraint(
+            model_name='appointment',
+            constraint=models.UniqueConstraint(condition=models.Q(('staff__isnull', True)), fields=('date', 'time'), name='appointment_unique_slot'),
+        ),
+        migrations.AddConstraint(
+            model_name='slothold',
+            constraint=models.UniqueConstraint(fields=('staff', 'date', 'time'), name='slothold_unique_staff_slot'),
+        ),
+        migrations.AddConstraint(
+            model_name='slothold',
+            constraint=models.UniqueConstraint(condition=models.Q(('staff__isnull', True)), fields=('date', 'time'), name='slothold_unique_slot'),
+        ),
+    ]
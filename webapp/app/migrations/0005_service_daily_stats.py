@@ -0,0 +1,48 @@
+# Generated by Django 4.1.12 on 2026-10-18 07:07
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0004_staff_and_durations'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ServiceDailyStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('service_id', models.IntegerField()),
+                ('date', models.DateField()),
+                ('bookings', models.PositiveIntegerField(default=0)),
+                ('revenue', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='appointment',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['services_ids'], name='appointment_services_ids_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='servicedailystats',
+            index=models.Index(fields=['date'], name='servicedailystats_date_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='servicedailystats',
+            constraint=models.UniqueConstraint(fields=('service_id', 'date'), name='servicedailystats_unique_day'),
+        ),
+        # Backfill the statistics of the existing appointments
+        migrations.RunSQL(
+            """
+            INSERT INTO app_servicedailystats (service_id, date, bookings, revenue)
+            SELECT s.id, a.date, count(*), sum(s.price)
+            FROM app_appointment a
+            CROSS JOIN LATERAL unnest(a.services_ids) AS booked(service_id)
+            JOIN app_service s ON s.id = booked.service_id
+            GROUP BY s.id, a.date
+            """,
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.1.12 on 2026-10-18 07:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0006_broadcast'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appointment',
+            name='payment_charge_id',
+            field=models.TextField(blank=True, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 4.1.12 on 2026-10-18 08:05
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0007_appointment_payment_charge_id'),
+    ]
+
+    operations = [
+        # The availability version shared by all the processes (see availability.get_version), called once
+        # so that the first increment changes its last value
+        migrations.RunSQL(
+            [
+                "CREATE SEQUENCE app_availability_version",
+                "SELECT nextval('app_availability_version')",
+            ],
+            "DROP SEQUENCE app_availability_version",
+        ),
+    ]
@@ -1,11 +1,24 @@
 from django.db import models
 from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
+
+import datetime
 
 
 # Create your models here.
 class Service(models.Model):
     title = models.TextField()
     price = models.IntegerField()
+    # Duration of the service in minutes
+    duration = models.PositiveIntegerField(default=60)
+
+
+class Staff(models.Model):
+    name = models.TextField()
+    # Working hours, the same every day
+    opening_time = models.TimeField(default=datetime.time(11))
+    closing_time = models.TimeField(default=datetime.time(21))
+    is_active = models.BooleanField(default=True)
 
 
 class Appointment(models.Model):
@@ -13,3 +26,79 @@ class Appointment(models.Model):
     services_ids = ArrayField(models.IntegerField())
     date = models.DateField()
     time = models.TimeField()
+    # Appointments booked before the staff was introduced have no staff member and block the time for everyone
+    staff = models.ForeignKey(Staff, null=True, blank=True, on_delete=models.PROTECT)
+    # Total duration of the services in minutes
+    duration = models.PositiveIntegerField(default=60)
+    # Telegram payment charge ID, so that a payment books a single appointment
+    payment_charge_id = models.TextField(null=True, blank=True, unique=True)
+
+    class Meta:
+        indexes = [
+            # Active appointments of a user
+            models.Index(fields=['user_id', 'date', 'time'], name='appointment_user_date_idx'),
+            # Availability lookups over the booking horizon
+            models.Index(fields=['date', 'time'], name='appointment_date_time_idx'),
+            # Appointments with some of the services (services_ids && ARRAY[...])
+            GinIndex(fields=['services_ids'], name='appointment_services_ids_idx'),
+        ]
+        constraints = [
+            # A staff member can start only one appointment at a time, overlaps are checked when booking
+            models.UniqueConstraint(fields=['staff', 'date', 'time'], name='appointment_unique_staff_slot'),
+            # Only one appointment can be booked for a slot of a salon without staff
+            models.UniqueConstraint(fields=['date', 'time'], condition=models.Q(staff__isnull=True),
+                                    name='appointment_unique_slot'),
+        ]
+
+
+class ServiceDailyStats(models.Model):
+    # Daily bookings and revenue of a service, maintained by make_appointment() (see reporting.py)
+    service_id = models.IntegerField()
+    date = models.DateField()
+    bookings = models.PositiveIntegerField(default=0)
+    # Revenue in the units of Service.price
+    revenue = models.BigIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            # Reports over a range of days
+            models.Index(fields=['date'], name='servicedailystats_date_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['service_id', 'date'], name='servicedailystats_unique_day'),
+        ]
+
+
+class Broadcast(models.Model):
+    # A message sent to every customer, resumable after a crash (see broadcast.py)
+    name = models.TextField(unique=True)
+    text = models.TextField()
+    # All users up to this ID have been handled, the broadcast resumes after it
+    last_user_id = models.BigIntegerField(null=True, blank=True)
+    sent = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+
+class SlotHold(models.Model):
+    user_id = models.IntegerField()
+    date = models.DateField()
+    time = models.TimeField()
+    expires_at = models.DateTimeField()
+    staff = models.ForeignKey(Staff, null=True, blank=True, on_delete=models.CASCADE)
+    # Total duration of the held services in minutes
+    duration = models.PositiveIntegerField(default=60)
+
+    class Meta:
+        indexes = [
+            # Bulk release of expired holds
+            models.Index(fields=['expires_at'], name='slothold_expires_at_idx'),
+        ]
+        constraints = [
+            # Only one user can hold the slot of a staff member
+            models.UniqueConstraint(fields=['staff', 'date', 'time'], name='slothold_unique_staff_slot'),
+            # Only one user can hold a slot of a salon without staff
+            models.UniqueConstraint(fields=['date', 'time'], condition=models.Q(staff__isnull=True),
+                                    name='slothold_unique_slot'),
+        ]
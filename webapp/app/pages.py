@@ -0,0 +1,96 @@
+from app import availability, catalog, scheduling
+from asgiref.sync import sync_to_async
+from django.template.loader import render_to_string
+
+import gzip
+import hashlib
+import threading
+
+from typing import NamedTuple, Optional
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class RenderedPage(NamedTuple):
+    # Version of the service catalog and ETag of the free slots map the page was rendered from
+    version: int
+    free_slots_etag: str
+    etag: str
+    content: bytes
+    content_gzip: bytes
+    content_brotli: Optional[bytes]
+
+
+_make_order_page: Optional[RenderedPage] = None
+_lock = threading.Lock()
+
+
+def _render_make_order_page(service_catalog: catalog.ServiceCatalog,
+                            free_slots_map: availability.FreeSlotsMap) -> RenderedPage:
+    content = render_to_string('make_order.html', context={
+        'services': service_catalog.services,
+        'services_json': service_catalog.services_json,
+        'free_slots_json': free_slots_map.content.decode('utf-8'),
+        'free_slots_duration': scheduling.DEFAULT_DURATION,
+    }).encode('utf-8')
+
+    return RenderedPage(
+        version=service_catalog.version,
+        free_slots_etag=free_slots_map.etag,
+        etag=hashlib.sha256(content).hexdigest()[:32],
+        content=content,
+        content_gzip=gzip.compress(content, compresslevel=9, mtime=0),
+        content_brotli=brotli.compress(content) if brotli is not None else None,
+    )
+
+
+def _is_current(page: Optional[RenderedPage],
+                service_catalog: catalog.ServiceCatalog,
+                free_slots_map: availability.FreeSlotsMap) -> bool:
+    return page is not None and page.version == service_catalog.version and page.free_slots_etag == free_slots_map.etag
+
+
+def _get_make_order_page(service_catalog: catalog.ServiceCatalog,
+                         free_slots_map: availability.FreeSlotsMap) -> RenderedPage:
+    global _make_order_page
+
+    page = _make_order_page
+    if not _is_current(page, service_catalog, free_slots_map):
+        with _lock:
+            page = _make_order_page = _render_make_order_page(service_catalog, free_slots_map)
+
+    return page
+
+
+def get_make_order_page() -> RenderedPage:
+    """
+    Get the rendered "make_order" page together with its precompressed variants.
+
+    The page embeds the service catalog and a snapshot of the free slots for the default duration,
+    so that the Mini App can show the dates without another request. It is rendered once per version
+    of the catalog and of the free slots map (i.e. again after every booking).
+
+    Returns:
+        RenderedPage: The rendered page.
+    """
+    return _get_make_order_page(catalog.get_catalog(), availability.get_free_slots_map())
+
+
+async def aget_make_order_page() -> RenderedPage:
+    """
+    Asynchronous version of get_make_order_page(). The page is rendered in a thread only if it is outdated.
+
+    Returns:
+        RenderedPage: The rendered page.
+    """
+    service_catalog = await catalog.aget_catalog()
+    free_slots_map = await availability.aget_free_slots_map()
+
+    page = _make_order_page
+    if _is_current(page, service_catalog, free_slots_map):
+        return page
+
+    return await sync_to_async(_get_make_order_page)(service_catalog, free_slots_map)
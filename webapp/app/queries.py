@@ -0,0 +1,148 @@
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.utils.decorators import sync_and_async_middleware
+
+import asyncio
+import collections
+import contextlib
+import contextvars
+import logging
+
+from typing import Callable, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# How many times the same SQL can be run by a request before it is reported as a possible N+1 pattern
+REPEATED_QUERY_THRESHOLD = 3
+
+QUERY_COUNT_HEADER = 'X-Query-Count'
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryLog:
+    """
+    Database queries made while the log is captured (see capture()), including the queries of nested captures.
+    """
+
+    def __init__(self, parent: Optional['QueryLog'] = None, record_statements: bool = False):
+        self.parent = parent
+        self.count = 0
+        # Number of runs of every SQL statement (with placeholders, so the same statement with other parameters
+        # counts as a repetition), only if the statements are recorded
+        self.statements: Optional[collections.Counter] = collections.Counter() if record_statements else None
+
+    def add(self, sql: str):
+        log = self
+        while log is not None:
+            log.count += 1
+            if log.statements is not None:
+                log.statements[sql] += 1
+            log = log.parent
+
+    def repeated_statements(self, threshold: int = REPEATED_QUERY_THRESHOLD) -> List[Tuple[str, int]]:
+        """
+        Get the statements run at least 'threshold' times, the usual sign of an N+1 query pattern.
+
+        Args:
+            threshold (int, optional): The number of runs. Default is REPEATED_QUERY_THRESHOLD.
+
+        Returns:
+            List[Tuple[str, int]]: The statements and their number of runs, most repeated first.
+        """
+        if self.statements is None:
+            return []
+        return [(sql, count) for sql, count in self.statements.most_common() if count >= threshold]
+
+
+# The innermost capture of the current request or test, shared with the threads of sync_to_async()
+# (which copy the context)
+_current: contextvars.ContextVar[Optional[QueryLog]] = contextvars.ContextVar('query_log', default=None)
+
+
+def execute_wrapper(execute, sql, params, many, context):
+    """
+    Database execute wrapper adding the queries to the current logs (see signals.install_query_counter).
+    """
+    log = _current.get()
+    if log is not None:
+        log.add(sql)
+    return execute(sql, params, many, context)
+
+
+@contextlib.contextmanager
+def capture(record_statements: bool = False) -> Iterator[QueryLog]:
+    """
+    Count the database queries made in the enclosed block, in the current context and the threads it starts
+    with sync_to_async().
+
+    Args:
+        record_statements (bool, optional): Also count the runs of every SQL statement. Default is False.
+
+    Returns:
+        Iterator[QueryLog]: The log of the queries.
+    """
+    log = QueryLog(_current.get(), record_statements)
+    token = _current.set(log)
+    try:
+        yield log
+    finally:
+        _current.reset(token)
+
+
+def query_budget(queries: int) -> Callable:
+    """
+    Decorator declaring the maximum number of database queries of a view, when its caches are cold.
+    The budgets are checked by the tests, and by query_inspector_middleware during development.
+
+    Args:
+        queries (int): The budget.
+    """
+    def decorator(view):
+        view.query_budget = queries
+        return view
+
+    return decorator
+
+
+def _inspect(request, response, log: QueryLog):
+    resolver_match = getattr(request, 'resolver_match', None)
+    budget = getattr(resolver_match.func, 'query_budget', None) if resolver_match is not None else None
+
+    if response is not None:
+        response[QUERY_COUNT_HEADER] = str(log.count)
+    if budget is not None and log.count > budget:
+        if getattr(settings, 'QUERY_BUDGET_STRICT', False):
+            raise QueryBudgetExceeded(f"{request.path} made {log.count} queries, over its budget of {budget}")
+        logger.warning("%s made %s queries, over its budget of %s", request.path, log.count, budget)
+    for sql, count in log.repeated_statements():
+        logger.warning("%s ran the same query %s times (possible N+1): %s", request.path, count, sql)
+
+
+@sync_and_async_middleware
+def query_inspector_middleware(get_response):
+    """
+    Development middleware that logs the requests going over the query budget of their view and the queries
+    repeated by a request, and returns the number of queries in the X-Query-Count header.
+    Enabled by the QUERY_INSPECTOR setting. With the QUERY_BUDGET_STRICT setting (enabled by the tests),
+    the requests over budget raise QueryBudgetExceeded instead.
+    """
+    if not getattr(settings, 'QUERY_INSPECTOR', False):
+        raise MiddlewareNotUsed()
+
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            with capture(record_statements=True) as log:
+                response = await get_response(request)
+            _inspect(request, response, log)
+            return response
+    else:
+        def middleware(request):
+            with capture(record_statements=True) as log:
+                response = get_response(request)
+            _inspect(request, response, log)
+            return response
+
+    return middleware
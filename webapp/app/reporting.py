@@ -0,0 +1,171 @@
+from app import catalog
+from app.models import Appointment, Service, ServiceDailyStats
+from asgiref.sync import sync_to_async
+from django.db import connection, transaction
+
+import collections
+import datetime
+
+from typing import Any, Dict, Iterable, List, Optional
+
+
+# The longest range of days of a report
+MAX_REPORT_DAYS = 366
+
+_STATS_TABLE = ServiceDailyStats._meta.db_table
+
+
+def _service_totals(services_ids: Iterable[int]) -> Dict[int, List[int]]:
+    # [bookings, revenue] of every known service of an appointment, a service can be booked twice
+    entries = catalog.get_catalog().entries
+    totals = {}
+    for service_id, count in collections.Counter(services_ids).items():
+        if service_id in entries:
+            totals[service_id] = [count, count * entries[service_id].price]
+    return totals
+
+
+def record_appointment(date: datetime.date, services_ids: Iterable[int]):
+    """
+    Add a booked appointment to the daily statistics of its services, with a single upsert.
+    Services that do not exist anymore are not counted.
+
+    Args:
+        date (datetime.date): The date of the appointment.
+        services_ids (Iterable[int]): IDs of the services of the appointment.
+    """
+    totals = _service_totals(services_ids)
+    if not totals:
+        return
+
+    values = ', '.join(['(%s, %s, %s, %s)'] * len(totals))
+    params = [param for service_id, (bookings, revenue) in totals.items()
+              for param in (service_id, date, bookings, revenue)]
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            INSERT INTO {_STATS_TABLE} (service_id, date, bookings, revenue) VALUES {values}
+            ON CONFLICT (service_id, date) DO UPDATE
+            SET bookings = {_STATS_TABLE}.bookings + EXCLUDED.bookings,
+                revenue = {_STATS_TABLE}.revenue + EXCLUDED.revenue
+            """,
+            params
+        )
+
+
+def record_cancellation(date: datetime.date, services_ids: Iterable[int]):
+    """
+    Remove a cancelled appointment from the daily statistics of its services.
+
+    The revenue is decreased by the current prices of the services, which may differ from the prices
+    the appointment was booked for; rebuild() recomputes the statistics from the appointments.
+
+    Args:
+        date (datetime.date): The date of the appointment.
+        services_ids (Iterable[int]): IDs of the services of the appointment.
+    """
+    with connection.cursor() as cursor:
+        for service_id, (bookings, revenue) in _service_totals(services_ids).items():
+            cursor.execute(
+                f"""
+                UPDATE {_STATS_TABLE}
+                SET bookings = GREATEST(bookings - %s, 0), revenue = GREATEST(revenue - %s, 0)
+                WHERE service_id = %s AND date = %s
+                """,
+                [bookings, revenue, service_id, date]
+            )
+
+
+def rebuild(services_ids: Optional[List[int]] = None) -> int:
+    """
+    Recompute the daily statistics from the appointments, with the current prices of the services.
+
+    Args:
+        services_ids (List[int], optional): Recompute only the statistics of these services. The appointments
+            with any of them are found with the GIN index on Appointment.services_ids. Default is all services.
+
+    Returns:
+        int: The number of rebuilt daily rows.
+    """
+    appointments = Appointment._meta.db_table
+    services = Service._meta.db_table
+
+    where = "WHERE a.services_ids && %s::integer[] AND s.id = ANY(%s)" if services_ids else ""
+    params = [services_ids, services_ids] if services_ids else []
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        if services_ids:
+            cursor.execute(f"DELETE FROM {_STATS_TABLE} WHERE service_id = ANY(%s)", [services_ids])
+        else:
+            cursor.execute(f"DELETE FROM {_STATS_TABLE}")
+
+        cursor.execute(
+            f"""
+            INSERT INTO {_STATS_TABLE} (service_id, date, bookings, revenue)
+            SELECT s.id, a.date, count(*), sum(s.price)
+            FROM {appointments} a
+            CROSS JOIN LATERAL unnest(a.services_ids) AS booked(service_id)
+            JOIN {services} s ON s.id = booked.service_id
+            {where}
+            GROUP BY s.id, a.date
+            """,
+            params
+        )
+        return cursor.rowcount
+
+
+def get_report(date_from: datetime.date, date_to: datetime.date) -> Dict[str, Any]:
+    """
+    Get the bookings and revenue of every service over a range of days, read from the daily statistics.
+
+    Args:
+        date_from (datetime.date): The first day of the report.
+        date_to (datetime.date): The last day of the report.
+
+    Returns:
+        Dict[str, Any]: The report: totals per service, ordered by revenue, and the daily rows.
+    """
+    entries = catalog.get_catalog().entries
+    rows = ServiceDailyStats.objects.filter(date__range=(date_from, date_to)).order_by('date', 'service_id')
+
+    services: Dict[int, Dict[str, Any]] = {}
+    days = []
+    for row in rows.values_list('service_id', 'date', 'bookings', 'revenue'):
+        service_id, date, bookings, revenue = row
+        if service_id not in services:
+            entry = entries.get(service_id)
+            services[service_id] = {
+                'service_id': service_id,
+                'title': entry.title if entry is not None else None,
+                'bookings': 0,
+                'revenue': 0,
+            }
+        services[service_id]['bookings'] += bookings
+        services[service_id]['revenue'] += revenue
+        days.append({'date': date.isoformat(), 'service_id': service_id, 'bookings': bookings, 'revenue': revenue})
+
+    return {
+        'date_from': date_from.isoformat(),
+        'date_to': date_to.isoformat(),
+        'services': sorted(services.values(), key=lambda service: (-service['revenue'], service['service_id'])),
+        'days': days,
+        'total': {
+            'bookings': sum(service['bookings'] for service in services.values()),
+            'revenue': sum(service['revenue'] for service in services.values()),
+        },
+    }
+
+
+async def aget_report(date_from: datetime.date, date_to: datetime.date) -> Dict[str, Any]:
+    """
+    Asynchronous version of get_report().
+
+    Args:
+        date_from (datetime.date): The first day of the report.
+        date_to (datetime.date): The last day of the report.
+
+    Returns:
+        Dict[str, Any]: The report.
+    """
+    return await sync_to_async(get_report)(date_from, date_to)
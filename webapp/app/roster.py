@@ -0,0 +1,77 @@
+from app.models import Staff
+from app.scheduling import Chair, working_mask
+from asgiref.sync import sync_to_async
+
+import threading
+import time
+
+from typing import List, NamedTuple, Optional
+
+
+# How long a loaded roster is trusted, in seconds (see catalog.CATALOG_TIMEOUT)
+ROSTER_TIMEOUT = 60
+
+
+class Roster(NamedTuple):
+    # Chairs of the active staff members, empty for a salon without staff
+    chairs: List[Chair]
+    loaded_at: float
+
+
+_roster: Optional[Roster] = None
+_lock = threading.Lock()
+
+
+def _load() -> Roster:
+    return Roster(
+        chairs=[
+            Chair(staff.pk, working_mask(staff.opening_time, staff.closing_time))
+            for staff in Staff.objects.filter(is_active=True).order_by('pk')
+        ],
+        loaded_at=time.monotonic(),
+    )
+
+
+def _is_fresh(roster: Optional[Roster]) -> bool:
+    return roster is not None and time.monotonic() - roster.loaded_at <= ROSTER_TIMEOUT
+
+
+def get_chairs() -> List[Chair]:
+    """
+    Get the chairs of the active staff members, loading them with a single query if they are not cached yet.
+
+    Returns:
+        List[Chair]: The chairs, empty for a salon without staff.
+    """
+    global _roster
+
+    roster = _roster
+    if not _is_fresh(roster):
+        with _lock:
+            roster = _roster = _load()
+
+    return roster.chairs
+
+
+async def aget_chairs() -> List[Chair]:
+    """
+    Asynchronous version of get_chairs(). The database is accessed only if the cached roster is missing or stale.
+
+    Returns:
+        List[Chair]: The chairs, empty for a salon without staff.
+    """
+    roster = _roster
+    if _is_fresh(roster):
+        return roster.chairs
+
+    return await sync_to_async(get_chairs)()
+
+
+def invalidate():
+    """
+    Drop the cached roster, so that it is reloaded on the next access.
+    """
+    global _roster
+
+    with _lock:
+        _roster = None
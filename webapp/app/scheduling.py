@@ -0,0 +1,217 @@
+import datetime
+
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+
+# Granularity of the schedule in minutes, appointment durations are rounded up to whole slots
+SLOT_MINUTES = 30
+
+# Step of the offered start times in minutes, a multiple of SLOT_MINUTES
+START_MINUTES = 60
+
+# Duration of an appointment whose services are unknown, in minutes
+DEFAULT_DURATION = 60
+
+SLOTS_PER_DAY = 24 * 60 // SLOT_MINUTES
+
+# Slots at which an appointment can start
+START_MASK = sum(1 << i for i in range(0, SLOTS_PER_DAY, START_MINUTES // SLOT_MINUTES))
+
+
+class Chair(NamedTuple):
+    # None for the single chair of a salon without staff
+    staff_id: Optional[int]
+    # Bit i is set if the chair works during the i-th slot of the day
+    working_mask: int
+
+
+class Booking(NamedTuple):
+    staff_id: Optional[int]
+    date: datetime.date
+    time: datetime.time
+    # Duration in minutes
+    duration: int
+
+
+def slot_index(time: datetime.time) -> int:
+    return (time.hour * 60 + time.minute) // SLOT_MINUTES
+
+
+def slot_time(index: int) -> datetime.time:
+    minutes = index * SLOT_MINUTES
+    return datetime.time(minutes // 60, minutes % 60)
+
+
+def duration_slots(duration: int) -> int:
+    return max(1, -(-duration // SLOT_MINUTES))
+
+
+def span_mask(start: int, slots: int) -> int:
+    return ((1 << slots) - 1) << start
+
+
+def working_mask(opening_time: datetime.time, closing_time: datetime.time) -> int:
+    """
+    Get the bitset of the slots between the opening and the closing time.
+
+    Args:
+        opening_time (datetime.time): The start of the first slot.
+        closing_time (datetime.time): The end of the last slot.
+
+    Returns:
+        int: The working slots.
+    """
+    start = slot_index(opening_time)
+    end = slot_index(closing_time)
+    return span_mask(start, end - start) if end > start else 0
+
+
+def run_starts(free_mask: int, slots: int) -> int:
+    """
+    Find where runs of free slots long enough for an appointment start.
+
+    The whole day is processed at once with shifts and ands of the bitset, doubling the covered run length
+    on every step, so it takes O(log slots) operations.
+
+    Args:
+        free_mask (int): The free slots.
+        slots (int): The length of the run.
+
+    Returns:
+        int: Bit i is set if the slots i..i+slots-1 are all free.
+    """
+    starts = free_mask
+    covered = 1
+    while covered < slots:
+        step = min(covered, slots - covered)
+        starts &= starts >> step
+        covered += step
+
+    return starts
+
+
+def iter_bits(mask: int) -> Iterator[int]:
+    while mask:
+        lowest = mask & -mask
+        yield lowest.bit_length() - 1
+        mask ^= lowest
+
+
+class Schedule:
+    """
+    Occupancy of the chairs over a range of days, kept as one bitset per chair and day.
+
+    Free starts for a basket of services are found for all chairs of a day with a few bitwise operations
+    instead of checking the slots one by one.
+    """
+
+    def __init__(self, chairs: List[Chair], date_from: datetime.date, days: int):
+        """
+        Args:
+            chairs (List[Chair]): The chairs (staff members) of the salon.
+            date_from (datetime.date): The first date of the schedule.
+            days (int): The number of days in the schedule.
+        """
+        self.chairs = chairs
+        self.date_from = date_from
+        self.days = days
+
+        self._chair_indexes = {chair.staff_id: i for i, chair in enumerate(chairs)}
+        # Busy slots by day and chair
+        self._busy = [[0] * len(chairs) for _ in range(days)]
+
+    def add(self, booking: Booking):
+        """
+        Mark the slots of an appointment or a hold as busy. Bookings outside the schedule are ignored.
+
+        Args:
+            booking (Booking): The appointment or hold.
+        """
+        day = (booking.date - self.date_from).days
+        if not 0 <= day < self.days:
+            return
+
+        mask = span_mask(slot_index(booking.time), duration_slots(booking.duration))
+        busy = self._busy[day]
+
+        if booking.staff_id in self._chair_indexes:
+            busy[self._chair_indexes[booking.staff_id]] |= mask
+        elif booking.staff_id is None:
+            # Bookings without a staff member block the time on all chairs
+            for i in range(len(busy)):
+                busy[i] |= mask
+
+    def add_all(self, bookings: Iterable[Booking]):
+        for booking in bookings:
+            self.add(booking)
+
+    def free_starts(self, date: datetime.date, slots: int, not_before: int = 0) -> int:
+        """
+        Get the slots at which an appointment of the given length can start on at least one chair.
+
+        Args:
+            date (datetime.date): The date.
+            slots (int): The length of the appointment in slots.
+            not_before (int, optional): The first slot that can be offered. Default is 0.
+
+        Returns:
+            int: The bitset of the free starts.
+        """
+        starts = 0
+        for chair, busy in zip(self.chairs, self._busy[(date - self.date_from).days]):
+            starts |= run_starts(chair.working_mask & ~busy, slots)
+
+        return starts & START_MASK & ~((1 << not_before) - 1)
+
+    def find_chair(self, date: datetime.date, start: int, slots: int,
+                   preferred_staff_id: Optional[int] = None) -> Optional[Chair]:
+        """
+        Find a chair that is free for the whole appointment.
+
+        Args:
+            date (datetime.date): The date.
+            start (int): The first slot of the appointment.
+            slots (int): The length of the appointment in slots.
+            preferred_staff_id (int, optional): The staff member to check first. Default is None.
+
+        Returns:
+            Optional[Chair]: The free chair, or None if all chairs are busy.
+        """
+        mask = span_mask(start, slots)
+        busy = self._busy[(date - self.date_from).days]
+
+        candidates = sorted(range(len(self.chairs)), key=lambda i: self.chairs[i].staff_id != preferred_staff_id)
+        for i in candidates:
+            if self.chairs[i].working_mask & ~busy[i] & mask == mask:
+                return self.chairs[i]
+
+        return None
+
+    def free_slots(self, slots: int, now: datetime.datetime) -> Dict[datetime.date.isoformat, List[datetime.time.isoformat]]:
+        """
+        Build the map of free start times for an appointment of the given length. Dates without free starts are left out.
+
+        Args:
+            slots (int): The length of the appointment in slots.
+            now (datetime.datetime): The current date and time, earlier starts are not offered.
+
+        Returns:
+            Dict[str, List[str]]: Free start times (in ISO format) by date (in ISO format).
+        """
+        today = now.date()
+
+        free_dates = dict()
+        for day in range(self.days):
+            date = self.date_from + datetime.timedelta(days=day)
+            if date < today:
+                continue
+
+            # Only the slots that have not started yet can be booked today
+            not_before = (now.hour * 60 + now.minute) // SLOT_MINUTES + 1 if date == today else 0
+
+            free_times = [slot_time(i).isoformat() for i in iter_bits(self.free_starts(date, slots, not_before))]
+            if len(free_times) != 0:
+                free_dates[date.isoformat()] = free_times
+
+        return free_dates
+
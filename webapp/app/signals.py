@@ -0,0 +1,41 @@
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from app import availability, catalog, queries, reporting, roster
+from app.models import Appointment, Service, Staff
+
+
+@receiver(post_save, sender=Service)
+@receiver(post_delete, sender=Service)
+def invalidate_service_catalog(sender, **kwargs):
+    catalog.invalidate()
+
+
+# Appointments created, moved or cancelled (e.g. in the admin) take or free their slots
+@receiver(post_save, sender=Appointment)
+@receiver(post_delete, sender=Appointment)
+def bump_availability_version(sender, **kwargs):
+    transaction.on_commit(availability.bump_version)
+
+
+# Cancelled appointments are not counted in the reports anymore
+@receiver(post_delete, sender=Appointment)
+def record_cancellation(sender, instance, **kwargs):
+    reporting.record_cancellation(instance.date, instance.services_ids)
+
+
+# Staff changes change the working hours and chairs of the salon
+@receiver(post_save, sender=Staff)
+@receiver(post_delete, sender=Staff)
+def invalidate_roster(sender, **kwargs):
+    roster.invalidate()
+    transaction.on_commit(availability.bump_version)
+
+
+# Count the database queries of every request (see queries.capture)
+@receiver(connection_created)
+def install_query_counter(sender, connection, **kwargs):
+    if queries.execute_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(queries.execute_wrapper)
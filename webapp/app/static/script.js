@@ -15,53 +15,152 @@ BackButton.hide();
 MainButton.setText("SELECT DATE AND TIME");
 
 
+/* Elements */
+
+function element(id) {
+	return document.getElementById(id);
+}
+
+function show(id) {
+	element(id).style.display = '';
+}
+
+function hide(id) {
+	element(id).style.display = 'none';
+}
+
+
 /* Sections */
 
 var currentSection = 'select_services';
 
 function loadSelectServices() {
 	MainButton.setText("SELECT DATE AND TIME");
-	$('#select_date_and_time').hide();
-	$('#select_services').show();
+	hide('select_date_and_time');
+	show('select_services');
 	currentSection = 'select_services';
 }
 
 function loadSelectDateAndTime() {
 	MainButton.setText("BOOK");
-	$('#select_services').hide();
-	$('#select_date_and_time-times').hide();
-	loadDates();
-	$('#select_date_and_time').show();
+	hide('select_services');
+	selectedDateIsoformat = null;
+	selectedTimeIsoformat = null;
+	// The dates are shown right away, from the free times loaded since the services were selected or the snapshot
+	showFreeDates();
+	loadFreeDates();
+	show('select_date_and_time');
 	currentSection = 'select_date_and_time';
 }
 
 
 /* select_services */
 
-$('.select_service').click(function() {
-	const serviceIndex = parseInt($(this).attr('data-service_index'));
-	if (!selectedServicesIndexes.includes(serviceIndex)) {
-		$(this).addClass('select_service-selected');
-		selectedServicesIndexes.push(serviceIndex);
-	} else {
-		$(this).removeClass('select_service-selected');
-		selectedServicesIndexes.splice(selectedServicesIndexes.indexOf(serviceIndex), 1);
-	}
-
-	if (selectedServicesIndexes.length > 0) {
-		if (!MainButton.isVisible) {
-			MainButton.show();
+for (let div of document.querySelectorAll('.select_service')) {
+	div.addEventListener('click', function() {
+		const serviceIndex = parseInt(this.getAttribute('data-service_index'));
+		if (!selectedServicesIndexes.includes(serviceIndex)) {
+			this.classList.add('select_service-selected');
+			selectedServicesIndexes.push(serviceIndex);
+		} else {
+			this.classList.remove('select_service-selected');
+			selectedServicesIndexes.splice(selectedServicesIndexes.indexOf(serviceIndex), 1);
 		}
-	} else {
-		if (MainButton.isVisible) {
-			MainButton.hide();
+
+		if (selectedServicesIndexes.length > 0) {
+			if (!MainButton.isVisible) {
+				MainButton.show();
+			}
+			// Load the free times of the selected services while the user is still choosing
+			loadFreeDates();
+		} else {
+			if (MainButton.isVisible) {
+				MainButton.hide();
+			}
 		}
-	}
-});
+	});
+}
 
 
 /* select_date_and_time */
 
+var freeDates;
+
+// Free dates loaded from the webapp by the (sorted) IDs of the selected services, null while loading
+var freeDatesBySelection = {};
+
+// Whether the snapshot embedded in the page is still the current free times of its duration
+var freeDatesSnapshotIsCurrent = true;
+
+function getSelectedServicesIds() {
+	return selectedServicesIndexes.map(function(serviceIndex) {
+		return window.services[serviceIndex].pk;
+	});
+}
+
+function getSelectionKey() {
+	return JSON.stringify(getSelectedServicesIds().sort(function(a, b) { return a - b; }));
+}
+
+function getSelectedDuration() {
+	return selectedServicesIndexes.reduce(function(duration, serviceIndex) {
+		return duration + window.services[serviceIndex].fields.duration;
+	}, 0);
+}
+
+function getFreeDates() {
+	return freeDatesBySelection[getSelectionKey()] || window.freeDatesSnapshot;
+}
+
+function loadFreeDates() {
+	// The free times depend on the total duration of the selected services, the snapshot is exact for its duration
+	const selectionKey = getSelectionKey();
+	if (selectionKey in freeDatesBySelection
+			|| (freeDatesSnapshotIsCurrent && getSelectedDuration() == window.freeDatesSnapshotDuration)) {
+		return;
+	}
+	freeDatesBySelection[selectionKey] = null;
+
+	let requestURL = new URL(`${window.location.origin}/bot/get_free_appointment_dates`);
+	requestURL.searchParams.set('services_ids', selectionKey);
+
+	let xhr = new XMLHttpRequest();
+	xhr.open('GET', requestURL);
+	xhr.setRequestHeader('X-Telegram-Init-Data', window.initData);
+	xhr.send();
+	xhr.onload = function() {
+		if (xhr.status != 200) {
+			delete freeDatesBySelection[selectionKey];
+			return;
+		}
+		freeDatesBySelection[selectionKey] = JSON.parse(xhr.response).free_dates;
+		// Replace the dates shown from the snapshot
+		if (currentSection == 'select_date_and_time' && getSelectionKey() == selectionKey) {
+			showFreeDates();
+		}
+	};
+	xhr.onerror = function() {
+		delete freeDatesBySelection[selectionKey];
+	};
+}
+
+function showFreeDates() {
+	// Keep the selected date and time if they are still free
+	const dateIsoformat = selectedDateIsoformat;
+	const timeIsoformat = selectedTimeIsoformat;
+
+	freeDates = getFreeDates();
+	loadDates();
+	hide('select_date_and_time-times');
+
+	if (dateIsoformat != null && dateIsoformat in freeDates) {
+		selectDate(dateIsoformat);
+		if (timeIsoformat != null && freeDates[dateIsoformat].includes(timeIsoformat)) {
+			selectTime(timeIsoformat);
+		}
+	}
+}
+
 let months = [
 	"January", "February", "March", "April", "May", "June", "July", "August", "September", "October", "November", "December"
 ]
@@ -88,8 +187,29 @@ function stylizeDate(dateIsoformat) {
 }
 
 
+function selectDate(dateIsoformat) {
+	if (selectedDateIsoformat != null) {
+		element('select_date_and_time-dates').querySelector(`.select_date[data-date_iso='${selectedDateIsoformat}']`)
+			.classList.remove('select_date-selected');
+	}
+	element('select_date_and_time-dates').querySelector(`.select_date[data-date_iso='${dateIsoformat}']`)
+		.classList.add('select_date-selected');
+	selectedDateIsoformat = dateIsoformat;
+	loadTimes(dateIsoformat);
+}
+
+function selectTime(timeIsoformat) {
+	if (selectedTimeIsoformat != null) {
+		element('select_date_and_time-times').querySelector(`.select_time[data-time_iso='${selectedTimeIsoformat}']`)
+			.classList.remove('select_time-selected');
+	}
+	element('select_date_and_time-times').querySelector(`.select_time[data-time_iso='${timeIsoformat}']`)
+		.classList.add('select_time-selected');
+	selectedTimeIsoformat = timeIsoformat;
+}
+
 function loadDates() {
-	$('#select_date_and_time-dates').empty();
+	element('select_date_and_time-dates').replaceChildren();
 	selectedDateIsoformat = null;
 
 	for (let dateIsoformat in window.freeDates) {
@@ -97,42 +217,31 @@ function loadDates() {
 		div.classList.add('select_date');
 		div.setAttribute('data-date_iso', dateIsoformat);
 		div.onclick = function() {
-			if (selectedDateIsoformat != null) {
-				$(`.select_date[data-date_iso='${selectedDateIsoformat}']`).removeClass('select_date-selected');
-			}
-			$(this).addClass('select_date-selected');
-			selectedDateIsoformat = dateIsoformat;
-			loadTimes(dateIsoformat);
+			selectDate(dateIsoformat);
 		};
 		div.textContent = stylizeDate(dateIsoformat);
 
-		$('#select_date_and_time-dates').append(div);
+		element('select_date_and_time-dates').append(div);
 	}
 }
 
 function loadTimes(selectedDateIsoformat) {
-	$('#select_date_and_time-times').empty();
+	element('select_date_and_time-times').replaceChildren();
 	selectedTimeIsoformat = null;
 
-	for (let i in window.freeDates[selectedDateIsoformat]) {
-		let timeIsoformat = window.freeDates[selectedDateIsoformat][i];
-
+	for (let timeIsoformat of window.freeDates[selectedDateIsoformat]) {
 		let div = document.createElement('div');
 		div.classList.add('select_time');
 		div.setAttribute('data-time_iso', timeIsoformat)
 		div.onclick = function() {
-			if (selectedTimeIsoformat != null) {
-				$(`.select_time[data-time_iso='${selectedTimeIsoformat}']`).removeClass('select_time-selected');
-			}
-			$(this).addClass('select_time-selected');
-			selectedTimeIsoformat = timeIsoformat;
+			selectTime(timeIsoformat);
 		};
 		div.textContent = stylizeTime(timeIsoformat);
 
-		$('#select_date_and_time-times').append(div);
+		element('select_date_and_time-times').append(div);
 	}
 
-	$('#select_date_and_time-times').show();
+	show('select_date_and_time-times');
 }
 
 
@@ -151,10 +260,9 @@ MainButton.onClick(function() {
 			return null;
 		}
 
-		let selectedServicesIds = new Array();
+		let selectedServicesIds = getSelectedServicesIds();
 		let prices = new Array();
 		for (let selectedServiceIndex of selectedServicesIndexes) {
-			selectedServicesIds.push(window.services[selectedServiceIndex].pk);
 			prices.push({
 				'label': window.services[selectedServiceIndex].fields.title,
 				'amount': window.services[selectedServiceIndex].fields.price * 100
@@ -165,22 +273,26 @@ MainButton.onClick(function() {
 			'description': `Beauty salon services for you on ${stylizeDate(selectedDateIsoformat)} at ${stylizeTime(selectedTimeIsoformat)}`,
 			'prices': JSON.stringify(prices),
 			'payload': `${window.userId} ${window.initMessageId} ${JSON.stringify(selectedServicesIds)} ${selectedDateIsoformat} ${selectedTimeIsoformat}`,
-
-			'initDataHash': initDataHash,
-			'dataCheckString': dataCheckString,
 		}
 
 		let requestURL = new URL(`${window.location.origin}/bot/create_invoice_link`);
 		requestURL.searchParams.set('description', requestParams['description']);
 		requestURL.searchParams.set('prices', requestParams['prices']);
 		requestURL.searchParams.set('payload', requestParams['payload']);
-		requestURL.searchParams.set('initDataHash', requestParams['initDataHash']);
-		requestURL.searchParams.set('dataCheckString', requestParams['dataCheckString']);
 
 		let xhr = new XMLHttpRequest();
 		xhr.open('GET', requestURL);
+		xhr.setRequestHeader('X-Telegram-Init-Data', window.initData);
 		xhr.send();
 		xhr.onload = function() {
+			if (xhr.status == 409) {
+				WebApp.showAlert("This time has just been booked, please select another one");
+				// The loaded free times are outdated
+				freeDatesBySelection = {};
+				freeDatesSnapshotIsCurrent = false;
+				loadFreeDates();
+				return null;
+			}
 			window.Telegram.WebApp.openInvoice(JSON.parse(xhr.response).result);
 		}
 	}
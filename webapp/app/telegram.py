@@ -0,0 +1,156 @@
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from mysecrets import BOT_TOKEN, PROVIDER_TOKEN
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import contextlib
+import hashlib
+import json
+import logging
+import threading
+
+import requests
+
+from typing import Any, Dict, Iterator, Tuple
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_API_URL = f'https://api.telegram.org/bot{BOT_TOKEN}'
+
+# (connect, read) timeouts of the Telegram API requests, in seconds
+TELEGRAM_TIMEOUT = (3.05, 10)
+
+# How long a created invoice link is reused for the same order, in seconds
+INVOICE_LINK_TIMEOUT = 5 * 60
+
+# Shared keep-alive session for the Telegram API requests, retrying only failed connection attempts
+session = requests.Session()
+session.mount('https://', HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=10,
+    max_retries=Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.3),
+))
+
+# Hit and miss counters of the invoice link cache
+invoice_link_stats: Dict[str, int] = {'hits': 0, 'misses': 0}
+
+_stats_lock = threading.Lock()
+# Lock of every order being created, with the number of threads using it
+_key_locks: Dict[str, Tuple[threading.Lock, int]] = dict()
+_key_locks_lock = threading.Lock()
+
+
+def _count(counter: str):
+    with _stats_lock:
+        invoice_link_stats[counter] += 1
+
+
+@contextlib.contextmanager
+def _key_lock(key: str) -> Iterator[None]:
+    # The lock of a key is dropped by the last thread using it, not by the thread releasing it,
+    # so a thread that got the lock but has not acquired it yet still shares it with the others
+    with _key_locks_lock:
+        lock, users = _key_locks.get(key, (None, 0))
+        if lock is None:
+            lock = threading.Lock()
+        _key_locks[key] = (lock, users + 1)
+
+    try:
+        with lock:
+            yield
+    finally:
+        with _key_locks_lock:
+            lock, users = _key_locks[key]
+            if users == 1:
+                del _key_locks[key]
+            else:
+                _key_locks[key] = (lock, users - 1)
+
+
+def get_invoice_link_cache_key(description: str, payload: str, prices: str) -> str:
+    order_hash = hashlib.sha256(json.dumps([description, payload, prices]).encode('utf-8')).hexdigest()
+    return f'invoice_link:{order_hash}'
+
+
+def create_invoice_link(description: str, payload: str, prices: str) -> str:
+    """
+    Create an invoice link with the Telegram Bot API.
+
+    Successful responses are cached for INVOICE_LINK_TIMEOUT, so repeated requests for the same order
+    (e.g. the user tapping BOOK several times) reuse the same link instead of calling Telegram again.
+    Concurrent requests for the same order in the process wait for the first one.
+
+    Args:
+        description (str): The invoice description.
+        payload (str): The invoice payload.
+        prices (str): JSON list of the invoice prices.
+
+    Returns:
+        str: The Telegram API response body.
+    """
+    key = get_invoice_link_cache_key(description, payload, prices)
+
+    with _key_lock(key):
+        response_text = cache.get(key)
+        if response_text is not None:
+            _count('hits')
+            return response_text
+
+        _count('misses')
+        response = session.get(
+            f'{TELEGRAM_API_URL}/createInvoiceLink',
+            {
+                'title': "Appointment",
+                'description': description,
+                'payload': payload,
+                'provider_token': PROVIDER_TOKEN,
+                'currency': 'USD',
+                'prices': prices,
+                'photo_url': 'https://images.pexels.com/photos/853427/pexels-photo-853427.jpeg?cs=srgb&dl=pexels-delbeautybox-853427.jpg&fm=jpg',
+                'need_name': True,
+                'need_phone_number': True
+            },
+            timeout=TELEGRAM_TIMEOUT
+        )
+
+        if response.ok and response.json().get('ok'):
+            cache.set(key, response.text, INVOICE_LINK_TIMEOUT)
+        else:
+            logger.warning("createInvoiceLink failed: %s", response.text)
+
+        return response.text
+
+
+async def acreate_invoice_link(description: str, payload: str, prices: str) -> str:
+    """
+    Asynchronous version of create_invoice_link(). The request to Telegram is made in a separate thread.
+
+    Args:
+        description (str): The invoice description.
+        payload (str): The invoice payload.
+        prices (str): JSON list of the invoice prices.
+
+    Returns:
+        str: The Telegram API response body.
+    """
+    return await sync_to_async(create_invoice_link, thread_sensitive=False)(description, payload, prices)
+
+
+def send_message(chat_id: int, text: str) -> Dict[str, Any]:
+    """
+    Send a text message with the Telegram Bot API.
+
+    Args:
+        chat_id (int): The chat ID (the user ID for private chats).
+        text (str): The message text.
+
+    Returns:
+        Dict[str, Any]: The Telegram API response, with 'error_code' and 'parameters' if the message was not sent.
+    """
+    response = session.post(f'{TELEGRAM_API_URL}/sendMessage', {'chat_id': chat_id, 'text': text},
+                            timeout=TELEGRAM_TIMEOUT)
+    try:
+        return response.json()
+    except ValueError:
+        return {'ok': False, 'error_code': response.status_code, 'description': response.text}
@@ -1,3 +1,971 @@
-from django.test import TestCase
+import datetime
+import gzip
+import hmac
+import io
+import json
+import random
+import tempfile
+import threading
+import time
+import unittest
+from hashlib import sha256
+from urllib.parse import urlencode
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError
+from django.test import TestCase, override_settings
+from django.urls import resolve
+
+from app import (auth, availability, broadcast, catalog, data, export, holds, metrics, pages, queries, reporting, roster,
+                 scheduling, telegram)
+from app.models import Appointment, Broadcast, Service, ServiceDailyStats, SlotHold, Staff
+from django.utils import timezone
+from django.utils.html import escapejs
+from mysecrets import BOT_TOKEN
+
+
+# The pages link the static files by their hashed names, which are known once collectstatic has been run
+plain_static_files = override_settings(STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+
+# The requests going over the query budget of their view fail the test, instead of being logged (see app/queries.py)
+strict_query_budgets = override_settings(QUERY_INSPECTOR=True, QUERY_BUDGET_STRICT=True)
+
+
+def make_init_data(user_id: int = 1, auth_date: int = None) -> str:
+    # Sign the Mini App init data the same way Telegram does
+    fields = {
+        'auth_date': str(int(time.time()) if auth_date is None else auth_date),
+        'query_id': 'AAH',
+        'user': json.dumps({'id': user_id, 'first_name': 'Jane Doe'}),
+    }
+    data_check_string = '\n'.join(f'{key}={value}' for key, value in sorted(fields.items()))
+    fields['hash'] = hmac.new(auth.secret_key, data_check_string.encode('utf-8'), sha256).hexdigest()
+    return urlencode(fields)
+
+
+@strict_query_budgets
+class FreeAppointmentDatesTests(TestCase):
+
+    def setUp(self):
+        self.now = datetime.datetime(2023, 10, 9, 8, 30)
+        self.today = self.now.date()
+
+    def test_all_slots_are_free_without_appointments(self):
+        free_dates = availability.get_free_slots(now=self.now)
+
+        self.assertEqual(len(free_dates), availability.BOOKING_DAYS)
+        self.assertEqual(free_dates[self.today.isoformat()], [
+            datetime.time(h).isoformat() for h in range(availability.OPENING_HOUR, availability.CLOSING_HOUR)
+        ])
+
+    def test_booked_slots_are_excluded(self):
+        tomorrow = self.today + datetime.timedelta(days=1)
+        Appointment.objects.create(user_id=1, services_ids=[1], date=tomorrow, time=datetime.time(12))
+
+        free_dates = availability.get_free_slots(now=self.now)
+
+        self.assertNotIn('12:00:00', free_dates[tomorrow.isoformat()])
+        self.assertIn('12:00:00', free_dates[self.today.isoformat()])
+
+    def test_fully_booked_date_is_omitted(self):
+        for h in range(availability.OPENING_HOUR, availability.CLOSING_HOUR):
+            Appointment.objects.create(user_id=1, services_ids=[1], date=self.today, time=datetime.time(h))
+
+        free_dates = availability.get_free_slots(now=self.now)
+
+        self.assertNotIn(self.today.isoformat(), free_dates)
+
+    def test_past_hours_of_today_are_excluded(self):
+        free_dates = availability.get_free_slots(now=self.now.replace(hour=15))
+        self.assertEqual(free_dates[self.today.isoformat()][0], '16:00:00')
+
+        free_dates = availability.get_free_slots(now=self.now.replace(hour=20))
+        self.assertNotIn(self.today.isoformat(), free_dates)
+
+    def test_query_budget(self):
+        for i in range(availability.BOOKING_DAYS):
+            Appointment.objects.create(user_id=1, services_ids=[1],
+                                       date=self.today + datetime.timedelta(days=i), time=datetime.time(13))
+
+        roster.get_chairs()
+        with self.assertNumQueries(1):
+            data.get_free_appointment_dates()
+
+    def test_view_response_shape(self):
+        response = self.client.get('/bot/get_free_appointment_dates', HTTP_X_TELEGRAM_INIT_DATA=make_init_data())
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response.json()), ['free_dates'])
+
+
+@strict_query_budgets
+class SchedulingTests(TestCase):
+
+    def setUp(self):
+        catalog.invalidate()
+        roster.invalidate()
+        self.addCleanup(roster.invalidate)
+        self.date = datetime.date.today() + datetime.timedelta(days=1)
+        self.date_iso = self.date.isoformat()
+        self.now = datetime.datetime.combine(datetime.date.today(), datetime.time(8))
+
+    def test_run_starts(self):
+        for _ in range(200):
+            free_mask = random.getrandbits(scheduling.SLOTS_PER_DAY)
+            slots = random.randint(1, 8)
+            expected = sum(
+                1 << i for i in range(scheduling.SLOTS_PER_DAY)
+                if all(free_mask >> j & 1 for j in range(i, i + slots))
+            )
+            self.assertEqual(scheduling.run_starts(free_mask, slots), expected)
+
+    def test_duration_blocks_following_starts(self):
+        Appointment.objects.create(user_id=1, services_ids=[1], date=self.date, time=datetime.time(11), duration=90)
+
+        free_times = availability.get_free_slots(now=self.now)[self.date_iso]
+        self.assertNotIn('11:00:00', free_times)
+        self.assertNotIn('12:00:00', free_times)
+        self.assertIn('13:00:00', free_times)
+
+        # Two hours do not fit before the closing time
+        free_times = availability.get_free_slots(now=self.now, duration=120)[self.date_iso]
+        self.assertEqual(free_times[-1], '19:00:00')
+
+    def test_time_is_free_while_a_staff_member_is_free(self):
+        Staff.objects.create(name='Anna')
+        Staff.objects.create(name='Maria', opening_time=datetime.time(9), closing_time=datetime.time(13))
+
+        data.make_appointment(1, [1], self.date_iso, '12:00:00')
+        self.assertIn('12:00:00', availability.get_free_slots(now=self.now)[self.date_iso])
+        self.assertIn('09:00:00', availability.get_free_slots(now=self.now)[self.date_iso])
+
+        data.make_appointment(2, [1], self.date_iso, '12:00:00')
+        self.assertNotIn('12:00:00', availability.get_free_slots(now=self.now)[self.date_iso])
+        self.assertEqual(len({appointment.staff_id for appointment in Appointment.objects.all()}), 2)
+
+        with self.assertRaises(IntegrityError):
+            data.make_appointment(3, [1], self.date_iso, '12:00:00')
+
+    def test_hold_and_appointment_use_service_durations(self):
+        service = Service.objects.create(title='Coloring', price=50, duration=120)
+
+        self.assertTrue(holds.hold_slot(1, self.date_iso, '12:00:00', catalog.get_duration([service.pk])))
+        self.assertFalse(holds.hold_slot(2, self.date_iso, '13:00:00'))
+        self.assertTrue(holds.hold_slot(2, self.date_iso, '14:00:00'))
+
+        data.make_appointment(1, [service.pk], self.date_iso, '12:00:00')
+        self.assertEqual(Appointment.objects.get().duration, 120)
+        self.assertEqual(data.get_free_times(self.date_iso)[:3], ['11:00:00', '15:00:00', '16:00:00'])
+
+    def test_long_horizon_query_budget(self):
+        Staff.objects.bulk_create([Staff(name=f'Staff {i}') for i in range(5)])
+        Appointment.objects.bulk_create([
+            Appointment(user_id=1, services_ids=[1], date=self.date + datetime.timedelta(days=i), time=datetime.time(12))
+            for i in range(90)
+        ])
+        roster.get_chairs()
+
+        with self.assertNumQueries(1):
+            free_dates = availability.get_free_slots(days=90, now=self.now)
+
+        self.assertEqual(len(free_dates), 90)
+
+    def test_view_with_services(self):
+        service = Service.objects.create(title='Coloring', price=50, duration=120)
+        params = {'services_ids': json.dumps([service.pk])}
+
+        response = self.client.get('/bot/get_free_appointment_dates', params, HTTP_X_TELEGRAM_INIT_DATA=make_init_data())
+        self.assertEqual(response.json()['free_dates'][self.date_iso][-1], '19:00:00')
+
+        response = self.client.get('/bot/get_free_appointment_dates', {'services_ids': '[x'},
+                                   HTTP_X_TELEGRAM_INIT_DATA=make_init_data())
+        self.assertEqual(response.status_code, 400)
+
+
+@strict_query_budgets
+class FreeSlotsMapTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.tomorrow_iso = (datetime.date.today() + datetime.timedelta(days=1)).isoformat()
+
+    def get(self, **headers):
+        return self.client.get('/bot/get_free_appointment_dates', HTTP_X_TELEGRAM_INIT_DATA=make_init_data(), **headers)
+
+    def test_not_modified_with_the_version_query_only(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(self.tomorrow_iso, response.json()['free_dates'])
+
+        with self.assertNumQueries(1):
+            response = self.get(HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_version_is_bumped_by_appointment(self):
+        etag = self.get()['ETag']
+
+        with self.captureOnCommitCallbacks(execute=True):
+            data.make_appointment(1, [1], self.tomorrow_iso, '12:00:00')
+
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('12:00:00', response.json()['free_dates'][self.tomorrow_iso])
+
+    def test_version_is_bumped_by_hold(self):
+        version = availability.get_version()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            holds.hold_slot(1, self.tomorrow_iso, '12:00:00')
+
+        self.assertGreater(availability.get_version(), version)
+        self.assertNotIn('12:00:00', json.loads(availability.get_free_slots_map().content)['free_dates'][self.tomorrow_iso])
+
+    def test_version_is_bumped_by_admin_changes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            appointment = Appointment.objects.create(user_id=1, services_ids=[1], date=self.tomorrow_iso,
+                                                     time=datetime.time(12))
+        self.assertNotIn('12:00:00', json.loads(availability.get_free_slots_map().content)['free_dates'][self.tomorrow_iso])
+
+        # Moved to another time
+        with self.captureOnCommitCallbacks(execute=True):
+            appointment.time = datetime.time(14)
+            appointment.save()
+        free_times = json.loads(availability.get_free_slots_map().content)['free_dates'][self.tomorrow_iso]
+        self.assertIn('12:00:00', free_times)
+        self.assertNotIn('14:00:00', free_times)
+
+    def test_version_is_shared_by_the_processes(self):
+        version = availability.get_version()
+
+        # The version is kept in the database, not in the cache of the process
+        cache.clear()
+        self.assertEqual(availability.get_version(), version)
+        availability.bump_version()
+        self.assertEqual(availability.get_version(), version + 1)
+
+    def test_map_expires_with_the_earliest_hold(self):
+        SlotHold.objects.create(user_id=1, date=self.tomorrow_iso, time=datetime.time(12),
+                                expires_at=timezone.now() + datetime.timedelta(seconds=5))
+
+        with mock.patch.object(cache, 'set', wraps=cache.set) as cache_set:
+            availability.get_free_slots_map()
+
+        self.assertLessEqual(cache_set.call_args.args[2], 5)
+
+
+class ServiceCatalogTests(TestCase):
+
+    def setUp(self):
+        catalog.invalidate()
+        self.haircut = Service.objects.create(title='Haircut', price=20)
+        self.manicure = Service.objects.create(title='Manicure', price=15)
+
+    def test_catalog_is_cached(self):
+        with self.assertNumQueries(1):
+            catalog.get_catalog()
+            services, services_json = data.get_services_with_json()
+
+        self.assertEqual([service.title for service in services], ['Haircut', 'Manicure'])
+        self.assertIn('"title": "Manicure"', services_json)
+
+    def test_catalog_is_invalidated_on_save_and_delete(self):
+        version = catalog.get_catalog().version
+
+        self.haircut.price = 25
+        self.haircut.save()
+        self.assertEqual(catalog.get_catalog().entries[self.haircut.pk], ('Haircut', 25))
+
+        self.manicure.delete()
+        self.assertNotIn(self.manicure.pk, catalog.get_catalog().entries)
+        self.assertGreater(catalog.get_catalog().version, version)
+
+    def test_unknown_services_reload_the_catalog_once(self):
+        catalog.get_duration([self.haircut.pk])
+
+        with mock.patch.object(catalog.time, 'monotonic', return_value=time.monotonic() + 10):
+            version = catalog.get_catalog().version
+            with self.assertNumQueries(1):
+                for _ in range(3):
+                    self.assertEqual(catalog.get_duration([self.haircut.pk, 999]), 60)
+                    self.assertEqual(catalog.get_entries([999, self.manicure.pk]), [('Manicure', 15)])
+
+        # The catalog has not changed, so the page rendered from it is kept
+        self.assertEqual(catalog.get_catalog().version, version)
+
+    def test_active_appointments_query_count(self):
+        today = datetime.date.today()
+        for i in range(5):
+            Appointment.objects.create(user_id=1, services_ids=[self.haircut.pk, self.manicure.pk],
+                                       date=today + datetime.timedelta(days=i + 1), time=datetime.time(12))
+        catalog.get_catalog()
+
+        with self.assertNumQueries(1):
+            active_appointments = data.get_active_appointments(1)
+
+        self.assertEqual(len(active_appointments), 5)
+        self.assertEqual(active_appointments[0]['services_titles'], ['Haircut', 'Manicure'])
+
+
+@strict_query_budgets
+class ActiveAppointmentsPageTests(TestCase):
+
+    def setUp(self):
+        catalog.invalidate()
+        service = Service.objects.create(title='Haircut', price=20)
+        today = datetime.date.today()
+        for i in range(12):
+            Appointment.objects.create(user_id=1, services_ids=[service.pk],
+                                       date=today + datetime.timedelta(days=i // 4 + 1), time=datetime.time(11 + i % 4))
+        catalog.get_catalog()
+
+    def test_pages_forward_and_back(self):
+        first = data.get_active_appointments_page(1, limit=5)
+        self.assertIsNone(first['prev'])
+        self.assertEqual(len(first['active_appointments']), 5)
+
+        with self.assertNumQueries(1):
+            second = data.get_active_appointments_page(1, after=first['next'], limit=5)
+        third = data.get_active_appointments_page(1, after=second['next'], limit=5)
+        self.assertEqual(len(third['active_appointments']), 2)
+        self.assertIsNone(third['next'])
+
+        all_appointments = data.get_active_appointments(1)
+        self.assertEqual(first['active_appointments'] + second['active_appointments'] + third['active_appointments'],
+                         all_appointments)
+
+        back = data.get_active_appointments_page(1, before=second['prev'], limit=5)
+        self.assertEqual(back['active_appointments'], first['active_appointments'])
+        self.assertIsNone(back['prev'])
+        self.assertEqual(back['next'], first['next'])
+
+    def test_view(self):
+        params = {'bot_token': BOT_TOKEN, 'user_id': 1, 'limit': 10}
+
+        page = self.client.get('/bot/get_active_appointments', params).json()
+        self.assertEqual(len(page['active_appointments']), 10)
+
+        page = self.client.get('/bot/get_active_appointments', dict(params, after=page['next'])).json()
+        self.assertEqual(len(page['active_appointments']), 2)
+        self.assertIsNotNone(page['prev'])
+
+        self.assertEqual(self.client.get('/bot/get_active_appointments', dict(params, after='x')).status_code, 400)
+        self.assertEqual(self.client.get('/bot/get_active_appointments', dict(params, limit='a')).status_code, 400)
+
+
+@strict_query_budgets
+@plain_static_files
+class MakeOrderPageTests(TestCase):
+
+    def setUp(self):
+        catalog.invalidate()
+        cache.clear()
+        Service.objects.create(title='Haircut', price=20)
+        self.tomorrow_iso = (datetime.date.today() + datetime.timedelta(days=1)).isoformat()
+
+    def test_bad_request_without_init_message_id(self):
+        self.assertEqual(self.client.get('/bot/make_order').status_code, 400)
+        self.assertEqual(self.client.get('/bot/make_order?init_message_id=abc').status_code, 400)
+
+    def test_page_is_rendered_once(self):
+        response = self.client.get('/bot/make_order?init_message_id=1')
+        self.assertContains(response, 'Haircut')
+
+        # Only the availability version is read
+        with self.assertNumQueries(1):
+            other_response = self.client.get('/bot/make_order?init_message_id=2')
+
+        self.assertEqual(other_response.content, response.content)
+        self.assertEqual(other_response['ETag'], response['ETag'])
+
+    def test_gzip_variant(self):
+        response = self.client.get('/bot/make_order?init_message_id=1')
+        gzip_response = self.client.get('/bot/make_order?init_message_id=1', HTTP_ACCEPT_ENCODING='gzip, deflate')
+
+        self.assertEqual(gzip_response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(gzip_response.content), response.content)
+        self.assertNotEqual(gzip_response['ETag'], response['ETag'])
+
+    @unittest.skipIf(pages.brotli is None, "brotli is not installed")
+    def test_brotli_variant(self):
+        response = self.client.get('/bot/make_order?init_message_id=1')
+        brotli_response = self.client.get('/bot/make_order?init_message_id=1', HTTP_ACCEPT_ENCODING='gzip, br')
+
+        self.assertEqual(brotli_response['Content-Encoding'], 'br')
+        self.assertEqual(pages.brotli.decompress(brotli_response.content), response.content)
+
+    def test_not_modified(self):
+        etag = self.client.get('/bot/make_order?init_message_id=1')['ETag']
+
+        response = self.client.get('/bot/make_order?init_message_id=1', HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 304)
+
+    def test_page_is_rerendered_on_catalog_change(self):
+        etag = self.client.get('/bot/make_order?init_message_id=1')['ETag']
+        Service.objects.create(title='Manicure', price=15)
+
+        response = self.client.get('/bot/make_order?init_message_id=1', HTTP_IF_NONE_MATCH=etag)
+
+        self.assertContains(response, 'Manicure')
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_free_dates_are_embedded(self):
+        response = self.client.get('/bot/make_order?init_message_id=1')
+
+        self.assertContains(response, escapejs(availability.get_free_slots_map().content.decode('utf-8')))
+        self.assertContains(response, escapejs(self.tomorrow_iso))
+        self.assertNotContains(response, 'jquery')
+
+    def test_page_is_rerendered_on_booking(self):
+        etag = self.client.get('/bot/make_order?init_message_id=1')['ETag']
+
+        with self.captureOnCommitCallbacks(execute=True):
+            data.make_appointment(1, [1], self.tomorrow_iso, '12:00:00')
+
+        response = self.client.get('/bot/make_order?init_message_id=1', HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, escapejs(availability.get_free_slots_map().content.decode('utf-8')))
+
+    def test_hashed_static_files(self):
+        with tempfile.TemporaryDirectory() as static_root, \
+                override_settings(STATIC_ROOT=static_root,
+                                  STATICFILES_STORAGE='whitenoise.storage.CompressedManifestStaticFilesStorage'), \
+                mock.patch.object(pages, '_make_order_page', None):
+            call_command('collectstatic', interactive=False, verbosity=0, ignore_patterns=['admin'])
+            script_url = staticfiles_storage.url('script.js')
+
+            self.assertContains(self.client.get('/bot/make_order?init_message_id=1'), f'src="{script_url}"')
+            self.assertRegex(script_url, r'^/static/script\.[0-9a-f]{12}\.js$')
+
+            response = self.client.get(script_url, HTTP_ACCEPT_ENCODING='gzip, br')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Encoding'], 'br' if pages.brotli is not None else 'gzip')
+            self.assertIn('immutable', response['Cache-Control'])
+
+
+@strict_query_budgets
+class MakeAppointmentTests(TestCase):
+
+    def test_slot_can_be_booked_once(self):
+        params = {'bot_token': BOT_TOKEN, 'user_id': 1, 'services_ids': '[1]',
+                  'date_iso': '2023-10-10', 'time_iso': '12:00:00'}
+
+        self.assertEqual(self.client.get('/bot/make_appointment', params).status_code, 200)
+        self.assertEqual(self.client.get('/bot/make_appointment', dict(params, user_id=2)).status_code, 409)
+        self.assertEqual(Appointment.objects.get().user_id, 1)
+
+    def test_payment_books_one_appointment(self):
+        Staff.objects.bulk_create([Staff(name='Anna'), Staff(name='Maria')])
+        params = {'bot_token': BOT_TOKEN, 'user_id': 1, 'services_ids': '[1]',
+                  'date_iso': '2023-10-10', 'time_iso': '12:00:00', 'charge_id': 'charge-1'}
+
+        # The request is repeated after a gateway timeout or when the payment update is handled again
+        self.assertEqual(self.client.get('/bot/make_appointment', params).status_code, 200)
+        self.assertEqual(self.client.get('/bot/make_appointment', params).status_code, 200)
+        self.assertEqual(Appointment.objects.get().payment_charge_id, 'charge-1')
+
+
+@strict_query_budgets
+class UpcomingAppointmentsTests(TestCase):
+
+    def setUp(self):
+        haircut = Service.objects.create(title='Haircut', price=20)
+        for user_id, (day, hour) in enumerate([(9, 20), (10, 11), (10, 14), (11, 11)]):
+            Appointment.objects.create(user_id=user_id, services_ids=[haircut.pk],
+                                       date=datetime.date(2023, 10, day), time=datetime.time(hour))
+
+    def test_window_spans_midnight(self):
+        params = {'bot_token': BOT_TOKEN, 'start': '2023-10-09T20:00:00', 'end': '2023-10-10T14:00:00'}
+        response = self.client.get('/bot/get_upcoming_appointments', params)
+
+        appointments = response.json()['appointments']
+        self.assertEqual([appointment['user_id'] for appointment in appointments], [0, 1])
+        self.assertEqual(appointments[1]['date'], '2023-10-10')
+        self.assertEqual(appointments[1]['time'], '11:00:00')
+        self.assertEqual(appointments[1]['services_titles'], ['Haircut'])
+
+    def test_bad_windows(self):
+        params = {'bot_token': BOT_TOKEN, 'start': '2023-10-09T20:00:00'}
+        for end in ('2023-10-09T19:00:00', '2023-10-20T20:00:00', 'tomorrow'):
+            self.assertEqual(self.client.get('/bot/get_upcoming_appointments', dict(params, end=end)).status_code, 400)
+        self.assertEqual(self.client.get('/bot/get_upcoming_appointments', params).status_code, 400)
+
+
+@strict_query_budgets
+class ReportingTests(TestCase):
+
+    def setUp(self):
+        self.haircut = Service.objects.create(title='Haircut', price=20, duration=30)
+        self.manicure = Service.objects.create(title='Manicure', price=15, duration=30)
+
+    def book(self, user_id, services_ids, time_iso):
+        data.make_appointment(user_id, services_ids, '2023-10-10', time_iso)
+
+    def get_report(self, **params):
+        params = dict({'bot_token': BOT_TOKEN, 'date_from': '2023-10-01', 'date_to': '2023-10-31'}, **params)
+        return self.client.get('/bot/get_services_report', params)
+
+    def test_bookings_are_aggregated_per_day(self):
+        self.book(1, [self.haircut.pk, self.manicure.pk], '12:00:00')
+        self.book(2, [self.haircut.pk], '14:00:00')
+
+        report = self.get_report().json()
+        self.assertEqual(report['services'], [
+            {'service_id': self.haircut.pk, 'title': 'Haircut', 'bookings': 2, 'revenue': 40},
+            {'service_id': self.manicure.pk, 'title': 'Manicure', 'bookings': 1, 'revenue': 15},
+        ])
+        self.assertEqual(report['total'], {'bookings': 3, 'revenue': 55})
+        self.assertEqual(ServiceDailyStats.objects.count(), 2)
+
+        self.assertEqual(self.get_report(date_from='2023-10-11').json()['services'], [])
+
+    def test_cancellations_and_rebuild(self):
+        self.book(1, [self.haircut.pk, self.manicure.pk], '12:00:00')
+        self.book(2, [self.haircut.pk], '14:00:00')
+        Appointment.objects.get(user_id=2).delete()
+
+        stats = {row.service_id: (row.bookings, row.revenue) for row in ServiceDailyStats.objects.all()}
+        self.assertEqual(stats, {self.haircut.pk: (1, 20), self.manicure.pk: (1, 15)})
+
+        ServiceDailyStats.objects.update(bookings=0, revenue=0)
+        self.assertEqual(reporting.rebuild([self.haircut.pk]), 1)
+        self.assertEqual(ServiceDailyStats.objects.get(service_id=self.haircut.pk).bookings, 1)
+        self.assertEqual(ServiceDailyStats.objects.get(service_id=self.manicure.pk).bookings, 0)
+
+        self.assertEqual(reporting.rebuild(), 2)
+        self.assertEqual(ServiceDailyStats.objects.get(service_id=self.manicure.pk).bookings, 1)
+
+    def test_bad_requests(self):
+        self.assertEqual(self.get_report(date_from='2023-11-01').status_code, 400)
+        self.assertEqual(self.get_report(date_to='2025-01-01').status_code, 400)
+        self.assertEqual(self.get_report(date_from='tomorrow').status_code, 400)
+        self.assertEqual(self.get_report(bot_token='wrong').status_code, 403)
+
+
+class ExportTests(TestCase):
+
+    def setUp(self):
+        haircut = Service.objects.create(title='Haircut', price=20)
+        manicure = Service.objects.create(title='Manicure, gel', price=15)
+        for day, services_ids in ((9, [haircut.pk, manicure.pk]), (10, [manicure.pk]), (12, [haircut.pk, 999])):
+            Appointment.objects.create(user_id=day, services_ids=services_ids, date=datetime.date(2023, 10, day),
+                                       time=datetime.time(12))
+
+    def export(self, *args):
+        output = io.StringIO()
+        call_command('export_appointments', *args, stdout=output)
+        return output.getvalue()
+
+    def test_csv(self):
+        lines = self.export('--date-from', '2023-10-09', '--date-to', '2023-10-10').splitlines()
+        self.assertEqual(lines[0], ','.join(export.COLUMNS))
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[1].endswith(',"Haircut;Manicure, gel"'))
+
+    def test_jsonl_in_chunks(self):
+        with mock.patch.object(export, 'EXPORT_CHUNK_SIZE', 2):
+            chunks = list(export.export_appointments('jsonl', date_from=datetime.date(2023, 10, 9)))
+            self.assertEqual([len(chunk.splitlines()) for chunk in chunks], [2, 1])
+
+            rows = [json.loads(line) for line in self.export('--format', 'jsonl', '--date-from', '2023-10-10').splitlines()]
+
+        self.assertEqual([row['user_id'] for row in rows], [10, 12])
+        self.assertEqual(rows[1]['services_titles'], ['Haircut', ''])
+        self.assertEqual(rows[1]['date'], '2023-10-12')
+
+    def test_output_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = f'{directory}/appointments.csv'
+            self.export('--output', path)
+            with open(path, encoding='utf-8') as output:
+                self.assertEqual(len(output.read().splitlines()), 4)
+
+    def test_bad_arguments(self):
+        with self.assertRaises(CommandError):
+            self.export('--format', 'xml')
+        with self.assertRaises(CommandError):
+            self.export('--date-to', 'soon')
+
+
+class BroadcastTests(TestCase):
+
+    def setUp(self):
+        for user_id, hour in ((1, 11), (2, 11), (2, 12), (3, 11), (4, 11), (5, 11)):
+            Appointment.objects.create(user_id=user_id, services_ids=[1], date=datetime.date(2023, 10, 10),
+                                       time=datetime.time(hour), staff=Staff.objects.create(name=str(hour)))
+        self.broadcast = Broadcast.objects.create(name='closure', text="Closed tomorrow")
+
+    def run_broadcast(self, send_message):
+        with mock.patch.object(telegram, 'send_message', side_effect=send_message) as mocked:
+            broadcast.run_broadcast(self.broadcast, concurrency=2, rate=1000)
+        return sorted(call.args[0] for call in mocked.call_args_list)
+
+    def test_resumes_after_crash(self):
+        def crash_on_fourth_user(chat_id, text):
+            if chat_id == 4:
+                raise RuntimeError("crash")
+            return {'ok': True}
+
+        with self.assertRaises(RuntimeError):
+            self.run_broadcast(crash_on_fourth_user)
+
+        self.broadcast.refresh_from_db()
+        self.assertEqual(self.broadcast.last_user_id, 3)
+        self.assertEqual(self.broadcast.sent, 3)
+        self.assertIsNone(self.broadcast.finished_at)
+
+        self.assertEqual(self.run_broadcast(lambda chat_id, text: {'ok': True}), [4, 5])
+        self.broadcast.refresh_from_db()
+        self.assertEqual((self.broadcast.sent, self.broadcast.failed, self.broadcast.last_user_id), (5, 0, 5))
+        self.assertIsNotNone(self.broadcast.finished_at)
+
+    def test_flood_limit_and_blocked_users(self):
+        flood_limited = set()
+
+        def send_message(chat_id, text):
+            if chat_id == 1 and chat_id not in flood_limited:
+                flood_limited.add(chat_id)
+                return {'ok': False, 'error_code': 429, 'parameters': {'retry_after': 0}}
+            if chat_id == 2:
+                return {'ok': False, 'error_code': 403, 'description': "Forbidden: bot was blocked by the user"}
+            return {'ok': True}
+
+        self.assertEqual(self.run_broadcast(send_message), [1, 1, 2, 3, 4, 5])
+        self.assertEqual((self.broadcast.sent, self.broadcast.failed), (4, 1))
+
+
+@strict_query_budgets
+class MetricsTests(TestCase):
+
+    def get_sample(self, name, **labels):
+        return metrics.REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_view_latency_and_queries(self):
+        Appointment.objects.create(user_id=1, services_ids=[1], date=datetime.date.today(), time=datetime.time(12))
+        labels = {'view': 'get_active_appointments'}
+        requests = self.get_sample('webapp_view_duration_seconds_count', **labels)
+        queries = self.get_sample('webapp_view_db_queries_sum', **labels)
+        ok_responses = self.get_sample('webapp_view_responses_total', status='2xx', **labels)
+
+        self.client.get('/bot/get_active_appointments', {'bot_token': BOT_TOKEN, 'user_id': 1})
+
+        self.assertEqual(self.get_sample('webapp_view_duration_seconds_count', **labels), requests + 1)
+        self.assertGreaterEqual(self.get_sample('webapp_view_db_queries_sum', **labels), queries + 1)
+        self.assertEqual(self.get_sample('webapp_view_responses_total', status='2xx', **labels), ok_responses + 1)
+
+    def test_metrics_endpoint(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+
+        response = self.client.get('/metrics', {'bot_token': BOT_TOKEN})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'webapp_invoice_link_cache_lookups_total{result="hit"}', response.content)
+
+        self.client.get('/bot/unknown')
+        self.assertIn(b'webapp_view_responses_total{status="4xx",view="unmatched"}',
+                      self.client.get('/metrics', {'bot_token': BOT_TOKEN}).content)
+
+
+@strict_query_budgets
+@plain_static_files
+class QueryBudgetTests(TestCase):
+
+    def setUp(self):
+        self.service = Service.objects.create(title='Haircut', price=20)
+        self.date_iso = (datetime.date.today() + datetime.timedelta(days=1)).isoformat()
+        Appointment.objects.create(user_id=1, services_ids=[self.service.pk],
+                                   date=datetime.date.fromisoformat(self.date_iso), time=datetime.time(12))
+
+    def assertWithinBudget(self, path, params=None, **headers):
+        # Budgets are declared for cold caches
+        catalog.invalidate()
+        roster.invalidate()
+        cache.clear()
+
+        with queries.capture(record_statements=True) as log:
+            response = self.client.get(path, params, **headers)
+            if response.streaming:
+                b''.join(response.streaming_content)
+
+        self.assertLess(response.status_code, 400)
+        self.assertLessEqual(log.count, resolve(path).func.query_budget, f"{path} is over its query budget")
+        self.assertEqual(log.repeated_statements(), [])
+
+    def test_every_view_has_a_budget(self):
+        for path in ('/metrics', *(f'/bot/{name}' for name in (
+                'make_order', 'get_free_appointment_dates', 'get_active_appointments', 'get_upcoming_appointments',
+                'create_invoice_link', 'make_appointment', 'check_slot_hold', 'get_services_report'))):
+            self.assertIsInstance(resolve(path).func.query_budget, int, path)
+
+    def test_mini_app_views(self):
+        self.assertWithinBudget('/bot/make_order', {'init_message_id': 1})
+        self.assertWithinBudget('/bot/get_free_appointment_dates', {'services_ids': f'[{self.service.pk}]'},
+                                HTTP_X_TELEGRAM_INIT_DATA=make_init_data())
+
+        response = mock.Mock(ok=True, text=json.dumps({'ok': True, 'result': 'https://t.me/$invoice'}))
+        with mock.patch.object(telegram.session, 'get', return_value=response):
+            self.assertWithinBudget('/bot/create_invoice_link', {
+                'description': 'Beauty salon services',
+                'prices': json.dumps([{'label': 'Haircut', 'amount': 2000}]),
+                'payload': f'2 10 [{self.service.pk}] {self.date_iso} 14:00:00',
+                'initData': make_init_data(2),
+            })
+
+    def test_bot_views(self):
+        params = {'bot_token': BOT_TOKEN}
+        self.assertWithinBudget('/bot/get_active_appointments', dict(params, user_id=1))
+        self.assertWithinBudget('/bot/get_upcoming_appointments',
+                                dict(params, start=f'{self.date_iso}T00:00:00', end=f'{self.date_iso}T23:00:00'))
+        self.assertWithinBudget('/bot/check_slot_hold',
+                                dict(params, user_id=1, date_iso=self.date_iso, time_iso='12:00:00'))
+        self.assertWithinBudget('/bot/make_appointment', dict(params, user_id=2, services_ids=f'[{self.service.pk}]',
+                                                              date_iso=self.date_iso, time_iso='14:00:00',
+                                                              charge_id='charge-1'))
+        self.assertWithinBudget('/bot/get_services_report', dict(params, date_from=self.date_iso, date_to=self.date_iso))
+        self.assertWithinBudget('/metrics', params)
+
+    def test_repeated_queries_are_detected(self):
+        services_ids = [Service.objects.create(title=f'Service {i}', price=10).pk for i in range(3)]
+
+        with queries.capture(record_statements=True) as log:
+            for service_id in services_ids:
+                Service.objects.get(pk=service_id)
+
+        self.assertEqual(log.count, 3)
+        self.assertEqual([count for _, count in log.repeated_statements()], [3])
+
+    def test_nested_captures(self):
+        with queries.capture() as outer:
+            Service.objects.count()
+            with queries.capture() as inner:
+                Service.objects.count()
+
+        self.assertEqual((outer.count, inner.count), (2, 1))
+
+    @override_settings(QUERY_INSPECTOR=True, QUERY_BUDGET_STRICT=False)
+    def test_query_inspector_middleware(self):
+        view = resolve('/bot/get_active_appointments').func
+        params = {'bot_token': BOT_TOKEN, 'user_id': 1}
+
+        with mock.patch.object(view, 'query_budget', 0), self.assertLogs('app.queries', 'WARNING') as logs:
+            response = self.client.get('/bot/get_active_appointments', params)
+
+        self.assertGreaterEqual(int(response[queries.QUERY_COUNT_HEADER]), 1)
+        self.assertIn('over its budget of 0', logs.output[0])
+
+        with mock.patch.object(view, 'query_budget', 0), override_settings(QUERY_BUDGET_STRICT=True):
+            with self.assertRaisesMessage(queries.QueryBudgetExceeded, 'over its budget of 0'):
+                self.client.get('/bot/get_active_appointments', params)
+
+
+@strict_query_budgets
+class SlotHoldTests(TestCase):
+
+    def setUp(self):
+        self.date_iso = (datetime.date.today() + datetime.timedelta(days=1)).isoformat()
+
+    def test_slot_is_held_for_one_user(self):
+        self.assertTrue(holds.hold_slot(1, self.date_iso, '12:00:00'))
+        self.assertTrue(holds.hold_slot(1, self.date_iso, '12:00:00'))
+        self.assertFalse(holds.hold_slot(2, self.date_iso, '12:00:00'))
+
+        self.assertTrue(holds.check_slot_hold(1, self.date_iso, '12:00:00'))
+        self.assertFalse(holds.check_slot_hold(2, self.date_iso, '12:00:00'))
+
+    def test_user_holds_one_slot(self):
+        for hour in range(availability.OPENING_HOUR, availability.CLOSING_HOUR):
+            self.assertTrue(holds.hold_slot(1, self.date_iso, datetime.time(hour).isoformat()))
+
+        self.assertEqual(SlotHold.objects.filter(user_id=1).count(), 1)
+        self.assertFalse(holds.check_slot_hold(1, self.date_iso, '12:00:00'))
+        self.assertTrue(holds.hold_slot(2, self.date_iso, '12:00:00'))
+
+    def test_booked_slot_cannot_be_held(self):
+        data.make_appointment(1, [1], self.date_iso, '12:00:00')
+
+        self.assertFalse(holds.hold_slot(2, self.date_iso, '12:00:00'))
+
+    def test_expired_holds_are_released(self):
+        SlotHold.objects.bulk_create([
+            SlotHold(user_id=1, date=self.date_iso, time=datetime.time(h),
+                     expires_at=timezone.now() - datetime.timedelta(seconds=1))
+            for h in range(availability.OPENING_HOUR, availability.CLOSING_HOUR)
+        ])
+
+        self.assertFalse(holds.check_slot_hold(1, self.date_iso, '12:00:00'))
+        with self.assertNumQueries(1):
+            self.assertEqual(holds.release_expired_holds(), availability.CLOSING_HOUR - availability.OPENING_HOUR)
+        self.assertTrue(holds.hold_slot(2, self.date_iso, '12:00:00'))
+
+    def test_held_slot_is_not_free(self):
+        holds.hold_slot(1, self.date_iso, '12:00:00')
+
+        self.assertNotIn('12:00:00', data.get_free_appointment_dates()[self.date_iso])
+
+    def test_appointment_releases_hold(self):
+        holds.hold_slot(1, self.date_iso, '12:00:00')
+        data.make_appointment(1, [1], self.date_iso, '12:00:00')
+
+        self.assertFalse(SlotHold.objects.exists())
+
+    def test_check_slot_hold_view(self):
+        holds.hold_slot(1, self.date_iso, '12:00:00')
+        params = {'bot_token': BOT_TOKEN, 'user_id': 1, 'date_iso': self.date_iso, 'time_iso': '12:00:00'}
+
+        self.assertEqual(self.client.get('/bot/check_slot_hold', params).json(), {'held': True})
+        self.assertEqual(self.client.get('/bot/check_slot_hold', dict(params, user_id=2)).json(), {'held': False})
+        self.assertEqual(self.client.get('/bot/check_slot_hold', dict(params, bot_token='')).status_code, 403)
+
+
+class AsyncDataTests(TestCase):
+
+    def setUp(self):
+        catalog.invalidate()
+        self.service = Service.objects.create(title='Haircut', price=20)
+        self.date_iso = (datetime.date.today() + datetime.timedelta(days=1)).isoformat()
+
+    async def test_async_appointment_flow(self):
+        await sync_to_async(holds.hold_slot)(1, self.date_iso, '12:00:00')
+        self.assertTrue(await holds.acheck_slot_hold(1, self.date_iso, '12:00:00'))
+
+        await data.amake_appointment(1, [self.service.pk], self.date_iso, '12:00:00')
+
+        self.assertEqual(await data.aget_active_appointments(1), await sync_to_async(data.get_active_appointments)(1))
+        self.assertEqual((await data.aget_active_appointments(1))[0]['services_titles'], ['Haircut'])
+
+
+@strict_query_budgets
+class CreateInvoiceLinkTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        date_iso = (datetime.date.today() + datetime.timedelta(days=1)).isoformat()
+        self.params = {
+            'description': 'Beauty salon services',
+            'prices': json.dumps([{'label': 'Haircut', 'amount': 2000}]),
+            'payload': f'1 10 [1] {date_iso} 12:00:00',
+            'initData': make_init_data(1),
+        }
+
+    def mock_telegram(self, ok=True):
+        response = mock.Mock(ok=ok, text=json.dumps({'ok': ok, 'result': 'https://t.me/$invoice'}))
+        response.json.return_value = {'ok': ok}
+        return mock.patch.object(telegram.session, 'get', return_value=response)
+
+    def test_unauthorized(self):
+        response = self.client.get('/bot/create_invoice_link', dict(self.params, initData=make_init_data(1)[:-1]))
+
+        self.assertEqual(response.status_code, 401)
+
+    def test_invoice_link_for_another_user(self):
+        with self.mock_telegram() as telegram_get:
+            response = self.client.get('/bot/create_invoice_link', dict(self.params, initData=make_init_data(2)))
+
+        self.assertEqual(response.status_code, 403)
+        telegram_get.assert_not_called()
+
+    def test_invoice_link_is_reused(self):
+        stats = dict(telegram.invoice_link_stats)
+
+        with self.mock_telegram() as telegram_get:
+            first_response = self.client.get('/bot/create_invoice_link', self.params)
+            second_response = self.client.get('/bot/create_invoice_link', self.params)
+
+        self.assertEqual(telegram_get.call_count, 1)
+        self.assertEqual(json.loads(second_response.content)['result'], 'https://t.me/$invoice')
+        self.assertEqual(second_response.content, first_response.content)
+        self.assertEqual(telegram.invoice_link_stats['hits'] - stats['hits'], 1)
+        self.assertEqual(telegram.invoice_link_stats['misses'] - stats['misses'], 1)
+
+    def test_concurrent_requests_create_one_invoice_link(self):
+        response = mock.Mock(ok=True, text=json.dumps({'ok': True, 'result': 'https://t.me/$invoice'}))
+        response.json.return_value = {'ok': True}
+
+        def slow_get(*args, **kwargs):
+            time.sleep(0.02)
+            return response
+
+        args = (self.params['description'], self.params['payload'], self.params['prices'])
+        key = telegram.get_invoice_link_cache_key(*args)
+        with mock.patch.object(telegram.session, 'get', side_effect=slow_get) as telegram_get:
+            # All the threads get the lock of the order before it is first released
+            with telegram._key_lock(key):
+                threads = [threading.Thread(target=telegram.create_invoice_link, args=args) for _ in range(8)]
+                for thread in threads:
+                    thread.start()
+                while telegram._key_locks[key][1] < 9:
+                    time.sleep(0.001)
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(telegram_get.call_count, 1)
+        self.assertEqual(telegram._key_locks, {})
+
+    def test_failed_invoice_link_is_not_cached(self):
+        with self.mock_telegram(ok=False) as telegram_get:
+            self.client.get('/bot/create_invoice_link', self.params)
+            self.client.get('/bot/create_invoice_link', self.params)
+
+        self.assertEqual(telegram_get.call_count, 2)
+
+    def test_held_slot_conflict(self):
+        holds.hold_slot(2, self.params['payload'].split()[3], '12:00:00')
+
+        with self.mock_telegram() as telegram_get:
+            response = self.client.get('/bot/create_invoice_link', self.params)
+
+        self.assertEqual(response.status_code, 409)
+        telegram_get.assert_not_called()
+
+
+@strict_query_budgets
+class AuthTests(TestCase):
+
+    def test_verified_init_data(self):
+        init_data = auth.verify_init_data(make_init_data(5))
+
+        self.assertEqual(init_data.user['id'], 5)
+        self.assertEqual(init_data.user['first_name'], 'Jane Doe')
+
+    def test_tampered_init_data(self):
+        init_data = make_init_data(5).replace('%22id%22%3A+5', '%22id%22%3A+6')
+
+        self.assertIsNone(auth.verify_init_data(init_data))
+
+    def test_non_ascii_credentials(self):
+        init_data = make_init_data(5).rsplit('hash=', 1)[0] + 'hash=%C3%A9'
+        self.assertIsNone(auth.verify_init_data(init_data))
+
+        self.assertEqual(self.client.get('/bot/get_free_appointment_dates', {'initData': init_data}).status_code, 401)
+        self.assertEqual(self.client.get('/bot/check_slot_hold', {'bot_token': 'é'}).status_code, 403)
+
+    def test_expired_init_data(self):
+        init_data = make_init_data(5, auth_date=int(time.time()) - auth.INIT_DATA_MAX_AGE - 1)
+
+        self.assertIsNone(auth.verify_init_data(init_data))
+
+    def test_verified_init_data_is_cached(self):
+        init_data = make_init_data(5)
+
+        with mock.patch.object(auth, '_verify_init_data', wraps=auth._verify_init_data) as verify:
+            auth.verify_init_data(init_data)
+            auth.verify_init_data(init_data)
+
+        self.assertEqual(verify.call_count, 1)
+
+    def test_verified_init_data_cache_is_bounded(self):
+        with mock.patch.object(auth, 'VERIFIED_INIT_DATA_CACHE_SIZE', 2):
+            for user_id in range(3):
+                auth.verify_init_data(make_init_data(user_id))
+
+        self.assertLessEqual(len(auth._verified_init_data), 2)
+
+    def test_bot_token_header(self):
+        params = {'user_id': 1}
+
+        self.assertEqual(self.client.get('/bot/get_active_appointments', params).status_code, 403)
+        self.assertEqual(self.client.get('/bot/get_active_appointments', params, HTTP_X_BOT_TOKEN=BOT_TOKEN).status_code, 200)
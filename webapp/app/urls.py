@@ -6,6 +6,9 @@ urlpatterns = [
     path('make_order', views.make_order, name='make_order'),
     path('get_free_appointment_dates', views.get_free_appointment_dates, name='get_free_appointment_dates'),
     path('get_active_appointments', views.get_active_appointments, name='get_active_appointments'),
+    path('get_upcoming_appointments', views.get_upcoming_appointments, name='get_upcoming_appointments'),
     path('create_invoice_link', views.create_invoice_link, name='create_invoice_link'),
     path('make_appointment', views.make_appointment, name='make_appointment'),
+    path('check_slot_hold', views.check_slot_hold, name='check_slot_hold'),
+    path('get_services_report', views.get_services_report, name='get_services_report'),
 ]
@@ -1,79 +1,135 @@
-import hmac
-from hashlib import sha256
-from urllib.parse import unquote
+import datetime
 import json
-import requests
-from app import data
-from django.http import HttpResponse, JsonResponse
-from django.shortcuts import render
-from mysecrets import BOT_TOKEN, PROVIDER_TOKEN
+from app import availability, catalog, data, holds, metrics, pages, reporting, scheduling, telegram
+from app.auth import bot_token_required, init_data_required
+from app.queries import query_budget
+from django.db import IntegrityError
+from django.http import HttpResponse, HttpResponseNotModified, JsonResponse
+from django.utils.http import parse_etags
 
-# Create a secret key using HMAC for securing data
-secret_key = hmac.new(b'WebAppData', bytes(BOT_TOKEN, encoding='utf-8'), sha256).digest()
+
+def accepts_encoding(request, encoding: str) -> bool:
+    # Check whether the client accepts the content encoding (and has not disabled it with q=0)
+    for accepted in request.headers.get('Accept-Encoding', '').split(','):
+        name, _, params = accepted.strip().partition(';')
+        if name.strip() == encoding:
+            return params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+    return False
 
 
 # Define a view function to render the "make_order" page
-def make_order(request):
+@query_budget(4)
+async def make_order(request):
     # Extract the 'init_message_id' from the request's GET parameters
     init_message_id = request.GET.get('init_message_id')
 
-    if init_message_id is None:
+    if init_message_id is None or not init_message_id.isdigit():
         return HttpResponse("Bad Request", status=400)
 
-    # Retrieve services and their JSON representation
-    services, services_json = data.get_services_with_json()
+    # The page is rendered once per version of the service catalog and of the free dates it embeds,
+    # the 'init_message_id' is read by the page itself
+    page = await pages.aget_make_order_page()
 
-    return render(
-        request,
-        'make_order.html',
-        context={
-            'init_message_id': int(init_message_id),
-            'services': services, 'services_json': services_json
-        }
-    )
+    if accepts_encoding(request, 'br') and page.content_brotli is not None:
+        content, content_encoding, etag = page.content_brotli, 'br', f'"{page.etag}-br"'
+    elif accepts_encoding(request, 'gzip'):
+        content, content_encoding, etag = page.content_gzip, 'gzip', f'"{page.etag}-gzip"'
+    else:
+        content, content_encoding, etag = page.content, None, f'"{page.etag}"'
 
+    if etag in parse_etags(request.headers.get('If-None-Match', '')):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(content, content_type='text/html; charset=utf-8')
+        if content_encoding is not None:
+            response['Content-Encoding'] = content_encoding
 
-# Define a view function to get free appointment dates
-def get_free_appointment_dates(request):
-    # Retrieve free appointment dates from the data module
-    free_dates = data.get_free_appointment_dates()
+    response['ETag'] = etag
+    response['Vary'] = 'Accept-Encoding'
+    # Let the client cache the page, but revalidate it on every open to pick up catalog changes
+    response['Cache-Control'] = 'no-cache'
 
-    return JsonResponse({
-        'free_dates': free_dates
-    })
+    return response
 
 
-# Define a view function to get active appointments for a user
-def get_active_appointments(request):
-    # Extract the 'bot_token' and 'user_id' from the request's GET parameters
-    bot_token = request.GET.get('bot_token')
+# Define a view function to get free appointment dates
+@query_budget(4)
+@init_data_required
+async def get_free_appointment_dates(request):
+    # The free start times depend on the total duration of the selected services (optional)
+    services_ids = request.GET.get('services_ids')
+    duration = scheduling.DEFAULT_DURATION
+
+    if services_ids is not None:
+        try:
+            services_ids = json.loads(services_ids)
+        except ValueError:
+            return HttpResponse("Bad Request", status=400)
+        if not isinstance(services_ids, list) or not all(isinstance(service_id, int) for service_id in services_ids):
+            return HttpResponse("Bad Request", status=400)
+        duration = await catalog.aget_duration(services_ids)
+
+    # Retrieve free appointment dates, cached per availability version
+    free_slots_map = await availability.aget_free_slots_map(duration)
+    etag = f'"{free_slots_map.etag}"'
+
+    # The Mini App revalidates the dates on every open, which needs no database work while nothing is booked
+    if etag in parse_etags(request.headers.get('If-None-Match', '')):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(free_slots_map.content, content_type='application/json')
+
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+
+    return response
 
-    if bot_token != BOT_TOKEN:
-        return HttpResponse("Forbidden", status=403)
 
+# Define a view function to get active appointments for a user
+@query_budget(2)
+@bot_token_required
+async def get_active_appointments(request):
+    # Extract the 'user_id' and the page (keyset cursors and size) from the request's GET parameters
     user_id = request.GET.get('user_id')
+    after = request.GET.get('after')
+    before = request.GET.get('before')
+    limit = request.GET.get('limit', str(data.ACTIVE_APPOINTMENTS_PAGE_SIZE))
 
-    if user_id is None:
+    if user_id is None or not user_id.isdigit() or not limit.isdigit() or (after is not None and before is not None):
         return HttpResponse("Bad Request", status=400)
 
-    # Retrieve active appointments for the specified user
-    return JsonResponse({
-        'active_appointments': data.get_active_appointments(int(user_id))
-    })
+    limit = min(max(int(limit), 1), data.MAX_ACTIVE_APPOINTMENTS_PAGE_SIZE)
 
+    # Retrieve a page of active appointments for the specified user
+    try:
+        return JsonResponse(await data.aget_active_appointments_page(int(user_id), after=after, before=before, limit=limit))
+    except ValueError:
+        # Malformed cursor
+        return HttpResponse("Bad Request", status=400)
 
-# Define a view function to create an invoice link for payment
-def create_invoice_link(request):
-    # Extract data related to invoice creation from the request's GET parameters
-    init_data_hash = request.GET.get('initDataHash')
-    data_check_string = request.GET.get('dataCheckString')
 
-    data_check_string_unquote = unquote(data_check_string.replace('&', '\n'))
-    hash = hmac.new(secret_key, bytes(data_check_string_unquote, encoding='utf-8'), sha256).hexdigest()
+# Define a view function to get the appointments starting in a window of time, for the reminders of the bot
+@query_budget(2)
+@bot_token_required
+async def get_upcoming_appointments(request):
+    # Extract the 'start' and 'end' of the window (local date and time in ISO format) from the request's GET parameters
+    try:
+        start = datetime.datetime.fromisoformat(request.GET['start'])
+        end = datetime.datetime.fromisoformat(request.GET['end'])
+    except (KeyError, ValueError):
+        return HttpResponse("Bad Request", status=400)
+
+    if not start <= end <= start + data.MAX_UPCOMING_APPOINTMENTS_WINDOW:
+        return HttpResponse("Bad Request", status=400)
+
+    return JsonResponse({'appointments': await data.aget_upcoming_appointments(start, end)})
 
-    if hash != init_data_hash:
-        return HttpResponse("Unauthorized", status=401)
 
+# Define a view function to create an invoice link for payment
+@query_budget(9)
+@init_data_required
+async def create_invoice_link(request):
+    # Extract data related to invoice creation from the request's GET parameters
     description = request.GET.get('description')
     payload = request.GET.get('payload')
     prices = request.GET.get('prices')
@@ -81,43 +137,93 @@ def create_invoice_link(request):
     if description is None or payload is None or prices is None:
         return HttpResponse("Bad Request", status=400)
 
-    # Send a request to the Telegram Bot API to create an invoice link
-    response = requests.get(
-        f'https://api.telegram.org/bot{BOT_TOKEN}/createInvoiceLink',
-        {
-            'title': "Appointment",
-            'description': description,
-            'payload': payload,
-            'provider_token': PROVIDER_TOKEN,
-            'currency': 'USD',
-            'prices': prices,
-            'photo_url': 'https://images.pexels.com/photos/853427/pexels-photo-853427.jpeg?cs=srgb&dl=pexels-delbeautybox-853427.jpg&fm=jpg',
-            'need_name': True,
-            'need_phone_number': True
-        }
-    )
-
-    return HttpResponse(response.text)
-
+    # Hold the slot for the user while the invoice is being paid
+    try:
+        user_id, _, services_ids, date_iso, time_iso = payload.split()
+        user_id = int(user_id)
+        services_ids = json.loads(services_ids)
+        datetime.date.fromisoformat(date_iso)
+        datetime.time.fromisoformat(time_iso)
+    except ValueError:
+        return HttpResponse("Bad Request", status=400)
 
-# Define a view function to make an appointment
-def make_appointment(request):
-    # Extract the 'bot_token', 'user_id', 'services_ids', 'date_iso', and 'time_iso'
-    # from the request's GET parameters
-    bot_token = request.GET.get('bot_token')
+    if not isinstance(services_ids, list) or not all(isinstance(service_id, int) for service_id in services_ids):
+        return HttpResponse("Bad Request", status=400)
 
-    if bot_token != BOT_TOKEN:
+    # The invoice can only be created for the user who opened the Mini App
+    if user_id != request.telegram_user.get('id'):
         return HttpResponse("Forbidden", status=403)
 
+    if not await holds.ahold_slot(user_id, date_iso, time_iso, await catalog.aget_duration(services_ids)):
+        return HttpResponse("Conflict", status=409)
+
+    # Create an invoice link with the Telegram Bot API (or reuse the one created for the same order)
+    response_text = await telegram.acreate_invoice_link(description, payload, prices)
+
+    return HttpResponse(response_text)
+
+
+# Define a view function to make an appointment
+@query_budget(11)
+@bot_token_required
+async def make_appointment(request):
+    # Extract the 'user_id', 'services_ids', 'date_iso', 'time_iso', and 'charge_id' (optional)
+    # from the request's GET parameters
     user_id = int(request.GET.get('user_id'))
     services_ids = json.loads(request.GET.get('services_ids'))
     date_iso = request.GET.get('date_iso')
     time_iso = request.GET.get('time_iso')
+    charge_id = request.GET.get('charge_id')
 
     if user_id is None or services_ids is None or date_iso is None or time_iso is None:
         return HttpResponse("Bad Request", status=400)
 
     # Call a function to make an appointment using the extracted data
-    data.make_appointment(user_id, services_ids, date_iso, time_iso)
+    try:
+        await data.amake_appointment(user_id, services_ids, date_iso, time_iso, charge_id)
+    except IntegrityError:
+        return HttpResponse("Conflict", status=409)
 
     return HttpResponse("OK", status=200)
+
+
+# Define a view function to check that the user holds the slot before the payment
+@query_budget(1)
+@bot_token_required
+async def check_slot_hold(request):
+    # Extract the 'user_id', 'date_iso', and 'time_iso' from the request's GET parameters
+    user_id = request.GET.get('user_id')
+    date_iso = request.GET.get('date_iso')
+    time_iso = request.GET.get('time_iso')
+
+    if user_id is None or date_iso is None or time_iso is None:
+        return HttpResponse("Bad Request", status=400)
+
+    return JsonResponse({
+        'held': await holds.acheck_slot_hold(int(user_id), date_iso, time_iso)
+    })
+
+
+# Define a view function to get the bookings and revenue per service over a range of days
+@query_budget(2)
+@bot_token_required
+async def get_services_report(request):
+    # Extract the 'date_from' and 'date_to' from the request's GET parameters, both included
+    try:
+        date_from = datetime.date.fromisoformat(request.GET['date_from'])
+        date_to = datetime.date.fromisoformat(request.GET['date_to'])
+    except (KeyError, ValueError):
+        return HttpResponse("Bad Request", status=400)
+
+    if not 0 <= (date_to - date_from).days < reporting.MAX_REPORT_DAYS:
+        return HttpResponse("Bad Request", status=400)
+
+    # The report is read from the daily statistics, not from the appointments
+    return JsonResponse(await reporting.aget_report(date_from, date_to))
+
+
+# Define a view function to serve the metrics of the webapp in the Prometheus format
+@query_budget(0)
+@bot_token_required
+async def get_metrics(request):
+    return HttpResponse(metrics.render_metrics(), content_type=metrics.CONTENT_TYPE_LATEST)
@@ -19,7 +19,7 @@ PROVIDER_TOKEN = environ['PROVIDER_TOKEN']
 
 DJANGO_SECRET_KEY = environ['DJANGO_SECRET_KEY']
 
-# For server-side webhook:
-# WEBHOOK_SECRET = environ['WEBHOOK_SECRET']
-#
-# BASE_WEBHOOK_URL = environ['BASE_WEBHOOK_URL']
+# For server-side webhook (not needed for polling):
+WEBHOOK_SECRET = environ.get('WEBHOOK_SECRET')
+
+BASE_WEBHOOK_URL = environ.get('BASE_WEBHOOK_URL')
@@ -46,9 +46,17 @@ INSTALLED_APPS = [
     "django_extensions",
 ]
 
+# Log the requests going over the query budgets of their views and the repeated queries (see app/queries.py)
+QUERY_INSPECTOR = DEBUG
+
+# Fail the requests going over the query budgets instead of logging them, enabled by the tests
+QUERY_BUDGET_STRICT = False
+
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
+    'app.metrics.metrics_middleware',
+    'app.queries.query_inspector_middleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -125,6 +133,10 @@ STATICFILES_DIRS = (
     os.path.join(BASE_DIR, 'static'),
 )
 
+# collectstatic stores the static files under content-hashed names, with gzip and brotli variants,
+# and WhiteNoise serves the hashed files with a long cache lifetime
+STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/?.?/ref/settings/#default-auto-field
 
@@ -16,7 +16,10 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import include, path
 
+from app import views
+
 urlpatterns = [
     path('bot/', include('app.urls')),
     path('admin/', admin.site.urls),
+    path('metrics', views.get_metrics, name='metrics'),
 ]
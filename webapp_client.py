@@ -0,0 +1,317 @@
+import asyncio
+import datetime
+import json
+import logging
+import os
+import sys
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# Statuses on which the webapp (or the proxy in front of it) is worth asking again
+RETRYABLE_STATUSES = {502, 503, 504}
+
+
+class WebappClient:
+    """
+    Asynchronous HTTP client for the bot -> webapp calls.
+
+    A single keep-alive connection pool is shared by all handlers, so the TLS handshake is paid once
+    instead of on every request, and no handler blocks the event loop while the webapp is answering.
+    """
+
+    def __init__(self, base_url: str, bot_token: str,
+                 timeout: float = 10.0,
+                 max_connections: int = 20,
+                 max_concurrency: int = 10,
+                 retries: int = 2,
+                 retry_backoff: float = 0.5):
+        """
+        Args:
+            base_url (str): The webapp URL (WEBAPP_URL), e.g. 'https://example.com/bot'.
+            bot_token (str): The bot token used to authenticate against the webapp.
+            timeout (float, optional): Total timeout of a single request in seconds. Default is 10.
+            max_connections (int, optional): Size of the keep-alive connection pool. Default is 20.
+            max_concurrency (int, optional): Maximum number of requests in flight at once. Default is 10.
+            retries (int, optional): How many times a failed request is retried. Default is 2.
+            retry_backoff (float, optional): Base delay between retries in seconds, doubled on every attempt. Default is 0.5.
+        """
+        self.base_url = base_url.rstrip('/')
+        self.bot_token = bot_token
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.max_connections = max_connections
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # The session is created lazily, so that it is bound to the running event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                keepalive_timeout=60,
+                # The webapp may use a self-signed certificate during local development
+                ssl=False,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def close(self):
+        """
+        Close the connection pool.
+        """
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def request(self, path: str, params: Dict[str, Any], idempotent: bool = True) -> aiohttp.ClientResponse:
+        """
+        Make a GET request to the webapp and read the response body.
+
+        Connection failures are retried with exponential backoff. Gateway errors and timeouts are retried
+        only for idempotent requests, since the webapp may already have processed them.
+
+        Args:
+            path (str): The path relative to the webapp URL, e.g. 'get_active_appointments'.
+            params (Dict[str, Any]): Query parameters. The bot token is added automatically.
+            idempotent (bool, optional): Whether it is safe to repeat the request after a gateway error or a timeout.
+                Default is True.
+
+        Returns:
+            aiohttp.ClientResponse: The response with its body already read.
+        """
+        params = {key: str(value) for key, value in params.items()}
+        # The token is sent in a header to keep it out of the webapp access logs
+        headers = {'X-Bot-Token': self.bot_token}
+        url = f'{self.base_url}/{path}'
+
+        attempt = 0
+        while True:
+            try:
+                async with self._semaphore:
+                    async with self._get_session().get(url, params=params, headers=headers) as response:
+                        await response.read()
+                if response.status not in RETRYABLE_STATUSES or not idempotent or attempt >= self.retries:
+                    response.raise_for_status()
+                    return response
+                logger.warning("Webapp returned %s for %s, retrying", response.status, path)
+            except (aiohttp.ClientConnectorError, asyncio.TimeoutError) as e:
+                if attempt >= self.retries or (isinstance(e, asyncio.TimeoutError) and not idempotent):
+                    raise
+                logger.warning("Webapp request to %s failed (%r), retrying", path, e)
+
+            await asyncio.sleep(self.retry_backoff * 2 ** attempt)
+            attempt += 1
+
+    async def get_active_appointments(self, user_id: int,
+                                      after: Optional[str] = None,
+                                      before: Optional[str] = None,
+                                      limit: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Get a page of active appointments of the user.
+
+        Args:
+            user_id (int): The Telegram user ID.
+            after (str, optional): Cursor of the appointment the page starts after. Default is None (the first page).
+            before (str, optional): Cursor of the appointment the page ends before. Default is None.
+            limit (int, optional): The page size. Default is None (the page size of the webapp).
+
+        Returns:
+            Dict[str, Any]: The 'active_appointments' of the page and the 'prev' and 'next' cursors (None if there is no such page).
+        """
+        params = {'user_id': user_id, 'after': after, 'before': before, 'limit': limit}
+        response = await self.request('get_active_appointments', {
+            key: value for key, value in params.items() if value is not None
+        })
+        return await response.json()
+
+    async def get_upcoming_appointments(self, start: datetime.datetime, end: datetime.datetime) -> List[Dict[str, Any]]:
+        """
+        Get the appointments of all users starting in a window of time.
+
+        Args:
+            start (datetime.datetime): The start of the window (local time), included.
+            end (datetime.datetime): The end of the window (local time), excluded. At most 7 days after the start.
+
+        Returns:
+            List[Dict[str, Any]]: The 'id', 'user_id', 'services_titles', 'date' and 'time' of the appointments,
+                ordered by date and time.
+        """
+        response = await self.request('get_upcoming_appointments', {
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+        })
+        return (await response.json())['appointments']
+
+    async def make_appointment(self, user_id: int, services_ids: str, date_iso: str, time_iso: str,
+                               charge_id: Optional[str] = None):
+        """
+        Create an appointment.
+
+        Args:
+            user_id (int): The Telegram user ID.
+            services_ids (str): JSON list of the booked services IDs.
+            date_iso (str): The appointment date in ISO format.
+            time_iso (str): The appointment time in ISO format.
+            charge_id (str, optional): The Telegram payment charge ID. The appointment of a payment is booked once,
+                so the call can be repeated. Default is None.
+        """
+        params = {'user_id': user_id, 'services_ids': services_ids, 'date_iso': date_iso, 'time_iso': time_iso,
+                  'charge_id': charge_id}
+        await self.request('make_appointment', {
+            key: value for key, value in params.items() if value is not None
+        }, idempotent=False)
+
+    async def check_slot_hold(self, user_id: int, date_iso: str, time_iso: str) -> bool:
+        """
+        Check that the user holds the slot (and extend the hold for the time of the payment).
+
+        Args:
+            user_id (int): The Telegram user ID.
+            date_iso (str): The appointment date in ISO format.
+            time_iso (str): The appointment time in ISO format.
+
+        Returns:
+            bool: Whether the user holds the slot.
+        """
+        response = await self.request('check_slot_hold', {
+            'user_id': user_id,
+            'date_iso': date_iso,
+            'time_iso': time_iso,
+        })
+        return (await response.json())['held']
+
+
+class DirectWebappClient:
+    """
+    Client with the same interface as WebappClient that calls the async data functions of the webapp directly
+    through the Django ORM, for deployments where the bot runs next to the webapp and has access to its database.
+
+    It saves the HTTP round trip, the JSON serialization and a webapp worker on every call.
+    As there is no request cycle in the bot, obsolete database connections are closed before every call,
+    the same way Django does it at the start of a request.
+    """
+
+    def __init__(self, webapp_dir: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'webapp')):
+        """
+        Args:
+            webapp_dir (str, optional): The directory of the Django project. Default is the 'webapp' directory next to this file.
+        """
+        setup_django(webapp_dir)
+
+        from app import data, holds
+        from asgiref.sync import sync_to_async
+        from django.db import close_old_connections
+        self._data = data
+        self._holds = holds
+        self._close_old_connections = sync_to_async(close_old_connections)
+
+    async def close(self):
+        """
+        Close the database connections of the Django ORM.
+        """
+        from asgiref.sync import sync_to_async
+        from django.db import connections
+        await sync_to_async(connections.close_all)()
+
+    async def get_active_appointments(self, user_id: int,
+                                      after: Optional[str] = None,
+                                      before: Optional[str] = None,
+                                      limit: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Get a page of active appointments of the user.
+
+        Args:
+            user_id (int): The Telegram user ID.
+            after (str, optional): Cursor of the appointment the page starts after. Default is None (the first page).
+            before (str, optional): Cursor of the appointment the page ends before. Default is None.
+            limit (int, optional): The page size. Default is None (the page size of the webapp).
+
+        Returns:
+            Dict[str, Any]: The page in the same format as returned by the webapp.
+        """
+        await self._close_old_connections()
+        page = await self._data.aget_active_appointments_page(
+            user_id, after=after, before=before, limit=limit or self._data.ACTIVE_APPOINTMENTS_PAGE_SIZE
+        )
+        page['active_appointments'] = [
+            dict(active_appointment,
+                 date=active_appointment['date'].isoformat(),
+                 time=active_appointment['time'].isoformat())
+            for active_appointment in page['active_appointments']
+        ]
+        return page
+
+    async def get_upcoming_appointments(self, start: datetime.datetime, end: datetime.datetime) -> List[Dict[str, Any]]:
+        """
+        Get the appointments of all users starting in a window of time.
+
+        Args:
+            start (datetime.datetime): The start of the window (local time), included.
+            end (datetime.datetime): The end of the window (local time), excluded.
+
+        Returns:
+            List[Dict[str, Any]]: The appointments in the same format as returned by the webapp.
+        """
+        await self._close_old_connections()
+        return [
+            dict(appointment, date=appointment['date'].isoformat(), time=appointment['time'].isoformat())
+            for appointment in await self._data.aget_upcoming_appointments(start, end)
+        ]
+
+    async def make_appointment(self, user_id: int, services_ids: str, date_iso: str, time_iso: str,
+                               charge_id: Optional[str] = None):
+        """
+        Create an appointment.
+
+        Args:
+            user_id (int): The Telegram user ID.
+            services_ids (str): JSON list of the booked services IDs.
+            date_iso (str): The appointment date in ISO format.
+            time_iso (str): The appointment time in ISO format.
+            charge_id (str, optional): The Telegram payment charge ID. The appointment of a payment is booked once,
+                so the call can be repeated. Default is None.
+        """
+        await self._close_old_connections()
+        await self._data.amake_appointment(user_id, json.loads(services_ids), date_iso, time_iso, charge_id)
+
+    async def check_slot_hold(self, user_id: int, date_iso: str, time_iso: str) -> bool:
+        """
+        Check that the user holds the slot (and extend the hold for the time of the payment).
+
+        Args:
+            user_id (int): The Telegram user ID.
+            date_iso (str): The appointment date in ISO format.
+            time_iso (str): The appointment time in ISO format.
+
+        Returns:
+            bool: Whether the user holds the slot.
+        """
+        await self._close_old_connections()
+        return await self._holds.acheck_slot_hold(user_id, date_iso, time_iso)
+
+
+def setup_django(webapp_dir: str):
+    """
+    Set up the Django project of the webapp in the bot process.
+
+    Args:
+        webapp_dir (str): The directory of the Django project.
+    """
+    if webapp_dir not in sys.path:
+        sys.path.insert(0, webapp_dir)
+
+    # 'webapp.mysecrets' is imported from the repository root, which makes 'webapp' a namespace package
+    # of the project directory itself; drop it, so that 'webapp.settings' is found in the Django project package
+    webapp_package = sys.modules.get('webapp')
+    if webapp_package is not None and getattr(webapp_package, '__file__', None) is None:
+        del sys.modules['webapp']
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'webapp.settings')
+
+    import django
+    django.setup()
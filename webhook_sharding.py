@@ -0,0 +1,227 @@
+import asyncio
+import hmac
+import json
+import logging
+import multiprocessing
+import zlib
+from typing import Any, Callable, Dict, List, Optional
+
+from aiogram import Bot, Dispatcher
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def get_update_chat_id(update: Dict[str, Any]) -> Optional[int]:
+    """
+    Get the ID of the chat an update belongs to (or of the user, for updates without a chat).
+
+    Args:
+        update (Dict[str, Any]): The raw update.
+
+    Returns:
+        Optional[int]: The chat ID, or None if the update is not related to a chat or a user.
+    """
+    for key, value in update.items():
+        if key == 'update_id' or not isinstance(value, dict):
+            continue
+        # Messages and chat member updates have a chat, callback queries have it in their message
+        for event in (value, value.get('message')):
+            if isinstance(event, dict) and isinstance(event.get('chat'), dict):
+                return event['chat']['id']
+        # Other queries (pre-checkout, inline, etc.) only have a user
+        if isinstance(value.get('from'), dict):
+            return value['from']['id']
+        if isinstance(value.get('user'), dict):
+            return value['user']['id']
+    return None
+
+
+def get_shard(chat_id: Optional[int], shards: int) -> int:
+    """
+    Get the shard (worker index) of a chat. Updates without a chat go to the first shard.
+
+    Args:
+        chat_id (Optional[int]): The chat ID.
+        shards (int): The number of shards.
+
+    Returns:
+        int: The shard index.
+    """
+    if chat_id is None:
+        return 0
+    return zlib.crc32(str(chat_id).encode()) % shards
+
+
+class ChatOrderedProcessor:
+    """
+    Processes updates concurrently, but the updates of the same chat one after another, in the order of arrival.
+    """
+
+    def __init__(self, process: Callable, max_concurrent_updates: int = 100):
+        """
+        Args:
+            process (Callable): Coroutine function that processes a raw update.
+            max_concurrent_updates (int, optional): Maximum number of updates processed at once. Default is 100.
+        """
+        self.process = process
+        self._semaphore = asyncio.Semaphore(max_concurrent_updates)
+        self._chat_tails: Dict[Optional[int], asyncio.Task] = dict()
+
+    async def _process_after(self, update: Dict[str, Any], previous: Optional[asyncio.Task]):
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            await self.process(update)
+        except Exception:
+            logger.exception("Failed to process update %s", update.get('update_id'))
+        finally:
+            self._semaphore.release()
+
+    async def submit(self, update: Dict[str, Any]) -> asyncio.Task:
+        """
+        Schedule processing of an update, waiting while too many updates are being processed.
+
+        Args:
+            update (Dict[str, Any]): The raw update.
+
+        Returns:
+            asyncio.Task: The processing task.
+        """
+        await self._semaphore.acquire()
+
+        chat_id = get_update_chat_id(update)
+        task = asyncio.create_task(self._process_after(update, self._chat_tails.get(chat_id)))
+        self._chat_tails[chat_id] = task
+
+        def forget(task: asyncio.Task):
+            if self._chat_tails.get(chat_id) is task:
+                del self._chat_tails[chat_id]
+        task.add_done_callback(forget)
+
+        return task
+
+    async def join(self):
+        """
+        Wait until all submitted updates are processed.
+        """
+        while self._chat_tails:
+            await asyncio.wait(list(self._chat_tails.values()))
+
+
+class ShardedWebhook:
+    """
+    Webhook that spreads update processing over several worker processes.
+
+    The web server process only checks the secret token, picks the worker by a hash of the chat ID and answers
+    Telegram right away. Every worker feeds its updates to the dispatcher, keeping the order of the updates of each chat.
+    Workers are forked, so they share the dispatcher, handlers and bot set up in the parent process.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, workers: int,
+                 secret_token: Optional[str] = None,
+                 max_concurrent_updates: int = 100,
+                 worker_init: Optional[Callable[[int], None]] = None):
+        """
+        Args:
+            dispatcher (Dispatcher): The dispatcher to feed the updates to.
+            bot (Bot): The bot instance.
+            workers (int): The number of worker processes.
+            secret_token (str, optional): The secret token of the webhook. Default is None (not checked).
+            max_concurrent_updates (int, optional): Maximum number of updates processed at once by a worker. Default is 100.
+            worker_init (Callable[[int], None], optional): Called with the worker index at the start of every worker. Default is None.
+        """
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.workers = workers
+        self.secret_token = secret_token
+        self.max_concurrent_updates = max_concurrent_updates
+        self.worker_init = worker_init
+
+        self._context = multiprocessing.get_context('fork')
+        self._queues: List[multiprocessing.Queue] = list()
+        self._processes: List[multiprocessing.Process] = list()
+
+    def start_workers(self):
+        """
+        Start the worker processes. It must be called before the event loop of the web server is started.
+        """
+        for index in range(self.workers):
+            queue = self._context.Queue()
+            process = self._context.Process(target=self._run_worker, args=(index, queue), daemon=True,
+                                            name=f'webhook-worker-{index}')
+            process.start()
+            self._queues.append(queue)
+            self._processes.append(process)
+
+    def stop_workers(self, timeout: float = 30):
+        """
+        Let the workers finish the queued updates and stop them.
+
+        Args:
+            timeout (float, optional): How long to wait for every worker, in seconds. Default is 30.
+        """
+        for queue in self._queues:
+            queue.put(None)
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        self._queues.clear()
+        self._processes.clear()
+
+    def dispatch(self, update: Dict[str, Any], raw_update: bytes):
+        """
+        Pass the update to the worker of its chat.
+
+        Args:
+            update (Dict[str, Any]): The parsed update.
+            raw_update (bytes): The update as received.
+        """
+        self._queues[get_shard(get_update_chat_id(update), self.workers)].put(raw_update)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret_token is not None and \
+                not hmac.compare_digest(request.headers.get(SECRET_TOKEN_HEADER, '').encode(), self.secret_token.encode()):
+            return web.Response(status=401, text="Unauthorized")
+
+        raw_update = await request.read()
+        try:
+            update = json.loads(raw_update)
+        except ValueError:
+            return web.Response(status=400, text="Bad Request")
+
+        self.dispatch(update, raw_update)
+        return web.Response()
+
+    def register(self, app: web.Application, path: str):
+        """
+        Register the webhook handler on the application.
+
+        Args:
+            app (web.Application): The aiohttp application.
+            path (str): The webhook path.
+        """
+        app.router.add_post(path, self.handle)
+
+    def _run_worker(self, index: int, queue: multiprocessing.Queue):
+        if self.worker_init is not None:
+            self.worker_init(index)
+        asyncio.run(self._worker(queue))
+
+    async def _worker(self, queue: multiprocessing.Queue):
+        loop = asyncio.get_running_loop()
+        processor = ChatOrderedProcessor(
+            lambda update: self.dispatcher.feed_raw_update(self.bot, update),
+            max_concurrent_updates=self.max_concurrent_updates
+        )
+
+        try:
+            while (raw_update := await loop.run_in_executor(None, queue.get)) is not None:
+                await processor.submit(json.loads(raw_update))
+            await processor.join()
+        finally:
+            await self.dispatcher.emit_shutdown(bot=self.bot)
+            await self.bot.session.close()